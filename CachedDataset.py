@@ -113,9 +113,37 @@ class CachedDataset(Dataset):
     for i in range(self._num_seqs):
       self._tag_idx[self._get_tag_by_real_idx(i)] = i
 
+  def supports_random_access(self):
+    """
+    :rtype: bool
+    """
+    return True
+
   def batch_set_generator_cache_whole_epoch(self):
     return True
 
+  def _get_all_seq_lengths_nd(self):
+    """
+    :return: lengths of all seqs, by real seq idx, shape (num_seqs, 1 + len(target_keys)), see get_seq_length_nd
+    :rtype: numpy.ndarray
+    """
+    return numpy.array(
+      [self._get_seq_length_by_real_idx(i) for i in range(self._num_seqs)],
+      dtype="int64").reshape((self._num_seqs, 1 + len(self.target_keys)))
+
+  def get_batch_plan_cache_key(self):
+    """
+    :return: key which identifies the seq lengths in the current seq order
+    :rtype: str
+    """
+    import hashlib
+    seq_order = numpy.array(self._seq_index, dtype="int64")[numpy.array(list(self._index_map), dtype="int64")]
+    seq_lens = self._get_all_seq_lengths_nd()[seq_order]
+    h = hashlib.sha1()
+    h.update(repr(["data"] + list(self.target_keys)).encode("utf8"))
+    h.update(numpy.ascontiguousarray(seq_lens, dtype="int64").tobytes())
+    return h.hexdigest()
+
   def _init_alloc_intervals(self):
     if self.cache_byte_size_limit_at_start == 0:
       return
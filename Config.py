@@ -158,6 +158,9 @@ class Config:
                       help="[VALUE/LIST] Hidden layer types: forward, recurrent, lstm.")
     parser.add_option("-z", "--max_sequences", dest="max_seqs", help="[INTEGER] Maximal number of sequences per batch.")
     parser.add_option("--config", dest="load_config", help="[STRING] load config")
+    parser.add_option(
+      "--profile_startup", dest="profile_startup", action="store_const", const="True",
+      help="Report the wall time of the startup phases and imports.")
     (options, args) = parser.parse_args(list(args))
     options = vars(options)
     for opt in options.keys():
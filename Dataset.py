@@ -18,6 +18,7 @@ from random import Random, random
 
 import sys
 import os
+import bisect
 import numpy
 import functools
 import typing
@@ -123,11 +124,14 @@ class Dataset(object):
     self.unique_seq_tags = unique_seq_tags
     self._seq_order_seq_lens_file = seq_order_seq_lens_file
     self._seq_order_seq_lens_by_idx = None
+    self._num_shards = 1  # see set_shard
+    self._shard_index = 0
     # There is probably no use case for combining the two, so avoid potential misconfiguration.
     assert self.partition_epoch == 1 or self.repeat_epoch == 1, (
       "Combining partition_epoch and repeat_epoch is prohibited.")
     self.timestamps = None
     self.labels = {}  # type: typing.Dict[str,typing.List[str]]
+    self._serialize_data_lookups = {}  # key -> (labels, len, mode, table), see _get_serialize_data_lookup
     self.weights = {}
     self.nbytes = 0
     self.num_running_chars = 0  # CTC running chars.
@@ -362,6 +366,35 @@ class Dataset(object):
       self._seq_order_seq_lens_by_idx = [seq_lens[tag] for tag in all_tags]
     return self._seq_order_seq_lens_by_idx[seq_idx]
 
+  def get_all_seq_lens(self):
+    """
+    Bulk version of the seq length function which is used for the seq ordering
+    (i.e. the ``get_seq_len`` which the dataset passes to :func:`get_seq_order_for_epoch`).
+    This is optional, but if a dataset can provide this efficiently, it makes the seq ordering much faster.
+
+    :return: seq lengths by original (corpus) seq idx, or None if not implemented
+    :rtype: numpy.ndarray|None
+    """
+    return None
+
+  def _get_seq_lens_for_seq_order(self, num_seqs, get_seq_len):
+    """
+    :param int num_seqs:
+    :param ((int) -> int)|None get_seq_len: function (originalSeqIdx: int) -> int
+    :return: seq lengths for all original seq indices, shape (num_seqs,)
+    :rtype: numpy.ndarray
+    """
+    if self._seq_order_seq_lens_file:
+      self._get_seq_order_seq_lens_by_idx(0)  # make sure it is loaded
+      seq_lens = numpy.array(self._seq_order_seq_lens_by_idx, dtype="int64")
+    else:
+      seq_lens = self.get_all_seq_lens()
+      if seq_lens is None:
+        assert get_seq_len
+        seq_lens = numpy.fromiter(map(get_seq_len, range(num_seqs)), dtype="int64", count=num_seqs)
+    assert seq_lens.shape == (num_seqs,), "%s: seq lens shape %r, num seqs %i" % (self, seq_lens.shape, num_seqs)
+    return seq_lens
+
   def get_seq_order_for_epoch(self, epoch, num_seqs, get_seq_len=None):
     """
     Returns the order of the given epoch.
@@ -374,6 +407,22 @@ class Dataset(object):
     :return: the order for the given epoch. such that seq_idx -> underlying idx
     :rtype: list[int]
     """
+    return self.get_seq_order_for_epoch_array(epoch=epoch, num_seqs=num_seqs, get_seq_len=get_seq_len).tolist()
+
+  def get_seq_order_for_epoch_array(self, epoch, num_seqs, get_seq_len=None):
+    """
+    Like :func:`get_seq_order_for_epoch`, but returns a Numpy array, which is much faster for big datasets.
+    The seq lengths are fetched all at once (via :func:`get_all_seq_lens` if available)
+    and all the sorting is done via Numpy.
+    The shuffling still uses the Python :class:`random.Random`,
+    so that the order is exactly the same as it always was for the same seeds.
+
+    :param int epoch: for 'random', this determines the random seed
+    :param int num_seqs:
+    :param ((int) -> int)|None get_seq_len: function (originalSeqIdx: int) -> int
+    :return: the order for the given epoch. such that seq_idx -> underlying idx
+    :rtype: numpy.ndarray
+    """
     partition_epoch = self.partition_epoch or 1
     repeat_epoch = self.repeat_epoch or 1
     if not epoch:
@@ -382,9 +431,7 @@ class Dataset(object):
     if partition_epoch > 1:
       full_epoch = (epoch - 1) // partition_epoch + 1
     assert num_seqs > 0
-    seq_index = list(range(num_seqs))  # type: typing.List[int]  # the real seq idx after sorting
-    if self._seq_order_seq_lens_file:
-      get_seq_len = self._get_seq_order_seq_lens_by_idx
+    seq_index = numpy.arange(num_seqs, dtype="int64")  # the real seq idx after sorting
     if self.seq_ordering == 'default':
       pass  # Keep order as-is.
     elif self.seq_ordering.startswith("default_every_n:"):
@@ -395,18 +442,19 @@ class Dataset(object):
       seq_index = numpy.arange(num_seqs // num, dtype="int64").repeat(num)
       for i in range(1, num):
         seq_index[i::num] += i * (num_seqs // num)
-      seq_index = list(seq_index)
     elif self.seq_ordering == 'reverse':
-      seq_index = list(reversed(seq_index))
+      seq_index = seq_index[::-1]
     elif self.seq_ordering == 'sorted':
-      assert get_seq_len
-      seq_index.sort(key=get_seq_len)  # sort by length, starting with shortest
+      seq_lens = self._get_seq_lens_for_seq_order(num_seqs=num_seqs, get_seq_len=get_seq_len)
+      # Stable sort, i.e. the same as the Python sort.
+      seq_index = numpy.argsort(seq_lens, kind="stable")  # sort by length, starting with shortest
     elif self.seq_ordering == "sorted_reverse":
-      assert get_seq_len
-      seq_index.sort(key=get_seq_len, reverse=True)  # sort by length, in reverse, starting with longest
+      seq_lens = self._get_seq_lens_for_seq_order(num_seqs=num_seqs, get_seq_len=get_seq_len)
+      # Python sort with reverse=True is stable as well, which is the same as a stable sort of the negated lens.
+      seq_index = numpy.argsort(-seq_lens, kind="stable")  # sort by length, in reverse, starting with longest
     elif self.seq_ordering.startswith('sort_bin_shuffle'):
       # Shuffle seqs, sort by length, and shuffle bins (then shuffle seqs within each bin if sort_bin_shuffle_x2).
-      assert get_seq_len
+      seq_lens = self._get_seq_lens_for_seq_order(num_seqs=num_seqs, get_seq_len=get_seq_len)
       tmp = self.seq_ordering.split(':')[1:]
       # Keep this deterministic! Use fixed seed.
       if len(tmp) <= 1:
@@ -415,8 +463,8 @@ class Dataset(object):
         nth = int(tmp[1])
       rnd_seed = ((full_epoch - 1) // nth + 1) if full_epoch else 1
       rnd = Random(rnd_seed + self.random_seed_offset)
-      rnd.shuffle(seq_index)  # Shuffle sequences.
-      seq_index.sort(key=get_seq_len)  # Sort by length, starting with shortest.
+      seq_index = self._shuffled_array(rnd, seq_index)  # Shuffle sequences.
+      seq_index = seq_index[numpy.argsort(seq_lens[seq_index], kind="stable")]  # Sort by length, shortest first.
       if len(tmp) == 0:
         bins = 2
       else:
@@ -429,15 +477,15 @@ class Dataset(object):
       out_index = []
       for i in bin_ids:
         if i == bins - 1:
-          part = seq_index[i * len(seq_index) // bins:][:]
+          part = seq_index[i * len(seq_index) // bins:]
         else:
-          part = seq_index[i * len(seq_index) // bins:(i + 1) * len(seq_index) // bins][:]
+          part = seq_index[i * len(seq_index) // bins:(i + 1) * len(seq_index) // bins]
         if self.seq_ordering.startswith('sort_bin_shuffle_x2'):
-          rnd.shuffle(part)  # Shuffle within the bin.
-        out_index += part
-      seq_index = out_index
+          part = self._shuffled_array(rnd, part)  # Shuffle within the bin.
+        out_index.append(part)
+      seq_index = numpy.concatenate(out_index)
     elif self.seq_ordering.startswith('laplace'):
-      assert get_seq_len
+      seq_lens = self._get_seq_lens_for_seq_order(num_seqs=num_seqs, get_seq_len=get_seq_len)
       tmp = self.seq_ordering.split(':')[1:]
       if len(tmp) == 0:
         bins = 2
@@ -452,56 +500,72 @@ class Dataset(object):
         nth = int(tmp[1])
       rnd_seed = ((full_epoch - 1) // nth + 1) if full_epoch else 1
       rnd = Random(rnd_seed + self.random_seed_offset)
-      rnd.shuffle(seq_index)
+      seq_index = self._shuffled_array(rnd, seq_index)
       out_index = []
       for i in range(bins):
         if i == bins - 1:
-          part = seq_index[i * len(seq_index) // bins:][:]
+          part = seq_index[i * len(seq_index) // bins:]
         else:
-          part = seq_index[i * len(seq_index) // bins:(i + 1) * len(seq_index) // bins][:]
-        part.sort(key=get_seq_len, reverse=(i % 2 == 1))
-        out_index += part
-      seq_index = out_index
+          part = seq_index[i * len(seq_index) // bins:(i + 1) * len(seq_index) // bins]
+        part_lens = seq_lens[part]
+        if i % 2 == 1:
+          part_lens = -part_lens  # reverse, but stable
+        out_index.append(part[numpy.argsort(part_lens, kind="stable")])
+      seq_index = numpy.concatenate(out_index)
     elif self.seq_ordering.startswith('random'):
       tmp = self.seq_ordering.split(':')
       nth = int(tmp[1]) if len(tmp) > 1 else 1
       # Keep this deterministic! Use fixed seed.
       rnd_seed = (full_epoch - 1) / nth + 1
       rnd = Random(rnd_seed + self.random_seed_offset)
-      rnd.shuffle(seq_index)
+      seq_index = self._shuffled_array(rnd, seq_index)
     else:
       assert False, "invalid batching specified: " + self.seq_ordering
     if self.unique_seq_tags:
       # Note: This is as generic as possible, but requires that get_all_tags is implemented.
-      all_seq_tags = self.get_all_tags()
-      used_seq_tags = set()
-      seq_index = [
-        i for i in seq_index
-        if (all_seq_tags[i] not in used_seq_tags, used_seq_tags.add(all_seq_tags[i]))[0]]
+      all_seq_tags = numpy.array(self.get_all_tags())
+      # Keep the first occurrence of each tag, in the order of seq_index.
+      _, first_indices = numpy.unique(all_seq_tags[seq_index], return_index=True)
+      seq_index = seq_index[numpy.sort(first_indices)]
     if partition_epoch > 1:
       seq_index = self._apply_partition_epoch(seq_index, partition_epoch, epoch)
     if repeat_epoch > 1:
-      seq_index = seq_index * repeat_epoch
+      seq_index = numpy.tile(seq_index, repeat_epoch)
     if self.seq_tags_filter is not None:
       # Note: This is as generic as possible, but requires that get_all_tags is implemented.
-      assert seq_index
+      assert len(seq_index) > 0
       all_seq_tags = self.get_all_tags()
       assert len(all_seq_tags) == num_seqs == self.get_total_num_seqs(), "%r vs %r vs %r" % (
         len(all_seq_tags), num_seqs, self.get_total_num_seqs())
       old_seq_index = seq_index
-      seq_index = [i for i in seq_index if all_seq_tags[i] in self.seq_tags_filter]
-      assert seq_index, "%s: empty after applying seq_list_filter_file. Example filter tags: %r, used tags: %r" % (
-        self, sorted(self.seq_tags_filter)[:3], [all_seq_tags[i] for i in old_seq_index[:3]])
+      all_seq_tags = numpy.array(all_seq_tags)
+      tags_mask = numpy.isin(all_seq_tags, numpy.array(sorted(self.seq_tags_filter)))
+      seq_index = seq_index[tags_mask[seq_index]]
+      assert len(seq_index) > 0, (
+        "%s: empty after applying seq_list_filter_file. Example filter tags: %r, used tags: %r" % (
+          self, sorted(self.seq_tags_filter)[:3], [all_seq_tags[i] for i in old_seq_index[:3]]))
     return seq_index
 
+  @staticmethod
+  def _shuffled_array(rnd, seq_index):
+    """
+    :param Random rnd:
+    :param numpy.ndarray seq_index:
+    :return: shuffled copy. we use the Python shuffle, to get exactly the same order as for a list
+    :rtype: numpy.ndarray
+    """
+    seq_index = seq_index.tolist()
+    rnd.shuffle(seq_index)
+    return numpy.array(seq_index, dtype="int64")
+
   @classmethod
   def _apply_partition_epoch(cls, seq_index, partition_epoch, epoch):
     """
-    :param list[int] seq_index: full list of ordered sequence indices
+    :param list[int]|numpy.ndarray seq_index: full list of ordered sequence indices
     :param int partition_epoch: number of partitions seq_index should be split into
     :param int|None epoch: current epoch
     :return: partition of seq_index for current epoch
-    :rtype: list[int]
+    :rtype: list[int]|numpy.ndarray
     """
     num_seqs = len(seq_index)
     current_partition = ((epoch or 1) - 1) % partition_epoch
@@ -894,20 +958,42 @@ class Dataset(object):
     :param numpy.ndarray data: 1D
     :rtype: str
     """
+    mode, table = self._get_serialize_data_lookup(key)
+    data = numpy.asarray(data)
+    if data.dtype.kind not in "iu":  # e.g. an empty list gives float64
+      data = data.astype("int32")
+    if mode == "bytes":
+      try:
+        return table[data].tobytes().decode("utf8")
+      except UnicodeDecodeError:
+        mode, table = "chars", numpy.array(self.labels[key], dtype=object)  # pass on to default case
+    if mode == "chars":
+      return "".join(table[data].tolist())
+    return " ".join(table[data].tolist())
+
+  def _get_serialize_data_lookup(self, key):
+    """
+    The labels are checked only once per key,
+    and converted into a lookup table such that :func:`serialize_data` is vectorized.
+
+    :param str key:
+    :return: mode ("bytes", "chars" or "words"), lookup table (label idx -> byte or label)
+    :rtype: (str, numpy.ndarray)
+    """
     labels = self.labels[key]
+    cached = self._serialize_data_lookups.get(key)
+    if cached and cached[0] is labels and cached[1] == len(labels):
+      return cached[2:]
     if len(labels) < 1000 and all([len(l) == 1 for l in labels]):
       # are these actually raw bytes? -> assume utf8
       if all([ord(l) <= 255 for l in labels]):
-        try:
-          if PY3:
-            return bytes([ord(labels[c]) for c in data]).decode("utf8")
-          else:
-            return b"".join([bytes(labels[c]) for c in data]).decode("utf8")
-        except UnicodeDecodeError:
-          pass  # pass on to default case
-      return "".join(map(labels.__getitem__, data))
+        mode, table = "bytes", numpy.array([ord(l) for l in labels], dtype="uint8")
+      else:
+        mode, table = "chars", numpy.array(labels, dtype=object)
     else:
-      return " ".join(map(labels.__getitem__, data))
+      mode, table = "words", numpy.array(labels, dtype=object)
+    self._serialize_data_lookups[key] = (labels, len(labels), mode, table)
+    return mode, table
 
   def calculate_priori(self, target="classes"):
     """
@@ -1031,7 +1117,7 @@ class Dataset(object):
                         max_pad_size=None,
                         min_seq_length=0, pruning=0.0,
                         seq_drop=0.0, max_total_num_seqs=-1,
-                        used_data_keys=None):
+                        used_data_keys=None, bucket_boundaries=None):
     """
     :param bool recurrent_net: If True, the batch might have a batch seq dimension > 1.
       Otherwise, the batch seq dimension is always 1 and multiple seqs will be concatenated.
@@ -1041,6 +1127,14 @@ class Dataset(object):
     :param int max_total_num_seqs:
     :param int|dict[str,int]|NumbersDict max_seq_length:
     :param set(str)|None used_data_keys:
+    :param list[int]|int|None bucket_boundaries: if given (only for recurrent_net), the seqs are put into buckets
+      by their length (max over all data keys), where bucket i contains the lengths <= bucket_boundaries[i],
+      and the last bucket all longer seqs. Each bucket collects its own pending batch,
+      and a batch is only emitted when it is full (or at the end).
+      This reduces the padding a lot, and it is still deterministic given the seq order.
+      If this is an int, so many buckets are derived from the length histogram (quantiles) of this epoch.
+      Note that the seq idx of the batches are not monotonic anymore, thus, like shuffle_batches,
+      this needs a dataset which can load any seqs (:func:`supports_random_access`), e.g. :class:`HDFDataset`.
     """
     if not batch_size:
       batch_size = sys.maxsize
@@ -1065,6 +1159,19 @@ class Dataset(object):
       if chunk_size != 0:
         print("Non-recurrent network, chunk size %s:%s ignored" % (chunk_size, chunk_step), file=log.v4)
         chunk_size = 0
+    if bucket_boundaries and not recurrent_net:
+      print("Non-recurrent network, bucket boundaries %r ignored" % (bucket_boundaries,), file=log.v4)
+      bucket_boundaries = None
+    if bucket_boundaries:
+      assert self.supports_random_access(), (
+        "%s: bucket_boundaries need a dataset which can load the seqs in any order, e.g. HDFDataset" % self)
+    if isinstance(bucket_boundaries, int):
+      bucket_boundaries = self._get_bucket_boundaries_from_histogram(
+        num_buckets=bucket_boundaries, chunk_size=chunk_size, chunk_step=chunk_step, used_data_keys=used_data_keys)
+    bucket_batches = [Batch() for _ in range(len(bucket_boundaries) + 1)] if bucket_boundaries else None
+    bucket_idx = None
+    total_frames = NumbersDict(0)
+    total_padded_frames = NumbersDict(0)
     batch = Batch()
     total_num_seqs = 0
     last_seq_idx = -1
@@ -1090,18 +1197,23 @@ class Dataset(object):
           print("warning: sequence length (%r) larger than limit (%r)" % (length, batch_size), file=log.v4)
         if self.rnd_seq_drop.random() < seq_drop:
           continue
+        if bucket_batches:
+          bucket_idx = bisect.bisect_left(bucket_boundaries, length.max_value())
+          batch = bucket_batches[bucket_idx]
         dt, ds = batch.try_sequence_as_slice(length)
         if batch.num_slices >= 1:
-          if (dt * ds).any_compare(batch_size, (lambda a, b: a > b)):
-            yield batch
-            batch = Batch()
-          elif ds > max_seqs:
-            yield batch
-            batch = Batch()
-          elif (dt * ds - batch.get_total_num_frames() - length).any_compare(max_pad_size, (lambda a, b: a > b)):
+          if (dt * ds).any_compare(batch_size, (lambda a, b: a > b)) or ds > max_seqs or (
+                max_pad_size.has_values() and (
+                  (dt * ds - batch.get_total_num_frames() - length).any_compare(
+                    max_pad_size, (lambda a, b: a > b)))):
+            if bucket_batches:
+              total_frames += batch.get_total_num_frames()
+              total_padded_frames += batch.get_all_slices_num_frames()
             yield batch
             batch = Batch()
         batch.add_sequence_as_slice(seq_idx=seq_idx, seq_start_frame=t_start, length=length)
+        if bucket_batches:
+          bucket_batches[bucket_idx] = batch
       else:  # Not recurrent.
         while t_start.max_value() < t_end.max_value():
           length = t_end - t_start
@@ -1118,8 +1230,90 @@ class Dataset(object):
         last_seq_idx = seq_idx
         total_num_seqs += 1
 
-    if batch.get_all_slices_num_frames().max_value() > 0:
-      yield batch
+    for batch in (bucket_batches or [batch]):
+      if batch.get_all_slices_num_frames().max_value() > 0:
+        if bucket_batches:
+          total_frames += batch.get_total_num_frames()
+          total_padded_frames += batch.get_all_slices_num_frames()
+        yield batch
+
+    if bucket_batches:
+      print("%s: bucketed batches (boundaries %r), padding ratio: %s" % (
+        self, bucket_boundaries, ", ".join([
+          "%s %.1f%%" % (key, 100. * (1. - float(total_frames[key]) / total_padded_frames[key]))
+          for key in sorted(total_padded_frames.keys()) if total_padded_frames[key]])), file=log.v4)
+
+  def _get_bucket_boundaries_from_histogram(self, num_buckets, chunk_size, chunk_step, used_data_keys):
+    """
+    :param int num_buckets:
+    :param int|NumbersDict chunk_size:
+    :param int|NumbersDict chunk_step:
+    :param set(str)|None used_data_keys:
+    :return: bucket boundaries for :func:`_generate_batches`, such that each bucket has about the same num of seqs
+    :rtype: list[int]
+    """
+    assert num_buckets >= 1
+    lens = None
+    if not chunk_size:
+      # Avoids another pass over all seqs, which might need to load them.
+      # Note that these are the lengths used for the seq ordering (e.g. of "data"), not the max over all data keys,
+      # and of the whole corpus, not just of this epoch, which is good enough for the quantiles.
+      lens = self.get_all_seq_lens()
+      if lens is not None:
+        ctx_total = self.ctx_left + self.ctx_right
+        if isinstance(ctx_total, NumbersDict):
+          ctx_total = max(list(ctx_total.values()) + [ctx_total.value or 0])
+        lens = lens + ctx_total
+    if lens is None:
+      lens = [
+        ((t_end + self.ctx_right) - (t_start - self.ctx_left)).max_value()
+        for (_, t_start, t_end) in self.iterate_seqs(
+          chunk_size=chunk_size, chunk_step=chunk_step, used_data_keys=used_data_keys)]
+    if len(lens) == 0:
+      return []
+    quantiles = numpy.percentile(lens, numpy.linspace(0., 100., num_buckets + 1)[1:-1])
+    return sorted(set([int(numpy.ceil(q)) for q in quantiles]))
+
+  def supports_random_access(self):
+    """
+    :return: whether :func:`load_seqs` can be called with seq idx ranges in any order.
+      Otherwise, the loaded seq idx must increase monotonically, as in the seq order of the epoch.
+    :rtype: bool
+    """
+    return False
+
+  def supports_sharding(self):
+    """
+    :return: whether :func:`set_shard` is supported,
+      i.e. whether :func:`init_seq_order` restricts the seq order to the shard
+    :rtype: bool
+    """
+    return False
+
+  def set_shard(self, shard_index, num_shards):
+    """
+    Restricts the dataset to every num_shards-th seq of the seq order of the epoch, starting with shard_index.
+    This is applied in the next :func:`init_seq_order`.
+    E.g. every worker process of the data provider has its own shard
+    (see :class:`TFDataPipeline.DataProviderWorkerPool`).
+
+    :param int shard_index:
+    :param int num_shards:
+    """
+    assert self.supports_sharding(), "%s does not support sharding" % self
+    assert 0 <= shard_index < num_shards
+    self._shard_index = shard_index
+    self._num_shards = num_shards
+
+  def _apply_shard(self, seq_order):
+    """
+    :param list[int]|numpy.ndarray seq_order: seq order of the epoch
+    :return: the part of the seq order of our shard (see :func:`set_shard`)
+    :rtype: list[int]|numpy.ndarray
+    """
+    if self._num_shards == 1:
+      return seq_order
+    return seq_order[self._shard_index::self._num_shards]
 
   def batch_set_generator_cache_whole_epoch(self):
     """
@@ -1136,17 +1330,61 @@ class Dataset(object):
     """
     return False
 
-  def generate_batches(self, shuffle_batches=False, **kwargs):
+  def get_batch_plan_cache_key(self):
+    """
+    For :class:`EngineBatch.BatchPlanCache`.
+    The batches generated by :func:`_generate_batches` only depend on the seq lengths (of all data keys)
+    in the current seq order (and on the batching options).
+    In many cases, the dataset cannot provide those efficiently without loading the seqs,
+    and then it does not make sense to use the cache.
+
+    :return: key which identifies the seq lengths in the current seq order, or None if not supported
+    :rtype: str|None
+    """
+    return None
+
+  def _generate_batches_cached(self, batch_plan_cache, **kwargs):
+    """
+    :param EngineBatch.BatchPlanCache batch_plan_cache:
+    :param kwargs: will be passed to :func:`_generate_batches`
+    :return: generator like :func:`_generate_batches`, but uses the cache
+    :rtype: typing.Generator[Batch]
+    """
+    key = batch_plan_cache.get_key(dataset=self, **kwargs)
+    if key is None:
+      for batch in self._generate_batches(**kwargs):
+        yield batch
+      return
+    batches = batch_plan_cache.load(key)
+    if batches is not None:
+      print("%s: Using cached batches from %s." % (self, batch_plan_cache.get_filename(key)), file=log.v4)
+      for batch in batches:
+        yield batch
+      return
+    batches = []
+    for batch in self._generate_batches(**kwargs):
+      batches.append(batch)
+      yield batch
+    # We only get here if the whole epoch was iterated through.
+    batch_plan_cache.save(key, batches)
+
+  def generate_batches(self, shuffle_batches=False, batch_plan_cache=None, **kwargs):
     """
     :param bool shuffle_batches:
+    :param EngineBatch.BatchPlanCache|None batch_plan_cache: persistent on-disk cache of the generated batches
     :param kwargs: will be passed to :func:`_generate_batches`
     :rtype: BatchSetGenerator
     """
+    if batch_plan_cache:
+      generator = self._generate_batches_cached(batch_plan_cache=batch_plan_cache, **kwargs)
+    else:
+      generator = self._generate_batches(**kwargs)
     return BatchSetGenerator(
       dataset=self,
-      generator=self._generate_batches(**kwargs),
+      generator=generator,
       shuffle_batches=shuffle_batches,
-      cache_whole_epoch=self.batch_set_generator_cache_whole_epoch())
+      cache_whole_epoch=self.batch_set_generator_cache_whole_epoch(),
+      generate_batches_kwargs=dict(shuffle_batches=shuffle_batches, **kwargs))
 
   @classmethod
   def index_shape_for_batches(cls, batches, data_key="data"):
@@ -1226,11 +1464,18 @@ def get_dataset_class(name):
   :rtype: type[Dataset]
   """
   from importlib import import_module
+  from Util import get_module_source_names
   # Only those modules which make sense to be loaded by the user,
   # because this function is only used for such cases.
   mod_names = [
     "HDFDataset", "SprintDataset", "GeneratingDataset", "NumpyDumpDataset",
     "MetaDataset", "LmDataset", "StereoDataset", "RawWavDataset"]
+  # Lazy: Import only the module which defines this class, if we find it in the source code.
+  mod_name = get_module_source_names(mod_names, r"^class (\w+)\(").get(name)
+  if mod_name:
+    clazz = getattr(import_module(mod_name), name)
+    assert issubclass(clazz, Dataset)
+    return clazz
   for mod_name in mod_names:
     mod = import_module(mod_name)
     if name in vars(mod):
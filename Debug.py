@@ -3,9 +3,14 @@
 Some generic debugging utilities.
 """
 
+from __future__ import print_function
+
 import os
 import sys
+import time
 import signal
+import contextlib
+import typing
 try:
   import thread
 except ImportError:
@@ -438,3 +443,105 @@ def debug_shell(user_ns=None, user_global_ns=None, exit_afterwards=True):
   if exit_afterwards:
     print("Debug shell exit. Exit now.")
     sys.exit(1)
+
+
+class StartupProfiler(object):
+  """
+  Measures the wall time of the startup phases (see :func:`rnn.init`)
+  and of all imports (in the main thread), until the first step.
+  This is enabled via ``rnn.py ... --profile_startup`` (or config option ``profile_startup``).
+  """
+
+  instance = None  # type: typing.Optional[StartupProfiler]
+
+  def __init__(self):
+    self.start_time = time.time()
+    self.phases = []  # type: typing.List[typing.Tuple[str,float]]  # (name, wall time)
+    self.import_self_times = {}  # type: typing.Dict[str,float]  # module name -> time, without sub-imports
+    self.import_total_times = {}  # type: typing.Dict[str,float]  # module name -> time, including sub-imports
+    self._import_stack = []  # type: typing.List[typing.List[float]]  # [sub-imports time] per active import
+    self._main_thread = threading.current_thread()
+    self._orig_import = None
+
+  @classmethod
+  def install(cls):
+    """
+    Creates the global instance (if not yet done) and hooks into the imports.
+
+    :rtype: StartupProfiler
+    """
+    if not cls.instance:
+      cls.instance = StartupProfiler()
+      cls.instance._install_import_hook()
+    return cls.instance
+
+  def _install_import_hook(self):
+    try:
+      import builtins
+    except ImportError:  # Python 2
+      import __builtin__ as builtins
+    self._orig_import = builtins.__import__
+    builtins.__import__ = self._import
+
+  def _uninstall_import_hook(self):
+    try:
+      import builtins
+    except ImportError:  # Python 2
+      import __builtin__ as builtins
+    if builtins.__import__ == self._import:
+      builtins.__import__ = self._orig_import
+
+  def _import(self, name, *args, **kwargs):
+    if name in sys.modules or threading.current_thread() is not self._main_thread:
+      return self._orig_import(name, *args, **kwargs)
+    start_time = time.time()
+    self._import_stack.append([0.0])
+    try:
+      return self._orig_import(name, *args, **kwargs)
+    finally:
+      sub_imports_time, = self._import_stack.pop()
+      total_time = time.time() - start_time
+      self.import_total_times[name] = self.import_total_times.get(name, 0.0) + total_time
+      self.import_self_times[name] = self.import_self_times.get(name, 0.0) + total_time - sub_imports_time
+      if self._import_stack:
+        self._import_stack[-1][0] += total_time
+
+  @classmethod
+  @contextlib.contextmanager
+  def phase(cls, name):
+    """
+    Measures the wall time of some startup phase, if the profiler is enabled.
+
+    :param str name:
+    """
+    if not cls.instance:
+      yield
+      return
+    start_time = time.time()
+    try:
+      yield
+    finally:
+      cls.instance.phases.append((name, time.time() - start_time))
+
+  @classmethod
+  def finish(cls, file=sys.stdout, num_imports=20):
+    """
+    Reports the startup time (if the profiler is enabled), and stops the profiling.
+    It is fine to call this multiple times (e.g. at the first step); only the first call reports.
+
+    :param typing.TextIO file:
+    :param int num_imports: how much of the slowest imports to report
+    """
+    self = cls.instance
+    if not self or not self._orig_import:
+      return
+    self._uninstall_import_hook()
+    self._orig_import = None
+    total_time = time.time() - self.start_time
+    print("Startup profile: %.3f sec until now." % total_time, file=file)
+    for name, dt in self.phases:
+      print("  phase %s: %.3f sec (%.1f%%)" % (name, dt, 100. * dt / total_time), file=file)
+    print("  imports: %.3f sec in total, slowest (self time, without sub-imports):" % sum(
+      self.import_self_times.values()), file=file)
+    for name, dt in sorted(self.import_self_times.items(), key=lambda item: -item[1])[:num_imports]:
+      print("    %s: %.3f sec (incl. sub-imports %.3f sec)" % (name, dt, self.import_total_times[name]), file=file)
@@ -4,9 +4,13 @@ Defines :class:`BatchSeqCopyPart` and other batch related helpers.
 This is shared across different backends.
 """
 
+from __future__ import print_function
+
+import os
 import random
 import typing
-from Util import NumbersDict
+import numpy
+from Util import NumbersDict, maybe_make_dirs
 
 
 class BatchSeqCopyPart:
@@ -164,6 +168,122 @@ class Batch:
     return self.end_seq - self.start_seq
 
 
+class BatchShapeStats:
+  """
+  Collects statistics about the shapes of the batches,
+  i.e. the number of seqs, the padded batch shape, and how many of the frames are real data vs. zero padding,
+  separately for each data key.
+  This is used by :class:`TFEngine.Runner` (via the info from :class:`TFDataPipeline.FeedDictDataProvider`)
+  and by ``tools/analyze-dataset-batches.py``, such that both report exactly the same numbers.
+  """
+
+  def __init__(self):
+    self.num_batches = 0
+    self.num_seqs = 0
+    self.max_num_seqs = 0
+    self.num_frames = NumbersDict()  # real frames, for each data key
+    self.num_padded_frames = NumbersDict()  # frames including the zero padding, for each data key
+    self.max_batch_shape = {}  # type: typing.Dict[str,typing.Tuple[int,int]]  # data key -> (slices, time)
+
+  @classmethod
+  def get_batch_info(cls, batch, data_keys):
+    """
+    This is intentionally only made of plain Python types
+    such that it can be sent around cheaply, e.g. from the data provider worker processes.
+
+    :param Batch batch:
+    :param list[str]|set[str] data_keys:
+    :return: dict with "num_seqs", "num_slices", and per data key "max_frames" (padded time) and "num_frames"
+    :rtype: dict[str,int|dict[str,int]]
+    """
+    num_frames = sum([seq.frame_length for seq in batch.seqs], NumbersDict(0))
+    return {
+      "num_seqs": len(batch.seqs),
+      "num_slices": batch.num_slices,
+      "max_frames": {k: int(batch.max_num_frames_per_slice.get(k, 0)) for k in sorted(data_keys)},
+      "num_frames": {k: int(num_frames.get(k, 0)) for k in sorted(data_keys)}}
+
+  @classmethod
+  def get_padding_ratio(cls, num_frames, num_padded_frames):
+    """
+    :param int num_frames:
+    :param int num_padded_frames:
+    :return: fraction of the padded frames which are zero padding
+    :rtype: float
+    """
+    if not num_padded_frames:
+      return 0.0
+    return 1.0 - float(num_frames) / num_padded_frames
+
+  def collect(self, batch_info):
+    """
+    :param dict[str,int|dict[str,int]] batch_info: via :func:`get_batch_info`
+    """
+    self.num_batches += 1
+    self.num_seqs += batch_info["num_seqs"]
+    self.max_num_seqs = max(self.max_num_seqs, batch_info["num_seqs"])
+    for k, max_frames in batch_info["max_frames"].items():
+      self.num_frames[k] = self.num_frames.dict.get(k, 0) + batch_info["num_frames"][k]
+      self.num_padded_frames[k] = self.num_padded_frames.dict.get(k, 0) + max_frames * batch_info["num_slices"]
+      shape = (batch_info["num_slices"], max_frames)
+      if k not in self.max_batch_shape or shape[0] * shape[1] > numpy.prod(self.max_batch_shape[k]):
+        self.max_batch_shape[k] = shape
+
+  def collect_batch(self, batch, data_keys):
+    """
+    :param Batch batch:
+    :param list[str]|set[str] data_keys:
+    :return: the batch info, via :func:`get_batch_info`
+    :rtype: dict[str,int|dict[str,int]]
+    """
+    batch_info = self.get_batch_info(batch, data_keys=data_keys)
+    self.collect(batch_info)
+    return batch_info
+
+  @classmethod
+  def get_batch_summary_values(cls, batch_info):
+    """
+    :param dict[str,int|dict[str,int]] batch_info: via :func:`get_batch_info`
+    :return: list of (tag, value), e.g. for the TF summary writer
+    :rtype: list[(str,float)]
+    """
+    values = [("batch_stats/num_seqs", batch_info["num_seqs"])]
+    for k, max_frames in sorted(batch_info["max_frames"].items()):
+      num_padded_frames = max_frames * batch_info["num_slices"]
+      values += [
+        ("batch_stats/%s/num_frames" % k, batch_info["num_frames"][k]),
+        ("batch_stats/%s/num_padded_frames" % k, num_padded_frames),
+        ("batch_stats/%s/max_time" % k, max_frames),
+        ("batch_stats/%s/padding_ratio" % k, cls.get_padding_ratio(batch_info["num_frames"][k], num_padded_frames))]
+    return values
+
+  def get_padding_ratios(self):
+    """
+    :return: data key -> fraction of zero padding over all collected batches
+    :rtype: dict[str,float]
+    """
+    return {
+      k: self.get_padding_ratio(self.num_frames[k], self.num_padded_frames[k])
+      for k in sorted(self.num_padded_frames.dict.keys())}
+
+  def dump(self, stream, stream_prefix=""):
+    """
+    :param io.TextIOBase|typing.TextIO|Log.Stream stream:
+    :param str stream_prefix:
+    """
+    if not self.num_batches:
+      print("%sno batches" % stream_prefix, file=stream)
+      return
+    print("%snum batches %i, num seqs %i (avg %.1f, max %i per batch)" % (
+      stream_prefix, self.num_batches, self.num_seqs, float(self.num_seqs) / self.num_batches, self.max_num_seqs),
+      file=stream)
+    padding_ratios = self.get_padding_ratios()
+    for k in sorted(self.num_padded_frames.dict.keys()):
+      print("%sdata key %r: num frames %i, padded %i, padding %.1f%%, max batch shape (slices,time) %r" % (
+        stream_prefix, k, self.num_frames[k], self.num_padded_frames[k], padding_ratios[k] * 100.,
+        self.max_batch_shape[k]), file=stream)
+
+
 class BatchSetGenerator:
   """
   This will give you the next batches (list[Batch]) such that you can use them for assign_dev_data().
@@ -173,16 +293,20 @@ class BatchSetGenerator:
   you call self.advance() explicitly to go forward to next batches.
   """
 
-  def __init__(self, dataset, generator, shuffle_batches=False, cache_whole_epoch=True):
+  def __init__(self, dataset, generator, shuffle_batches=False, cache_whole_epoch=True, generate_batches_kwargs=None):
     """
     :type dataset: Dataset.Dataset
     :type generator: typing.Generator[Batch]|typing.Iterator[Batch]
     :param bool shuffle_batches:
     :param bool cache_whole_epoch:
+    :param dict[str]|None generate_batches_kwargs: if created via :func:`Dataset.generate_batches`,
+      the options (except the batch plan cache), such that the batches can be generated again,
+      e.g. for a shard of the dataset (see :func:`Dataset.set_shard`)
     """
     self.dataset = dataset
     self.generator = generator
     self.shuffle_batches = shuffle_batches
+    self.generate_batches_kwargs = generate_batches_kwargs
     # In some cases, it might be faster to cache the list of batches.
     self.cache_whole_epoch = cache_whole_epoch
     self.cache = []  # type: typing.List[Batch]
@@ -279,3 +403,268 @@ class BatchSetGenerator:
     :rtype: int
     """
     return self.current_batch_idx
+
+  def read_all(self):
+    """
+    Reads all remaining batches from the generator, i.e. this gives you the whole remaining batch plan.
+    This does not advance, i.e. you can still iterate through the batches afterwards.
+
+    :return: all remaining batches
+    :rtype: list[Batch]
+    """
+    while self._read_next():
+      pass
+    return list(self.buffer)
+
+
+def get_batch_cost(batch):
+  """
+  :param Batch batch:
+  :return: estimated computation cost of the batch, i.e. padded frames (max frames of any data key) x num slices
+  :rtype: int
+  """
+  return batch.max_num_frames_per_slice.max_value() * batch.num_slices
+
+
+def assign_batches_by_cost(batches, num_ranks):
+  """
+  Assigns the batches to the ranks (e.g. Horovod instances), such that each rank gets the same number of batches,
+  and the costs (see :func:`get_batch_cost`) are balanced.
+  All ranks run in lockstep (one batch per rank per step),
+  thus we group batches of similar cost into the same step (such that no rank needs to wait much for the others),
+  and within a step, the most expensive batch goes to the rank with the lowest total cost so far.
+  The steps are ordered by the first batch of the step in the original batch order.
+  If the number of batches is not a multiple of num_ranks, the remaining cheapest batches are not assigned.
+
+  Note that the batches of one rank are not in increasing seq order anymore,
+  thus the dataset needs to support random access (like with ``shuffle_batches``).
+
+  :param list[Batch] batches: the whole batch plan. the order is the same for all ranks
+  :param int num_ranks:
+  :return: for each rank, the list of batch indices (indices into batches), in step order
+  :rtype: list[list[int]]
+  """
+  import heapq
+  assert num_ranks >= 1
+  costs = [get_batch_cost(batch) for batch in batches]
+  by_cost = sorted(range(len(batches)), key=lambda i: (-costs[i], i))
+  num_steps = len(batches) // num_ranks
+  steps = [by_cost[i * num_ranks:(i + 1) * num_ranks] for i in range(num_steps)]
+  steps.sort(key=min)
+  rank_costs = [(0, rank) for rank in range(num_ranks)]  # heap
+  assignment = [[] for _ in range(num_ranks)]  # type: typing.List[typing.List[int]]
+  for step_batch_idxs in steps:
+    popped = [heapq.heappop(rank_costs) for _ in range(num_ranks)]  # lowest total cost first
+    for (total, rank), batch_idx in zip(popped, step_batch_idxs):  # step_batch_idxs is sorted by cost, descending
+      assignment[rank].append(batch_idx)
+      heapq.heappush(rank_costs, (total + costs[batch_idx], rank))
+  return assignment
+
+
+def get_ranks_utilization(batches, assignment):
+  """
+  The ranks run in lockstep, thus each step takes as long as the most expensive batch of the step.
+  The utilization of a rank is its own cost relative to that.
+
+  :param list[Batch] batches:
+  :param list[list[int]] assignment: for each rank, list of batch indices, in step order.
+    e.g. via :func:`assign_batches_by_cost`
+  :return: for each rank, the utilization in [0,1]
+  :rtype: list[float]
+  """
+  num_steps = min([len(batch_idxs) for batch_idxs in assignment])
+  costs = [[get_batch_cost(batches[i]) for i in batch_idxs[:num_steps]] for batch_idxs in assignment]
+  total = sum([max([rank_costs[step] for rank_costs in costs]) for step in range(num_steps)])
+  if not total:
+    return [0.0 for _ in assignment]
+  return [float(sum(rank_costs)) / total for rank_costs in costs]
+
+
+class BatchPlanCache:
+  """
+  Persistent on-disk cache of the batches (i.e. the plans, list of :class:`Batch`)
+  generated by :func:`Dataset.Dataset._generate_batches`.
+  This can be reused across restarts, or e.g. for repeated evaluations on the same dev set.
+
+  The key is determined by :func:`Dataset.Dataset.get_batch_plan_cache_key`
+  (which covers the seq lengths in the current seq order), the dataset chunking options,
+  and the batching options (batch_size, max_seqs, max_seq_length, etc).
+  Each plan is stored as a compact numpy ``.npz`` file in the cache directory.
+  """
+
+  version = 1
+
+  def __init__(self, cache_dir):
+    """
+    :param str cache_dir:
+    """
+    self.cache_dir = cache_dir
+    maybe_make_dirs(cache_dir)
+
+  def get_key(self, dataset, **kwargs):
+    """
+    :param Dataset.Dataset dataset:
+    :param kwargs: options for :func:`Dataset.Dataset._generate_batches`
+    :return: key, or None if we cannot cache the batches
+    :rtype: str|None
+    """
+    if kwargs.get("seq_drop", 0.0) > 0 or dataset.weights or dataset.chunking_variance > 0:
+      return None  # not deterministic
+    dataset_key = dataset.get_batch_plan_cache_key()
+    if dataset_key is None:
+      return None
+    import hashlib
+    opts = {
+      "version": self.version, "dataset_class": dataset.__class__.__name__, "dataset_key": dataset_key,
+      "chunk_size": dataset.chunk_size, "chunk_step": dataset.chunk_step,
+      "ctx_left": dataset.ctx_left, "ctx_right": dataset.ctx_right, "min_chunk_size": dataset.min_chunk_size}
+    opts.update(kwargs)
+    return hashlib.sha1(self._canonical_repr(opts).encode("utf8")).hexdigest()
+
+  @classmethod
+  def _canonical_repr(cls, obj):
+    """
+    :param object obj: dict, list, NumbersDict, or some primitive value
+    :return: repr which does not depend on dict ordering
+    :rtype: str
+    """
+    if isinstance(obj, NumbersDict):
+      return "NumbersDict(%s, %s)" % (cls._canonical_repr(obj.value), cls._canonical_repr(obj.dict))
+    if isinstance(obj, dict):
+      return "{%s}" % ", ".join(["%r: %s" % (k, cls._canonical_repr(v)) for (k, v) in sorted(obj.items())])
+    if isinstance(obj, (set, frozenset)):
+      return "{%s}" % ", ".join(sorted([cls._canonical_repr(v) for v in obj]))
+    if isinstance(obj, (list, tuple)):
+      return "[%s]" % ", ".join([cls._canonical_repr(v) for v in obj])
+    return repr(obj)
+
+  def get_filename(self, key):
+    """
+    :param str key:
+    :rtype: str
+    """
+    return os.path.join(self.cache_dir, "batches-%s.npz" % key)
+
+  def load(self, key):
+    """
+    :param str key: via :func:`get_key`
+    :return: list of batches, or None if not cached
+    :rtype: list[Batch]|None
+    """
+    filename = self.get_filename(key)
+    if not os.path.exists(filename):
+      return None
+    with numpy.load(filename) as arrays:
+      return self.batches_from_arrays(dict(arrays))
+
+  def save(self, key, batches):
+    """
+    :param str key: via :func:`get_key`
+    :param list[Batch] batches:
+    """
+    import tempfile
+    filename = self.get_filename(key)
+    # Write to some temp file first and then rename, such that other processes never see an incomplete file.
+    fd, tmp_filename = tempfile.mkstemp(prefix="batches-", suffix=".npz.tmp", dir=self.cache_dir)
+    try:
+      with os.fdopen(fd, "wb") as f:
+        numpy.savez(f, **self.batches_to_arrays(batches))
+      os.rename(tmp_filename, filename)
+    except BaseException:
+      os.remove(tmp_filename)
+      raise
+
+  @classmethod
+  def _numbers_dicts_to_array(cls, numbers_dicts, keys):
+    """
+    :param list[NumbersDict] numbers_dicts:
+    :param list[str] keys:
+    :return: values, mask, both of shape (len(numbers_dicts), 1 + len(keys)). first column is the broadcast value.
+    :rtype: (numpy.ndarray,numpy.ndarray)
+    """
+    values = numpy.zeros((len(numbers_dicts), 1 + len(keys)), dtype="int64")
+    mask = numpy.zeros((len(numbers_dicts), 1 + len(keys)), dtype="bool")
+    key_idxs = {k: i + 1 for (i, k) in enumerate(keys)}
+    for i, d in enumerate(numbers_dicts):
+      if d.value is not None:
+        values[i, 0] = d.value
+        mask[i, 0] = True
+      for k, v in d.dict.items():
+        values[i, key_idxs[k]] = v
+        mask[i, key_idxs[k]] = True
+    return values, mask
+
+  @classmethod
+  def _numbers_dict_from_array(cls, values, mask, keys):
+    """
+    :param list[int] values: (1 + len(keys),)
+    :param list[bool] mask: (1 + len(keys),)
+    :param list[str] keys:
+    :rtype: NumbersDict
+    """
+    return NumbersDict(
+      broadcast_value=values[0] if mask[0] else None,
+      numbers_dict={k: values[i + 1] for (i, k) in enumerate(keys) if mask[i + 1]})
+
+  @classmethod
+  def batches_to_arrays(cls, batches):
+    """
+    :param list[Batch] batches:
+    :return: dict of numpy arrays, which can be stored via numpy.savez
+    :rtype: dict[str,numpy.ndarray]
+    """
+    parts = [part for batch in batches for part in batch.seqs]
+    keys = set()
+    for batch in batches:
+      keys.update(batch.max_num_frames_per_slice.keys())
+    for part in parts:
+      keys.update(part.seq_start_frame.keys())
+      keys.update(part.seq_end_frame.keys())
+      keys.update(part.batch_frame_offset.keys())
+    keys = sorted(keys)
+    batch_max_frames, batch_max_frames_mask = cls._numbers_dicts_to_array(
+      [batch.max_num_frames_per_slice for batch in batches], keys=keys)
+    part_frames, part_frames_mask = cls._numbers_dicts_to_array(
+      [d for part in parts for d in (part.seq_start_frame, part.seq_end_frame, part.batch_frame_offset)], keys=keys)
+    return {
+      "keys": numpy.array(keys, dtype="U"),
+      "batch_num_slices": numpy.array([batch.num_slices for batch in batches], dtype="int64"),
+      "batch_num_parts": numpy.array([len(batch.seqs) for batch in batches], dtype="int64"),
+      "batch_max_frames": batch_max_frames, "batch_max_frames_mask": batch_max_frames_mask,
+      "part_seq_idx": numpy.array([part.seq_idx for part in parts], dtype="int64"),
+      "part_batch_slice": numpy.array([part.batch_slice for part in parts], dtype="int64"),
+      "part_frames": part_frames.reshape((len(parts), 3, 1 + len(keys))),
+      "part_frames_mask": part_frames_mask.reshape((len(parts), 3, 1 + len(keys)))}
+
+  @classmethod
+  def batches_from_arrays(cls, arrays):
+    """
+    :param dict[str,numpy.ndarray] arrays: via :func:`batches_to_arrays`
+    :rtype: list[Batch]
+    """
+    keys = [str(k) for k in arrays["keys"]]
+    # Convert to Python lists once, which is much faster for the element-wise access below.
+    part_seq_idx = arrays["part_seq_idx"].tolist()
+    part_batch_slice = arrays["part_batch_slice"].tolist()
+    part_frames = arrays["part_frames"].tolist()
+    part_frames_mask = arrays["part_frames_mask"].tolist()
+    batch_max_frames = arrays["batch_max_frames"].tolist()
+    batch_max_frames_mask = arrays["batch_max_frames_mask"].tolist()
+    batches = []
+    part_start = 0
+    for b, (num_slices, num_parts) in enumerate(
+          zip(arrays["batch_num_slices"].tolist(), arrays["batch_num_parts"].tolist())):
+      batch = Batch()
+      batch.num_slices = num_slices
+      batch.max_num_frames_per_slice = cls._numbers_dict_from_array(
+        batch_max_frames[b], batch_max_frames_mask[b], keys=keys)
+      for p in range(part_start, part_start + num_parts):
+        start, end, offset = [
+          cls._numbers_dict_from_array(values, mask, keys=keys)
+          for (values, mask) in zip(part_frames[p], part_frames_mask[p])]
+        batch.seqs.append(BatchSeqCopyPart(
+          seq_idx=part_seq_idx[p], seq_start_frame=start, seq_end_frame=end,
+          batch_slice=part_batch_slice[p], batch_frame_offset=offset))
+      part_start += num_parts
+      batches.append(batch)
+    return batches
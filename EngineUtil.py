@@ -1,12 +1,15 @@
 
 """
-Contains utility functions to construct a batch.
+Contains utility functions to construct a batch,
+and to write the search outputs.
 This is used both by Theano and TF.
 """
 
 from __future__ import print_function
 
+import typing
 import numpy
+from functools import partial
 from EngineBatch import Batch
 from Log import log
 
@@ -124,3 +127,186 @@ def maybe_subtract_priors(network, train, config):
     b_softmax = ls[0]
     b_softmax.set_value(b_softmax.get_value() - prior_scale * numpy.log(priors))
     print("subtracting priors with prior_scale", prior_scale, file=log.v3)
+
+
+class SearchOutputWriter:
+  """
+  Writes the search outputs (see :func:`TFEngine.Engine.search`) incrementally to a file.
+  Finished seqs are kept only until all seqs before them (in the write order) are finished,
+  and are then written and flushed right away.
+  This also allows to resume a search after a crash, by skipping the seqs which were already written.
+
+  Formats:
+
+    * "txt": one line per seq, in the order of the corpus
+    * "py": a Python dict seq tag -> output, using :func:`Util.better_repr`
+  """
+
+  def __init__(self, filename, output_format="txt", resume=False):
+    """
+    :param str filename:
+    :param str output_format: "txt" or "py"
+    :param bool resume: if the file exists, keep the complete entries, and continue after them
+    """
+    import os
+    assert output_format in {"txt", "py"}, "invalid output_file_format %r" % output_format
+    self.filename = filename
+    self.output_format = output_format
+    self.done_seq_tags = None  # type: typing.Optional[typing.Set[str]]
+    self.num_done = 0
+    self.num_skip_first = 0
+    if resume and os.path.exists(filename):
+      content, self.num_done, done_seq_tags = self._read_complete_entries(filename, output_format)
+      if done_seq_tags is not None:
+        self.done_seq_tags = set(done_seq_tags)
+      print("Resume search output file %r with %i existing seqs." % (filename, self.num_done), file=log.v2)
+      self.file = open(filename, "w")
+      self.file.write(content)
+    else:
+      assert not os.path.exists(filename), "search output file %r already exists" % filename
+      self.file = open(filename, "w")
+      if output_format == "py":
+        self.file.write("{\n")
+    self.file.flush()
+    self.num_written = 0
+    self._order = None  # type: typing.Optional[typing.Iterator]
+    self._next_key = None
+    self._pending = {}  # key -> (seq tag, output)
+
+  @classmethod
+  def _read_complete_entries(cls, filename, output_format):
+    """
+    :param str filename:
+    :param str output_format:
+    :return: content up to the last complete entry, number of complete entries, seq tags (only for "py")
+    :rtype: (str, int, list[str]|None)
+    """
+    content = open(filename).read()
+    if output_format == "txt":
+      content = content[:content.rfind("\n") + 1]  # drop the incomplete last line
+      return content, content.count("\n"), None
+    seq_tags, end = cls._parse_py_entries(content)
+    if end is None:  # not even the "{" was written
+      return "{\n", 0, []
+    return content[:end], len(seq_tags), seq_tags
+
+  @staticmethod
+  def _parse_py_entries(content):
+    """
+    Parses a (maybe incomplete) file in "py" format, where each entry ends with ",\\n".
+
+    :param str content:
+    :return: seq tags of the complete entries, content length up to the end of the last complete entry or None
+    :rtype: (list[str], int|None)
+    """
+    import ast
+    import tokenize
+    lines = content.splitlines(True)
+    line_offsets = numpy.cumsum([0] + [len(line) for line in lines])
+    seq_tags = []
+    seq_tag = None
+    end = None
+    depth = 0
+    try:
+      for tok_type, tok_str, _, (end_row, _), _ in tokenize.generate_tokens(partial(next, iter(lines), "")):
+        if tok_type != tokenize.OP:
+          if depth == 1 and tok_type == tokenize.STRING and seq_tag is None:
+            seq_tag = ast.literal_eval(tok_str)
+          continue
+        if tok_str in "([{":
+          depth += 1
+          if depth == 1 and end is None:
+            end = int(line_offsets[end_row])
+        elif tok_str in ")]}":
+          depth -= 1
+        elif depth == 1 and tok_str == ",":
+          assert seq_tag is not None, "unexpected py search output format"
+          seq_tags.append(seq_tag)
+          seq_tag = None
+          end = int(line_offsets[end_row])
+    except tokenize.TokenError:
+      pass  # incomplete file
+    return seq_tags, end
+
+  def get_done_seq_tags(self, dataset):
+    """
+    :param Dataset.Dataset dataset:
+    :return: seq tags which are already written, or None if unknown
+    :rtype: set[str]|None
+    """
+    if self.done_seq_tags is None and self.num_done > 0:
+      # "txt" format: the lines are in the order of the corpus, restricted to the seq tags filter (if any).
+      try:
+        all_tags = dataset.get_all_tags()
+      except NotImplementedError:
+        all_tags = None
+      if all_tags is not None:
+        if dataset.seq_tags_filter is not None:
+          all_tags = [tag for tag in all_tags if tag in dataset.seq_tags_filter]
+        self.done_seq_tags = set(all_tags[:self.num_done])
+      else:
+        print("Dataset %r does not provide all seq tags, will skip the first %i seqs." % (dataset, self.num_done),
+              file=log.v2)
+        self.num_skip_first = self.num_done
+    return self.done_seq_tags
+
+  def set_order(self, keys):
+    """
+    :param list[int]|None keys: in which order to write the seqs (e.g. sorted corpus seq idx).
+      None means 0, 1, 2, ..., i.e. the seq idx.
+    """
+    assert not self._pending and self._next_key is None
+    self._order = iter(keys) if keys is not None else None
+
+  def _advance(self):
+    if self._order is None:
+      self._next_key = (self._next_key + 1) if self._next_key is not None else 0
+    else:
+      self._next_key = next(self._order, None)
+
+  def write(self, key, seq_tag, output):
+    """
+    :param int key: position in the write order (see :func:`set_order`)
+    :param str seq_tag:
+    :param str|list[(float,str)]|dict[str] output:
+    """
+    if self._next_key is None:
+      self._advance()
+    assert key not in self._pending, "seq %r (key %r) was already given" % (seq_tag, key)
+    self._pending[key] = (seq_tag, output)
+    while self._next_key in self._pending:
+      self._write_entry(*self._pending.pop(self._next_key))
+      self._advance()
+    self.file.flush()
+
+  def _write_entry(self, seq_tag, output):
+    """
+    :param str seq_tag:
+    :param str|list[(float,str)]|dict[str] output:
+    """
+    if self.num_skip_first > 0:
+      self.num_skip_first -= 1
+      return
+    if self.done_seq_tags is not None and seq_tag in self.done_seq_tags:
+      return
+    if self.output_format == "txt":
+      self.file.write("%s\n" % output)
+    else:
+      from Util import better_repr
+      self.file.write("%r: %s,\n" % (seq_tag, better_repr(output)))
+    self.num_written += 1
+
+  def close(self):
+    """
+    Writes any remaining seqs, and finishes the file.
+    """
+    if self._pending:
+      print("WARNING: search output: %i seqs are out of order, e.g. waiting for %r, got %r." % (
+        len(self._pending), self._next_key, sorted(self._pending.keys())[:3]), file=log.v2)
+      for key in sorted(self._pending.keys()):
+        self._write_entry(*self._pending.pop(key))
+    if self.output_format == "py":
+      self.file.write("}\n")
+    self.file.close()
+    print("Wrote %i seqs to search output file %r (%i existing before)." % (
+      self.num_written, self.filename, self.num_done), file=log.v2)
@@ -10,6 +10,7 @@ from CachedDataset2 import CachedDataset2
 from Util import class_idx_seq_to_1_of_k, CollectionReadCheckCovered, PY3
 from Log import log
 import numpy
+import os
 import re
 import sys
 import typing
@@ -1013,6 +1014,16 @@ class ExtractAudioFeatures:
       return ParseOggVorbisLib.get_instance().get_features_from_raw_bytes(
         raw_bytes=raw_bytes.getvalue(), output_dim=self.num_feature_filters, **(self.raw_ogg_opts or {}))
 
+    audio, sample_rate = self.read_audio_from_raw_bytes(raw_bytes)
+    return self.get_audio_features(audio=audio, sample_rate=sample_rate, seq_name=seq_name)
+
+  @staticmethod
+  def read_audio_from_raw_bytes(raw_bytes):
+    """
+    :param io.BytesIO raw_bytes:
+    :return: (audio, sample_rate), audio of shape (audio_len,)
+    :rtype: (numpy.ndarray, int)
+    """
     # Don't use librosa.load which internally uses audioread which would use Gstreamer as a backend,
     # which has multiple issues:
     # https://github.com/beetbox/audioread/issues/62
@@ -1024,7 +1035,55 @@ class ExtractAudioFeatures:
     import soundfile  # pip install pysoundfile
     # integer audio formats are automatically transformed in the range [-1,1]
     audio, sample_rate = soundfile.read(raw_bytes)
-    return self.get_audio_features(audio=audio, sample_rate=sample_rate, seq_name=seq_name)
+    return audio, sample_rate
+
+  def is_deterministic(self):
+    """
+    :return: whether the features only depend on the audio, i.e. there is no random augmentation.
+      Then the features can be extracted in any order, and can be cached.
+    :rtype: bool
+    """
+    if self.features == "raw_ogg":
+      return True
+    if self.random_permute_opts and self.random_permute_opts.truth_value:
+      return False
+    if self.pre_process or callable(self.features):  # these get the random_state
+      return False
+    return True
+
+  def get_cache_key(self):
+    """
+    Custom functions (e.g. ``post_process``) are identified by their source code
+    (or their code object, if the source is not available),
+    thus a changed function gives a new key.
+
+    :return: hash over all the options which influence the features, e.g. for a feature cache
+    :rtype: str
+    """
+    import hashlib
+    import inspect
+
+    def _repr(obj):
+      if callable(obj):
+        try:
+          code = inspect.getsource(obj)
+        except (OSError, TypeError):  # e.g. defined in an exec'd config, or a builtin
+          code = None
+          if hasattr(obj, "__code__"):
+            import marshal
+            code = hashlib.sha1(marshal.dumps(obj.__code__)).hexdigest()  # covers the consts and names
+        return "%s.%s(%s)" % (getattr(obj, "__module__", None), getattr(obj, "__name__", None), code)
+      if isinstance(obj, numpy.ndarray):
+        return repr(obj.tolist())
+      if isinstance(obj, dict):
+        return "{%s}" % ", ".join(["%r: %s" % (k, _repr(v)) for (k, v) in sorted(obj.items())])
+      return repr(obj)
+
+    opts = [
+      self.window_len, self.step_len, self.num_feature_filters, self.with_delta, self.norm_mean, self.norm_std_dev,
+      self.features, self.feature_options, self.raw_ogg_opts, self.post_process, self.sample_rate,
+      self.peak_normalization, self.preemphasis, self.join_frames]
+    return hashlib.sha1(", ".join([_repr(v) for v in opts]).encode("utf8")).hexdigest()[:16]
 
   def get_audio_features(self, audio, sample_rate, seq_name=None):
     """
@@ -2599,6 +2658,8 @@ class OggZipDataset(CachedDataset2):
                use_cache_manager=False,
                fixed_random_seed=None, fixed_random_subset=None,
                epoch_wise_filter=None,
+               num_feature_workers=0, num_prefetch_seqs=None,
+               feature_cache_dir=None,
                **kwargs):
     """
     :param str path: filename to zip
@@ -2612,6 +2673,15 @@ class OggZipDataset(CachedDataset2):
       If given, will use this random subset. This will be applied initially at loading time,
       i.e. not dependent on the epoch. It will use an internally hardcoded fixed random seed, i.e. it's deterministic.
     :param dict|None epoch_wise_filter: see init_seq_order
+    :param int num_feature_workers: if >0, this number of threads reads and decodes the audio files
+      of the upcoming seqs in the current seq order, and also extracts the features, if that is deterministic
+      (see :func:`ExtractAudioFeatures.is_deterministic`).
+      Otherwise the feature extraction (with random augmentation) still happens in order in the main thread.
+    :param int|None num_prefetch_seqs: how many seqs to prefetch with the workers. 2 * num_feature_workers by default
+    :param str|None feature_cache_dir: if given, stores the extracted features of each seq in this directory,
+      keyed by the zip member name, its CRC, and the feature options (:func:`ExtractAudioFeatures.get_cache_key`),
+      such that later epochs (or runs) do not need to decode the audio anymore.
+      Ignored if the feature extraction uses random augmentation.
     """
     import os
     import zipfile
@@ -2631,6 +2701,7 @@ class OggZipDataset(CachedDataset2):
       if use_cache_manager:
         self.paths = [Util.cf(path) for path in self.paths]
       self._zip_files = [zipfile.ZipFile(path) for path in self.paths]
+    self._zip_files_pid = os.getpid()  # after a fork, we must open them again, as the file position is shared
     kwargs.setdefault("name", self._names[0])
     super(OggZipDataset, self).__init__(**kwargs)
     self.targets = Vocabulary.create_vocab(**targets) if targets is not None else None
@@ -2657,6 +2728,17 @@ class OggZipDataset(CachedDataset2):
     if fixed_random_subset:
       self._filter_fixed_random_subset(fixed_random_subset)
     self.epoch_wise_filter = EpochWiseFilter(epoch_wise_filter) if epoch_wise_filter else None
+    self._num_feature_workers = num_feature_workers
+    self._num_prefetch_seqs = max(num_prefetch_seqs or 2 * num_feature_workers, 1)
+    self._feature_worker_pool = None  # created lazily
+    self._prefetched_features = {}  # seq_idx -> multiprocessing.pool.AsyncResult
+    self._feature_cache_dir = None  # type: typing.Optional[str]
+    if feature_cache_dir and self.feature_extractor:
+      if self.feature_extractor.is_deterministic():
+        self._feature_cache_dir = "%s/%s" % (feature_cache_dir, self.feature_extractor.get_cache_key())
+        Util.maybe_make_dirs(self._feature_cache_dir)
+      else:
+        print("%s: feature_cache_dir is ignored because of random augmentation." % self, file=log.v3)
     self._seq_order = None  # type: typing.Optional[typing.List[int]]
     self.init_seq_order()
 
@@ -2667,6 +2749,10 @@ class OggZipDataset(CachedDataset2):
     :rtype: bytes
     """
     if self._zip_files is not None:
+      if self._zip_files_pid != os.getpid():
+        import zipfile
+        self._zip_files = [zipfile.ZipFile(path) for path in self.paths]
+        self._zip_files_pid = os.getpid()
       return self._zip_files[zip_index].read(filename)
     return open("%s/%s" % (self.paths[0], filename), "rb").read()
 
@@ -2733,6 +2819,7 @@ class OggZipDataset(CachedDataset2):
     :returns whether the order changed (True is always safe to return)
     """
     super(OggZipDataset, self).init_seq_order(epoch=epoch, seq_list=seq_list)
+    self._prefetched_features.clear()  # seq idx refer to the old seq order
     if not epoch:
       epoch = 1
     self._audio_random.seed(self._fixed_random_seed or self._get_random_seed_for_epoch(epoch=epoch))
@@ -2761,9 +2848,18 @@ class OggZipDataset(CachedDataset2):
         self.epoch_wise_filter.debug_msg_prefix = str(self)
         self._seq_order = self.epoch_wise_filter.filter(epoch=epoch, seq_order=self._seq_order, get_seq_len=get_seq_len)
       self._num_seqs = len(self._seq_order)
+    if self._num_shards > 1:
+      self._seq_order = self._apply_shard(self._seq_order)
+      self._num_seqs = len(self._seq_order)
 
     return True
 
+  def supports_sharding(self):
+    """
+    :rtype: bool
+    """
+    return True
+
   def get_current_seq_order(self):
     """
     :rtype: list[int]
@@ -2836,17 +2932,129 @@ class OggZipDataset(CachedDataset2):
       targets_seq = []
     return targets_seq, raw_targets_txt
 
+  def _get_audio_filename(self, ref_seq_idx):
+    """
+    :param int ref_seq_idx:
+    :return: filename in zip-file
+    :rtype: str
+    """
+    seq = self._data[ref_seq_idx]
+    return "%s/%s" % (self._names[seq['_zip_file_index']], seq["file"])
+
   def _open_audio_file(self, seq_idx):
     """
     :param int seq_idx:
     :return: io.FileIO
     """
     import io
-    seq = self._data[self._get_ref_seq_idx(seq_idx)]
-    audio_fn = "%s/%s" % (self._names[seq['_zip_file_index']], seq["file"])
-    raw_bytes = self._read(audio_fn, seq['_zip_file_index'])
+    ref_seq_idx = self._get_ref_seq_idx(seq_idx)
+    raw_bytes = self._read(self._get_audio_filename(ref_seq_idx), self._data[ref_seq_idx]['_zip_file_index'])
     return io.BytesIO(raw_bytes)
 
+  def _get_feature_cache_filename(self, ref_seq_idx):
+    """
+    :param int ref_seq_idx:
+    :rtype: str
+    """
+    import hashlib
+    filename = self._get_audio_filename(ref_seq_idx)
+    zip_index = self._data[ref_seq_idx]['_zip_file_index']
+    if self._zip_files is not None:
+      checksum = self._zip_files[zip_index].getinfo(filename).CRC
+    else:
+      st = os.stat("%s/%s" % (self.paths[0], filename))
+      checksum = (st.st_size, int(st.st_mtime))
+    key = hashlib.sha1(("%s %r" % (filename, checksum)).encode("utf8")).hexdigest()
+    return "%s/%s.npy" % (self._feature_cache_dir, key)
+
+  def _load_audio_features(self, ref_seq_idx):
+    """
+    Reads and decodes the audio file, and extracts the features if that is deterministic.
+    Uses the feature cache, if enabled.
+    This is used by the worker threads (see ``num_feature_workers``), thus it must not use any state
+    which depends on the order of seqs (e.g. the random state of the feature extraction).
+
+    :param int ref_seq_idx:
+    :return: features (time,dim), or (audio, sample_rate) if the feature extraction needs to be done in order
+    :rtype: numpy.ndarray|(numpy.ndarray,int)
+    """
+    import io
+    import tempfile
+    cache_filename = self._get_feature_cache_filename(ref_seq_idx) if self._feature_cache_dir else None
+    if cache_filename and os.path.exists(cache_filename):
+      return numpy.load(cache_filename)
+    seq = self._data[ref_seq_idx]
+    audio_file = io.BytesIO(self._read(self._get_audio_filename(ref_seq_idx), seq['_zip_file_index']))
+    if not self.feature_extractor.is_deterministic():
+      return self.feature_extractor.read_audio_from_raw_bytes(audio_file)
+    features = self.feature_extractor.get_audio_features_from_raw_bytes(
+      audio_file, seq_name=self._get_tag_from_info_dict(seq))
+    if cache_filename:
+      fd, tmp_filename = tempfile.mkstemp(dir=self._feature_cache_dir, suffix=".tmp")
+      with os.fdopen(fd, "wb") as f:
+        numpy.save(f, features)
+      os.rename(tmp_filename, cache_filename)
+    return features
+
+  def _prefetch_audio_features(self, seq_idx):
+    """
+    Makes sure that the worker threads load the features of the next seqs, starting from seq_idx.
+
+    :param int seq_idx:
+    """
+    if self._feature_worker_pool is None:
+      from multiprocessing.pool import ThreadPool
+      self._feature_worker_pool = ThreadPool(self._num_feature_workers)
+    for idx in list(self._prefetched_features.keys()):
+      if idx < seq_idx:  # not needed anymore
+        del self._prefetched_features[idx]
+    for idx in range(seq_idx, min(seq_idx + self._num_prefetch_seqs, self._num_seqs)):
+      if idx not in self._prefetched_features:
+        self._prefetched_features[idx] = self._feature_worker_pool.apply_async(
+          self._load_audio_features, (self._get_ref_seq_idx(idx),))
+
+  def _close_feature_worker_pool(self):
+    """
+    Stops the worker threads (see ``num_feature_workers``). They are created again when needed.
+    """
+    self._prefetched_features.clear()
+    if self._feature_worker_pool is not None:
+      self._feature_worker_pool.terminate()
+      self._feature_worker_pool.join()
+      self._feature_worker_pool = None
+
+  def finish_epoch(self):
+    """
+    Stops the worker threads, and frees the prefetched features.
+    """
+    super(OggZipDataset, self).finish_epoch()
+    self._close_feature_worker_pool()
+
+  def __del__(self):
+    if getattr(self, "_feature_worker_pool", None) is not None:
+      # noinspection PyBroadException
+      try:
+        self._close_feature_worker_pool()
+      except Exception:  # e.g. at shutdown. but does not matter
+        pass
+
+  def _get_audio_features(self, seq_idx):
+    """
+    :param int seq_idx:
+    :return: features (time,dim)
+    :rtype: numpy.ndarray
+    """
+    if self._num_feature_workers > 0:
+      self._prefetch_audio_features(seq_idx)
+      res = self._prefetched_features.pop(seq_idx).get()
+    else:
+      res = self._load_audio_features(self._get_ref_seq_idx(seq_idx))
+    if isinstance(res, tuple):
+      audio, sample_rate = res
+      return self.feature_extractor.get_audio_features(
+        audio=audio, sample_rate=sample_rate, seq_name=self.get_tag(seq_idx))
+    return res
+
   def _collect_single_seq(self, seq_idx):
     """
     :param int seq_idx:
@@ -2854,8 +3062,7 @@ class OggZipDataset(CachedDataset2):
     """
     seq_tag = self.get_tag(seq_idx)
     if self.feature_extractor:
-      with self._open_audio_file(seq_idx) as audio_file:
-        features = self.feature_extractor.get_audio_features_from_raw_bytes(audio_file, seq_name=seq_tag)
+      features = self._get_audio_features(seq_idx)
     else:
       features = numpy.zeros(())  # currently the API requires some dummy values...
     targets, txt = self._get_transcription(seq_idx)
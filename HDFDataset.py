@@ -7,6 +7,7 @@ from __future__ import print_function
 import typing
 import collections
 import gc
+import sys
 import h5py
 import numpy
 from CachedDataset import CachedDataset
@@ -14,6 +15,12 @@ from CachedDataset2 import CachedDataset2
 from Dataset import Dataset, DatasetSeq
 from Log import log
 import Util
+try:
+  # noinspection PyCompatibility
+  from Queue import Queue
+except ImportError:
+  # noinspection PyCompatibility
+  from queue import Queue
 
 
 # Common attribute names for HDF dataset, which should be used in order to be proceed with HDFDataset class.
@@ -30,15 +37,22 @@ class HDFDataset(CachedDataset):
   This was the main original dataset format of RETURNN.
   """
 
-  def __init__(self, files=None, use_cache_manager=False, **kwargs):
+  def __init__(self, files=None, use_cache_manager=False, use_mmap=False, **kwargs):
     """
     :param None|list[str] files:
     :param bool use_cache_manager: uses :func:`Util.cf` for files
+    :param bool use_mmap: for all contiguous uncompressed HDF datasets (e.g. "inputs"),
+      read the data directly via a memory map (:class:`numpy.memmap`) instead of via h5py.
+      This is usually used together with cache_byte_size=0.
+      :func:`get_data` then returns read-only views without any copy,
+      and the page cache is shared across all processes on the node which read the same file.
     """
     super(HDFDataset, self).__init__(**kwargs)
     assert self.partition_epoch == 1 or self.cache_byte_size_total_limit == 0, \
       "To use partition_epoch in HDFDatasets, disable caching by setting cache_byte_size=0"
     self._use_cache_manager = use_cache_manager
+    self._use_mmap = use_mmap
+    self._file_mmaps = []  # type: typing.List[typing.Dict[str,numpy.memmap]]  # per file, data key -> memmap
     self.files = []  # type: typing.List[str]  # file names
     self.h5_files = []  # type: typing.List[h5py.File]
     self.file_start = [0]
@@ -58,6 +72,7 @@ class HDFDataset(CachedDataset):
         pass
     del self.h5_files[:]
     del self.file_seq_start[:]
+    del self._file_mmaps[:]
 
   @staticmethod
   def _decode(s):
@@ -97,6 +112,8 @@ class HDFDataset(CachedDataset):
     self.files.append(filename)
     self.h5_files.append(fin)
     print("parsing file", filename, file=log.v5)
+    if self._use_mmap:
+      self._file_mmaps.append(self._get_file_mmaps(filename, fin))
     if 'times' in fin:
       if self.timestamps is None:
         self.timestamps = fin[attr_times][...]
@@ -197,6 +214,61 @@ class HDFDataset(CachedDataset):
     self.data_dtype["data"] = str(fin['inputs'].dtype)
     assert len(self.target_keys) == len(self.file_seq_start[0][0]) - 1
 
+  @staticmethod
+  def _mmap_h5_dataset(filename, dset):
+    """
+    :param str filename:
+    :param h5py.Dataset dset:
+    :return: memmap of the raw data, or None if that is not possible (e.g. chunked or compressed)
+    :rtype: numpy.memmap|None
+    """
+    if dset.chunks is not None or dset.compression is not None:
+      return None
+    if dset.dtype.kind not in "biuf":  # e.g. strings
+      return None
+    if dset.size == 0:
+      return None  # HDF might not have allocated any storage
+    offset = dset.id.get_offset()
+    if offset is None:
+      return None
+    return numpy.memmap(filename, dtype=dset.dtype, mode="r", offset=offset, shape=dset.shape)
+
+  def _get_file_mmaps(self, filename, fin):
+    """
+    Resolves the byte offsets of the HDF datasets in the file once, and maps them into memory.
+
+    :param str filename:
+    :param h5py.File fin:
+    :return: data key -> memmap, only for the data keys where this is possible
+    :rtype: dict[str,numpy.memmap]
+    """
+    h5_datasets = {"data": fin['inputs']}
+    if 'targets' in fin:
+      h5_datasets.update({k: fin['targets/data/' + k] for k in fin['targets/data']})
+    mmaps = {}
+    for key, dset in sorted(h5_datasets.items()):
+      mmap = self._mmap_h5_dataset(filename, dset)
+      if mmap is not None:
+        mmaps[key] = mmap
+    print("%s: file %s, use mmap for %r, h5py for %r" % (
+      self, filename, sorted(mmaps.keys()), sorted(set(h5_datasets.keys()) - set(mmaps.keys()))), file=log.v5)
+    return mmaps
+
+  def _get_file_data_source(self, file_idx, key):
+    """
+    :param int file_idx:
+    :param str key: "data" or some target key
+    :return: something which can be sliced to get the raw data (for all seqs of the file)
+    :rtype: numpy.memmap|h5py.Dataset
+    """
+    if self._use_mmap and key in self._file_mmaps[file_idx]:
+      return self._file_mmaps[file_idx][key]
+    fin = self.h5_files[file_idx]
+    if key == "data":
+      return fin['inputs']
+    assert 'targets' in fin
+    return fin['targets/data/' + key]
+
   def _load_seqs(self, start, end):
     """
     Load data sequences.
@@ -231,10 +303,10 @@ class HDFDataset(CachedDataset):
       if start == 0 or self.cache_byte_size_total_limit > 0:  # suppress with disabled cache
         print("loading file %d/%d (seq range %i-%i)" % (i+1, len(self.files), start, end), self.files[i], file=log.v4)
       fin = self.h5_files[i]
-      inputs = fin['inputs']
+      inputs = self._get_file_data_source(i, "data")
       targets = None
       if 'targets' in fin:
-        targets = {k: fin['targets/data/' + k] for k in fin['targets/data']}
+        targets = {k: self._get_file_data_source(i, k) for k in fin['targets/data']}
       for idc, ids in file_info[i]:
         s = ids - self.file_start[i]
         p = self.file_seq_start[i][s]
@@ -260,25 +332,24 @@ class HDFDataset(CachedDataset):
     if self.cache_byte_size_total_limit > 0:  # Use the cache?
       return super(HDFDataset, self).get_data(seq_idx, key)
 
-    # Otherwise, directly read it from file now.
+    # Otherwise, directly read it from file now (or with mmap, just return a view).
     real_seq_idx = self._seq_index[seq_idx]
     file_idx = self._get_file_index(real_seq_idx)
-    fin = self.h5_files[file_idx]
 
     real_file_seq_idx = real_seq_idx - self.file_start[file_idx]
     start_pos = self.file_seq_start[file_idx][real_file_seq_idx]
     end_pos = self.file_seq_start[file_idx][real_file_seq_idx + 1]
 
+    source = self._get_file_data_source(file_idx, key)
     if key == "data":
-      inputs = fin['inputs']
-      data = inputs[start_pos[0]:end_pos[0]]
-      if self.window > 1:
-        data = self.sliding_window(data)
+      data = source[start_pos[0]:end_pos[0]]
     else:
-      assert 'targets' in fin
-      targets = fin['targets/data/' + key]
       ldx = self.target_keys.index(key) + 1
-      data = targets[start_pos[ldx]:end_pos[ldx]]
+      data = source[start_pos[ldx]:end_pos[ldx]]
+    if isinstance(data, numpy.memmap):
+      data = numpy.asarray(data)  # plain ndarray view
+    if key == "data" and self.window > 1:
+      data = self.sliding_window(data)
     return data
 
   def get_input_data(self, sorted_seq_idx):
@@ -314,6 +385,20 @@ class HDFDataset(CachedDataset):
 
     return end_pos - start_pos
 
+  def get_all_seq_lens(self):
+    """
+    :return: the "data" seq lengths (which is what we use for the seq order) for all seqs, by real seq idx
+    :rtype: numpy.ndarray
+    """
+    return numpy.concatenate([numpy.diff(seq_start[:, 0]) for seq_start in self.file_seq_start])
+
+  def _get_all_seq_lengths_nd(self):
+    """
+    :return: lengths of all seqs, by real seq idx, shape (num_seqs, 1 + len(target_keys)), see get_seq_length_nd
+    :rtype: numpy.ndarray
+    """
+    return numpy.concatenate([numpy.diff(seq_start, axis=0) for seq_start in self.file_seq_start], axis=0)
+
   def _get_tag_by_real_idx(self, real_seq_idx):
     file_idx = self._get_file_index(real_seq_idx)
     real_file_seq_idx = real_seq_idx - self.file_start[file_idx]
@@ -879,9 +964,15 @@ class SimpleHDFWriter:
   which can be read later by :class:`HDFDataset`.
 
   Note that we dump to a temp file first, and only at :func:`close` we move it over to the real destination.
+
+  By default, every seq is written directly to the HDF file.
+  For large amounts of data (e.g. forwarding), use ``buffer_num_frames``,
+  which gathers the seqs in memory and writes them as a whole chunk,
+  and maybe ``async_flush``, such that the writing happens in a background thread.
   """
 
-  def __init__(self, filename, dim, labels=None, ndim=None, extra_type=None, swmr=False):
+  def __init__(self, filename, dim, labels=None, ndim=None, extra_type=None, swmr=False,
+               buffer_num_frames=None, async_flush=False, compression=None, compression_opts=None):
     """
     :param str filename: Create file, truncate if exists
     :param int|None dim:
@@ -889,6 +980,12 @@ class SimpleHDFWriter:
     :param list[str]|None labels:
     :param dict[str,(int,int,str)]|None extra_type: key -> (dim,ndim,dtype)
     :param bool swmr: see http://docs.h5py.org/en/stable/swmr.html
+    :param int|None buffer_num_frames: if set, gathers the (unpadded) seqs in memory,
+      and writes them all at once when this number of input frames is reached.
+      The HDF datasets then grow geometrically, and are cut to the real size in :func:`close`.
+    :param bool async_flush: write the buffered chunks in a background thread. requires buffer_num_frames
+    :param str|None compression: e.g. "gzip" or "lzf", for the data arrays. see h5py create_dataset
+    :param int|None compression_opts: e.g. the gzip level
     """
     from Util import hdf5_strings, unicode
     import tempfile
@@ -935,9 +1032,26 @@ class SimpleHDFWriter:
 
     self._extra_num_time_steps = {}  # type: typing.Dict[str,int]  # key -> num-steps
     self._prepared_extra = set()
+    self._dataset_opts = {}  # for the data arrays
+    if compression:
+      self._dataset_opts.update(dict(compression=compression, compression_opts=compression_opts))
     if extra_type:
       self._prepare_extra(extra_type)
 
+    assert not async_flush or buffer_num_frames, "async_flush requires buffer_num_frames"
+    self._buffer_num_frames = buffer_num_frames
+    self._buffer = []  # type: typing.List[typing.Tuple[str,numpy.ndarray,typing.List[typing.Tuple[str,numpy.ndarray]]]]
+    self._buffer_cur_num_frames = 0
+    self._flush_queue = None  # type: typing.Optional[Queue]
+    self._flush_thread = None
+    self._flush_exception = None  # type: typing.Optional[BaseException]
+    if async_flush:
+      from threading import Thread
+      self._flush_queue = Queue(maxsize=2)
+      self._flush_thread = Thread(name="%r flush" % self, target=self._flush_thread_main)
+      self._flush_thread.daemon = True
+      self._flush_thread.start()
+
     if swmr:
       assert not self._file.swmr_mode  # this also checks whether the attribute exists (right version)
       self._file.swmr_mode = True
@@ -971,11 +1085,13 @@ class SimpleHDFWriter:
       shape = [None] * ndim  # type: typing.List[typing.Optional[int]]
       if ndim >= 2:
         shape[-1] = dim
+      dataset_opts = self._dataset_opts
       if dtype == "string":
         # noinspection PyUnresolvedReferences
         dtype = h5py.special_dtype(vlen=str)
+        dataset_opts = {}
       self._datasets[data_key] = self._file['targets/data'].create_dataset(
-        data_key, shape=[d if d else 0 for d in shape], dtype=dtype, maxshape=shape)
+        data_key, shape=[d if d else 0 for d in shape], dtype=dtype, maxshape=shape, **dataset_opts)
       self._file['targets/size'].attrs[data_key] = [dim or 1, ndim]
       self._extra_num_time_steps[data_key] = 0
       self._prepared_extra.add(data_key)
@@ -996,7 +1112,7 @@ class SimpleHDFWriter:
     name = "inputs"
     if name not in self._datasets:
       self._datasets[name] = self._file.create_dataset(
-        name, raw_data.shape, raw_data.dtype, maxshape=tuple(None for _ in raw_data.shape))
+        name, raw_data.shape, raw_data.dtype, maxshape=tuple(None for _ in raw_data.shape), **self._dataset_opts)
     else:
       old_shape = self._datasets[name].shape
       self._datasets[name].resize(old_shape[0] + raw_data.shape[0], axis=0)
@@ -1005,13 +1121,14 @@ class SimpleHDFWriter:
     self._file.attrs['numTimesteps'] += raw_data.shape[0]
     self._file.attrs['numSeqs'] += 1
 
-  def _insert_h5_other(self, data_key, raw_data, dtype=None, add_time_dim=False, dim=None):
+  @staticmethod
+  def _get_other_data(raw_data, dtype=None, add_time_dim=False):
     """
-    :param str data_key:
     :param numpy.ndarray|int|float|list[int] raw_data: shape=(time,data) or shape=(time,) or shape=()...
     :param str|None dtype:
     :param bool add_time_dim:
-    :param int|None dim:
+    :return: raw_data with time dim
+    :rtype: numpy.ndarray
     """
     if isinstance(raw_data, (int, float, list, numpy.float32)):
       raw_data = numpy.array(raw_data)
@@ -1021,23 +1138,44 @@ class SimpleHDFWriter:
     assert raw_data.ndim > 0 and raw_data.shape[0] > 0
     if dtype:
       raw_data = raw_data.astype(dtype)
+    return raw_data
+
+  @staticmethod
+  def _get_other_type(raw_data, dim=None):
+    """
+    :param numpy.ndarray raw_data: via :func:`_get_other_data`
+    :param int|None dim:
+    :return: (dim,ndim,dtype), like for extra_type
+    :rtype: (int,int,str)
+    """
     if dim is None:
       if raw_data.ndim > 1:
         dim = raw_data.shape[-1]
       else:
         dim = 1  # dummy
-
-    # We assume that _insert_h5_inputs was called before.
-    assert self._file.attrs['numSeqs'] > 0 and self._seq_lengths.shape[0] > 0
-    seq_idx = self._file.attrs['numSeqs'] - 1
-
-    if raw_data.dtype == numpy.object:
+    if raw_data.dtype == object:
       # Is this a string?
       assert isinstance(raw_data.flat[0], (str, bytes))
       dtype = "string"
     else:
       dtype = raw_data.dtype.name
-    if self._prepare_extra({data_key: (dim, raw_data.ndim, dtype)}):
+    return dim, raw_data.ndim, dtype
+
+  def _insert_h5_other(self, data_key, raw_data, dtype=None, add_time_dim=False, dim=None):
+    """
+    :param str data_key:
+    :param numpy.ndarray|int|float|list[int] raw_data: shape=(time,data) or shape=(time,) or shape=()...
+    :param str|None dtype:
+    :param bool add_time_dim:
+    :param int|None dim:
+    """
+    raw_data = self._get_other_data(raw_data, dtype=dtype, add_time_dim=add_time_dim)
+
+    # We assume that _insert_h5_inputs was called before.
+    assert self._file.attrs['numSeqs'] > 0 and self._seq_lengths.shape[0] > 0
+    seq_idx = self._file.attrs['numSeqs'] - 1
+
+    if self._prepare_extra({data_key: self._get_other_type(raw_data, dim=dim)}):
       # We added it now. Maybe other extra data keys were added before. The data_key_idx is different now.
       # Thus, seq_lengths might have become invalid. Reinit them.
       assert seq_idx == 0  # We can only do that in the beginning.
@@ -1087,12 +1225,15 @@ class SimpleHDFWriter:
       assert all([n_batch == value.shape[0] for value in extra.values()]), (
         "n_batch %i, extra shapes: %r" % (n_batch, {key: value.shape for (key, value) in extra.items()}))
 
-    seqlen_offset = self._seq_lengths.shape[0]
-    self._seq_lengths.resize(seqlen_offset + n_batch, axis=0)
-    self._seq_tags.resize(seqlen_offset + n_batch, axis=0)
+    self._check_flush_exception()
+    if self._buffer_num_frames is None:
+      seqlen_offset = self._seq_lengths.shape[0]
+      self._seq_lengths.resize(seqlen_offset + n_batch, axis=0)
+      self._seq_tags.resize(seqlen_offset + n_batch, axis=0)
+    else:
+      seqlen_offset = None
 
     for i in range(n_batch):
-      self._seq_tags[seqlen_offset + i] = numpy.array(seq_tag[i], dtype=self._seq_tags.dtype)
       # Note: Currently, our HDFDataset does not support to have multiple axes with dynamic length.
       # Thus, we flatten all together, and calculate the flattened seq len.
       # (Ignore this if there is only a single time dimension.)
@@ -1101,24 +1242,34 @@ class SimpleHDFWriter:
       flat_shape = [flat_seq_len]
       if self.dim and not sparse:
         flat_shape.append(self.dim)
-      self._seq_lengths[seqlen_offset + i, 0] = flat_seq_len
       data = inputs[i]
       data = data[tuple([slice(None, seq_len[axis][i]) for axis in range(ndim_with_seq_len)])]
       data = numpy.reshape(data, flat_shape)
-      self._insert_h5_inputs(data)
+      seq_extra = []  # type: typing.List[typing.Tuple[str,numpy.ndarray]]  # (key, raw_data)
       if len(seq_len) > 1:
         # Note: Because we have flattened multiple axes with dynamic len into a single one,
         # we want to store the individual axes lengths. We store those in a separate data entry "sizes".
         # Note: We could add a dummy time-dim for this "sizes", and then have a feature-dim = number of axes.
         # However, we keep it consistent to how we handled it in our 2D MDLSTM experiments.
-        self._insert_h5_other(
-          "sizes", [seq_len[axis][i] for axis in range(ndim_with_seq_len)], add_time_dim=False, dtype="int32")
+        seq_extra.append((
+          "sizes",
+          self._get_other_data(
+            [seq_len[axis][i] for axis in range(ndim_with_seq_len)], add_time_dim=False, dtype="int32")))
       if extra:
         assert len(seq_len) == 1  # otherwise you likely will get trouble with seq len mismatch
+        for key, value in extra.items():
+          assert value.shape[0] == n_batch
+          seq_extra.append((key, value[i]))
+      if seqlen_offset is None:
+        self._buffer_seq(seq_tag=seq_tag[i], data=data, seq_extra=seq_extra)
+        continue
+      self._seq_tags[seqlen_offset + i] = numpy.array(seq_tag[i], dtype=self._seq_tags.dtype)
+      self._seq_lengths[seqlen_offset + i, 0] = flat_seq_len
+      self._insert_h5_inputs(data)
+      if seq_extra:
         try:
-          for key, value in extra.items():
-            assert value.shape[0] == n_batch
-            self._insert_h5_other(key, value[i])
+          for key, value in seq_extra:
+            self._insert_h5_other(key, value)
         except Exception:
           print("%s: insert extra exception. input shape %r, seq len %r, extra shapes: %r" % (
             self, inputs.shape, seq_len,
@@ -1126,6 +1277,135 @@ class SimpleHDFWriter:
             file=log.v3)
           raise
 
+  def _buffer_seq(self, seq_tag, data, seq_extra):
+    """
+    :param str|bytes seq_tag:
+    :param numpy.ndarray data: flat inputs
+    :param list[(str,numpy.ndarray)] seq_extra:
+    """
+    # Copy, such that we do not keep a reference to the whole (padded) batch.
+    seq_extra = [(key, numpy.array(self._get_other_data(value))) for (key, value) in seq_extra]
+    self._buffer.append((seq_tag, numpy.array(data), seq_extra))
+    self._buffer_cur_num_frames += data.shape[0]
+    if self._buffer_cur_num_frames >= self._buffer_num_frames:
+      self._flush_buffer()
+
+  def _flush_buffer(self):
+    """
+    Hands over the buffered seqs as one chunk to :func:`_write_chunk`, maybe via the flush thread.
+    """
+    if not self._buffer:
+      return
+    seq_tags = [seq_tag for (seq_tag, _, _) in self._buffer]
+    inputs = numpy.concatenate([data for (_, data, _) in self._buffer], axis=0)
+    seq_lens = {"inputs": [data.shape[0] for (_, data, _) in self._buffer]}
+    extra = {}
+    extra_type = {}
+    for key, value in self._buffer[0][2]:
+      extra_type[key] = self._get_other_type(value)
+    for _, _, seq_extra in self._buffer:
+      assert sorted([key for (key, _) in seq_extra]) == sorted(extra_type.keys()), "different extra keys per seq"
+      for key, value in seq_extra:
+        extra.setdefault(key, []).append(value)
+        seq_lens.setdefault(key, []).append(value.shape[0])
+    extra = {key: numpy.concatenate(values, axis=0) for (key, values) in extra.items()}
+    chunk = (seq_tags, inputs, extra, extra_type, seq_lens)
+    self._buffer = []
+    self._buffer_cur_num_frames = 0
+    if self._flush_queue:
+      self._check_flush_exception()
+      self._flush_queue.put(chunk)
+    else:
+      self._write_chunk(*chunk)
+
+  def _flush_thread_main(self):
+    while True:
+      chunk = self._flush_queue.get()
+      if chunk is None:
+        break
+      if self._flush_exception:
+        continue  # just skip, the exception will be raised in the main thread
+      try:
+        self._write_chunk(*chunk)
+      except Exception as exc:
+        sys.excepthook(*sys.exc_info())
+        self._flush_exception = exc
+
+  def _check_flush_exception(self):
+    if self._flush_exception:
+      raise Exception("%s: exception in flush thread: %r" % (self, self._flush_exception))
+
+  @staticmethod
+  def _resize_for_append(dataset, new_len):
+    """
+    Grows geometrically, to avoid many resizes. The real size is set in :func:`close`.
+
+    :param h5py.Dataset dataset:
+    :param int new_len:
+    """
+    if dataset.shape[0] < new_len:
+      dataset.resize(max(new_len, dataset.shape[0] * 3 // 2), axis=0)
+
+  def _write_chunk(self, seq_tags, inputs, extra, extra_type, seq_lens):
+    """
+    Writes many seqs at once.
+
+    :param list[str|bytes] seq_tags:
+    :param numpy.ndarray inputs: flat inputs of all seqs, concatenated
+    :param dict[str,numpy.ndarray] extra: key -> flat data of all seqs, concatenated
+    :param dict[str,(int,int,str)] extra_type: key -> (dim,ndim,dtype)
+    :param dict[str,list[int]] seq_lens: "inputs" or extra key -> seq lens
+    """
+    if not self._prepared_extra:
+      self._prepare_extra(extra_type)
+    assert set(extra.keys()) == self._prepared_extra, "extra keys %r, expected %r" % (
+      sorted(extra.keys()), sorted(self._prepared_extra))
+    num_seqs = len(seq_tags)
+    seq_offset = int(self._file.attrs['numSeqs'])
+    seq_lens_array = numpy.zeros((num_seqs, self._seq_lengths.shape[1]), dtype="int32")
+    seq_lens_array[:, 0] = seq_lens["inputs"]
+    for data_key_idx_0, data_key in enumerate(sorted(self._prepared_extra)):
+      seq_lens_array[:, data_key_idx_0 + 1] = seq_lens[data_key]
+    self._resize_for_append(self._seq_lengths, seq_offset + num_seqs)
+    self._seq_lengths[seq_offset:seq_offset + num_seqs] = seq_lens_array
+    self._resize_for_append(self._seq_tags, seq_offset + num_seqs)
+    self._seq_tags[seq_offset:seq_offset + num_seqs] = numpy.array(seq_tags, dtype=self._seq_tags.dtype)
+
+    name = "inputs"
+    if name not in self._datasets:
+      self._datasets[name] = self._file.create_dataset(
+        name, (0,) + inputs.shape[1:], inputs.dtype, maxshape=tuple(None for _ in inputs.shape),
+        **self._dataset_opts)
+    offset = int(self._file.attrs['numTimesteps'])
+    self._resize_for_append(self._datasets[name], offset + inputs.shape[0])
+    self._datasets[name][offset:offset + inputs.shape[0]] = inputs
+    self._file.attrs['numTimesteps'] = offset + inputs.shape[0]
+
+    for data_key, raw_data in extra.items():
+      offset = self._extra_num_time_steps[data_key]
+      self._resize_for_append(self._datasets[data_key], offset + raw_data.shape[0])
+      self._datasets[data_key][offset:offset + raw_data.shape[0]] = raw_data
+      self._extra_num_time_steps[data_key] = offset + raw_data.shape[0]
+    self._file.attrs['numSeqs'] = seq_offset + num_seqs
+
+  def _finish_buffered_writes(self):
+    """
+    Writes the remaining buffered seqs, waits for the flush thread, and cuts the datasets to their real size.
+    """
+    self._flush_buffer()
+    if self._flush_thread:
+      self._flush_queue.put(None)
+      self._flush_thread.join()
+      self._flush_thread = None
+      self._check_flush_exception()
+    num_seqs = int(self._file.attrs['numSeqs'])
+    self._seq_lengths.resize(num_seqs, axis=0)
+    self._seq_tags.resize(num_seqs, axis=0)
+    if "inputs" in self._datasets:
+      self._datasets["inputs"].resize(int(self._file.attrs['numTimesteps']), axis=0)
+    for data_key, num_time_steps in self._extra_num_time_steps.items():
+      self._datasets[data_key].resize(num_time_steps, axis=0)
+
   def close(self):
     """
     Closes the file.
@@ -1133,6 +1413,8 @@ class SimpleHDFWriter:
     import os
     import shutil
     if self._file:
+      if self._buffer_num_frames is not None:
+        self._finish_buffered_writes()
       self._file.close()
       self._file = None
     if self.tmp_filename:
@@ -9,6 +9,7 @@ from __future__ import print_function
 
 import os
 import sys
+import array
 from Dataset import DatasetSeq
 from CachedDataset2 import CachedDataset2
 import gzip
@@ -46,9 +47,11 @@ class LmDataset(CachedDataset2):
                error_on_invalid_seq=True,
                add_delayed_seq_data=False,
                delayed_seq_data_start_symbol="[START]",
+               use_corpus_index=False,
                **kwargs):
     """
-    After initialization, the corpus is represented by self.orths (as a list of sequences).
+    After initialization, the corpus is represented by self.orths (as a list of sequences),
+    or, with use_corpus_index, by a line-offset index into the corpus file(s), see :class:`LmCorpusIndex`.
     The vocabulary is given by self.orth_symbols and self.orth_symbols_map gives the corresponding
     mapping from symbol to integer index.
 
@@ -73,6 +76,9 @@ class LmDataset(CachedDataset2):
     :param bool add_delayed_seq_data: will add another data-key "delayed" which will have the sequence.
       delayed_seq_data_start_symbol + original_sequence[:-1].
     :param str delayed_seq_data_start_symbol: used for add_delayed_seq_data.
+    :param bool use_corpus_index: instead of loading the whole corpus into memory,
+      use a line-offset index (persisted next to the corpus file), and read the orthographies on demand.
+      Only for uncompressed line-based txt corpus files.
     """
     super(LmDataset, self).__init__(**kwargs)
 
@@ -184,15 +190,19 @@ class LmDataset(CachedDataset2):
       self.num_outputs["delayed"] = self.num_outputs["data"]
       self.labels["delayed"] = self.labels["data"]
 
-    if isinstance(corpus_file, list):  # If a list of files is provided, concatenate all.
+    self.orths = None  # type: typing.Optional[typing.List[str]]
+    self.corpus_index = None  # type: typing.Optional[LmCorpusIndex]
+    if use_corpus_index:
+      self.corpus_index = LmCorpusIndex(corpus_file if isinstance(corpus_file, list) else [corpus_file])
+    elif isinstance(corpus_file, list):  # If a list of files is provided, concatenate all.
       self.orths = []
       for file_name in corpus_file:
         self.orths += read_corpus(file_name)
     else:
       self.orths = read_corpus(corpus_file)
     # It's only estimated because we might filter some out or so.
-    self._estimated_num_seqs = len(self.orths) // self.partition_epoch
-    print("  done, loaded %i sequences" % len(self.orths), file=log.v4)
+    self._estimated_num_seqs = self._get_num_orths() // self.partition_epoch
+    print("  done, loaded %i sequences" % self._get_num_orths(), file=log.v4)
 
     self.next_orth_idx = 0
     self.next_seq_idx = 0
@@ -244,8 +254,11 @@ class LmDataset(CachedDataset2):
     if seq_list is not None:
       self.seq_order = [int(s[len(self._tag_prefix):]) for s in seq_list]
     else:
-      self.seq_order = self.get_seq_order_for_epoch(
-        epoch=epoch, num_seqs=len(self.orths), get_seq_len=lambda i: len(self.orths[i]))
+      self.seq_order = self.get_seq_order_for_epoch_array(
+        epoch=epoch, num_seqs=self._get_num_orths(), get_seq_len=self._get_orth_len)
+    if self._num_shards > 1:
+      self.seq_order = self._apply_shard(self.seq_order)
+      self._estimated_num_seqs = len(self.seq_order)
     self.next_orth_idx = 0
     self.next_seq_idx = 0
     self.num_skipped = 0
@@ -254,6 +267,48 @@ class LmDataset(CachedDataset2):
       self.seq_gen.random_seed(epoch)
     return True
 
+  def supports_sharding(self):
+    """
+    :rtype: bool
+    """
+    return True
+
+  def get_all_seq_lens(self):
+    """
+    :return: the orth lengths (which is what we use for the seq order) for all seqs, by corpus seq idx
+    :rtype: numpy.ndarray
+    """
+    if self.corpus_index:
+      return self.corpus_index.orth_lens
+    return numpy.fromiter(map(len, self.orths), dtype="int64", count=len(self.orths))
+
+  def _get_num_orths(self):
+    """
+    :return: number of orthographies in the corpus
+    :rtype: int
+    """
+    if self.corpus_index:
+      return len(self.corpus_index)
+    return len(self.orths)
+
+  def _get_orth(self, corpus_seq_idx):
+    """
+    :param int corpus_seq_idx:
+    :rtype: str
+    """
+    if self.corpus_index:
+      return self.corpus_index.get_orth(corpus_seq_idx)
+    return self.orths[corpus_seq_idx]
+
+  def _get_orth_len(self, corpus_seq_idx):
+    """
+    :param int corpus_seq_idx:
+    :rtype: int
+    """
+    if self.corpus_index:
+      return int(self.corpus_index.orth_lens[corpus_seq_idx])
+    return len(self.orths[corpus_seq_idx])
+
   def _reduce_log_skipped_seqs(self):
     if isinstance(self.log_skipped_seqs, bool):
       return
@@ -286,7 +341,7 @@ class LmDataset(CachedDataset2):
         return None
       assert self.next_seq_idx == seq_idx, "We expect that we iterate through all seqs."
       true_idx = self.seq_order[self.next_orth_idx]
-      orth = self.orths[true_idx]  # get sequence for the next index given by seq_order
+      orth = self._get_orth(true_idx)  # get sequence for the next index given by seq_order
       seq_tag = (self._tag_prefix + str(true_idx))
       self.next_orth_idx += 1
       if orth == "</s>":
@@ -433,16 +488,25 @@ def _iter_txt(filename, callback):
     f = gzip.GzipFile(fileobj=f)
 
   for line in f:
-    try:
-      line = line.decode("utf8")
-    except UnicodeDecodeError:
-      line = line.decode("latin_1")  # or iso8859_15?
-    line = line.strip()
+    line = _decode_txt_line(line)
     if not line:
       continue
     callback(line)
 
 
+def _decode_txt_line(line):
+  """
+  :param bytes line: raw line from a txt corpus file
+  :return: decoded and stripped line
+  :rtype: str
+  """
+  try:
+    line = line.decode("utf8")
+  except UnicodeDecodeError:
+    line = line.decode("latin_1")  # or iso8859_15?
+  return line.strip()
+
+
 def iter_corpus(filename, callback):
   """
   :param str filename:
@@ -466,6 +530,110 @@ def read_corpus(filename):
   return out_list
 
 
+class LmCorpusIndex:
+  """
+  Line-offset index for line-based txt corpus files, such that we do not need to load the whole corpus into memory.
+  The orthographies are read on demand (via mmap), so e.g. with partition_epoch,
+  a sub-epoch only touches the lines it actually uses.
+  Only the lengths of the orthographies (for the seq order) are kept in memory.
+
+  The index of each file is persisted next to the corpus file (filename + ".line-index.npz"),
+  and is rebuilt if the corpus file changed (size or mtime).
+  Empty lines are skipped, like in :func:`iter_corpus`.
+  """
+
+  IndexFilePostfix = ".line-index.npz"
+
+  def __init__(self, filenames):
+    """
+    :param list[str] filenames: uncompressed line-based txt files
+    """
+    self.filenames = filenames
+    file_idxs, offsets, sizes, orth_lens = [], [], [], []
+    for i, filename in enumerate(filenames):
+      assert not filename.endswith(".gz"), "%s: corpus index not supported for gzip files" % self
+      assert not _is_bliss(filename), "%s: corpus index not supported for Bliss XML files" % self
+      index = self._get_file_index(filename)
+      file_idxs.append(numpy.full(index["offsets"].shape, i, dtype="int32"))
+      offsets.append(index["offsets"])
+      sizes.append(index["sizes"])
+      orth_lens.append(index["orth_lens"])
+    self.file_idxs = numpy.concatenate(file_idxs) if filenames else numpy.zeros((0,), dtype="int32")
+    self.offsets = numpy.concatenate(offsets) if filenames else numpy.zeros((0,), dtype="int64")
+    self.sizes = numpy.concatenate(sizes) if filenames else numpy.zeros((0,), dtype="int64")
+    self.orth_lens = numpy.concatenate(orth_lens) if filenames else numpy.zeros((0,), dtype="int64")
+    self._mmaps = {}  # file idx -> mmap.mmap
+
+  def __repr__(self):
+    return "<%s %r>" % (self.__class__.__name__, self.filenames)
+
+  def __len__(self):
+    return len(self.offsets)
+
+  @classmethod
+  def _get_file_index(cls, filename):
+    """
+    :param str filename:
+    :return: dict with "offsets", "sizes", "orth_lens"
+    :rtype: dict[str,numpy.ndarray]
+    """
+    index_filename = filename + cls.IndexFilePostfix
+    stat = os.stat(filename)
+    file_info = numpy.array([stat.st_size, int(stat.st_mtime)], dtype="int64")
+    if os.path.exists(index_filename):
+      with numpy.load(index_filename) as index:
+        if numpy.array_equal(index["file_info"], file_info):
+          return {key: index[key] for key in ["offsets", "sizes", "orth_lens"]}
+      print("LmCorpusIndex: corpus file %r changed, rebuilding index" % filename, file=log.v4)
+    print("LmCorpusIndex: building index for %r" % filename, file=log.v4)
+    index = cls._build_file_index(filename)
+    try:
+      tmp_filename = "%s.tmp%i" % (index_filename, os.getpid())
+      with open(tmp_filename, "wb") as f:
+        numpy.savez(f, file_info=file_info, **index)
+      os.rename(tmp_filename, index_filename)
+    except IOError as exc:  # e.g. read-only dir
+      print("LmCorpusIndex: cannot store index %r: %s" % (index_filename, exc), file=log.v3)
+    return index
+
+  @staticmethod
+  def _build_file_index(filename):
+    """
+    :param str filename:
+    :return: dict with "offsets", "sizes", "orth_lens", by orth idx. offset/size (in bytes) of the raw line
+    :rtype: dict[str,numpy.ndarray]
+    """
+    offsets = array.array("q")
+    sizes = array.array("q")
+    orth_lens = array.array("q")
+    pos = 0
+    with open(filename, "rb") as f:
+      for line in f:
+        orth = _decode_txt_line(line)
+        if orth:
+          offsets.append(pos)
+          sizes.append(len(line))
+          orth_lens.append(len(orth))
+        pos += len(line)
+    return {
+      "offsets": numpy.frombuffer(offsets, dtype="int64").copy(),
+      "sizes": numpy.frombuffer(sizes, dtype="int64").copy(),
+      "orth_lens": numpy.frombuffer(orth_lens, dtype="int64").copy()}
+
+  def get_orth(self, idx):
+    """
+    :param int idx: orth idx, over all files
+    :rtype: str
+    """
+    import mmap
+    file_idx = int(self.file_idxs[idx])
+    if file_idx not in self._mmaps:
+      with open(self.filenames[file_idx], "rb") as f:
+        self._mmaps[file_idx] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    offset = int(self.offsets[idx])
+    return _decode_txt_line(self._mmaps[file_idx][offset:offset + int(self.sizes[idx])])
+
+
 class AllophoneState:
   """
   Represents one allophone (phone with context) state (number, boundary).
@@ -1025,6 +1193,88 @@ class PhoneSeqGenerator:
     return allos
 
 
+class FlatTokenSeqs:
+  """
+  List-like container of token (label idx) sequences.
+  All sequences are stored in one flat int32 array, with an additional offsets array.
+  This is much more compact than a list of individual numpy arrays,
+  and it can be stored on disk and loaded via mmap.
+  See :class:`TranslationDataset` (option ``binary_cache_dir``).
+  """
+
+  TokensPostfix = ".tokens.npy"
+  OffsetsPostfix = ".offsets.npy"
+
+  def __init__(self, tokens, offsets):
+    """
+    :param numpy.ndarray tokens: 1D, int32
+    :param numpy.ndarray offsets: 1D, int64, len num seqs + 1
+    """
+    assert tokens.ndim == 1 and offsets.ndim == 1 and len(offsets) >= 1
+    assert offsets[-1] == len(tokens)
+    self.tokens = tokens
+    self.offsets = offsets
+
+  @classmethod
+  def from_seqs(cls, seqs):
+    """
+    :param list[numpy.ndarray] seqs: each 1D
+    :rtype: FlatTokenSeqs
+    """
+    offsets = numpy.zeros((len(seqs) + 1,), dtype="int64")
+    numpy.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+    if seqs:
+      tokens = numpy.concatenate(seqs).astype("int32", copy=False)
+    else:
+      tokens = numpy.zeros((0,), dtype="int32")
+    return cls(tokens=tokens, offsets=offsets)
+
+  @classmethod
+  def load(cls, filename_prefix):
+    """
+    :param str filename_prefix:
+    :return: memory-mapped token seqs, or None if the files do not exist
+    :rtype: FlatTokenSeqs|None
+    """
+    if not os.path.exists(filename_prefix + cls.OffsetsPostfix):
+      return None
+    # The offsets file is written last, thus if it exists, the tokens file also exists.
+    tokens = numpy.load(filename_prefix + cls.TokensPostfix, mmap_mode="r")
+    offsets = numpy.load(filename_prefix + cls.OffsetsPostfix, mmap_mode="r")
+    return cls(tokens=tokens, offsets=offsets)
+
+  def save(self, filename_prefix):
+    """
+    Atomically stores the arrays (write to temp file, then rename).
+
+    :param str filename_prefix:
+    """
+    import tempfile
+    for postfix, array_ in [(self.TokensPostfix, self.tokens), (self.OffsetsPostfix, self.offsets)]:
+      fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename_prefix) or ".", prefix=os.path.basename(filename_prefix), suffix=".tmp")
+      with os.fdopen(fd, "wb") as f:
+        numpy.save(f, numpy.asarray(array_))
+      os.rename(tmp_filename, filename_prefix + postfix)
+
+  def get_seq_lens(self):
+    """
+    :rtype: numpy.ndarray
+    """
+    return numpy.diff(self.offsets)
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, idx):
+    """
+    :param int idx:
+    :return: copy, i.e. not memory-mapped and writeable
+    :rtype: numpy.ndarray
+    """
+    return numpy.array(self.tokens[self.offsets[idx]:self.offsets[idx + 1]])
+
+
 class TranslationDataset(CachedDataset2):
   """
   Based on the conventions by our team for translation datasets.
@@ -1041,12 +1291,15 @@ class TranslationDataset(CachedDataset2):
   MapToDataKeys = {"source": "data", "target": "classes"}  # just by our convention
   _main_data_key = None
   _main_classes_key = None
+  _support_binary_cache = True
+  _binary_cache_version = 1
 
   def __init__(self, path, file_postfix, source_postfix="", target_postfix="",
                source_only=False,
                unknown_label=None,
                seq_list_file=None,
                use_cache_manager=False,
+               binary_cache_dir=None,
                **kwargs):
     """
     :param str path: the directory containing the files
@@ -1060,6 +1313,9 @@ class TranslationDataset(CachedDataset2):
     :param str seq_list_file: filename. line-separated list of line numbers defining fixed sequence order.
       multiple occurrences supported, thus allows for repeating examples while loading only once.
     :param bool use_cache_manager: uses :func:`Util.cf` for files
+    :param str|None binary_cache_dir: if given, stores the token idx seqs of each data key
+      in a binary format in this directory (see :class:`FlatTokenSeqs`), and loads them via mmap on later runs.
+      This skips the reading of the text files and the vocab lookups, and needs much less memory.
     """
 
     super(TranslationDataset, self).__init__(**kwargs)
@@ -1073,6 +1329,8 @@ class TranslationDataset(CachedDataset2):
     self._add_postfix = {self._main_data_key: source_postfix, self._main_classes_key: target_postfix}
     self._keys_to_read = [self._main_data_key, self._main_classes_key]
     self._use_cache_manager = use_cache_manager
+    assert not binary_cache_dir or self._support_binary_cache, "%s: binary_cache_dir not supported" % self
+    self._binary_cache_dir = binary_cache_dir
     from threading import Lock, Thread
     self._lock = Lock()
     import os
@@ -1113,6 +1371,18 @@ class TranslationDataset(CachedDataset2):
       better_exchook.install()
       from Util import AsyncThreadRun
 
+      if self._binary_cache_dir:
+        cached_data = {k: FlatTokenSeqs.load(self._get_binary_cache_filename_prefix(k)) for k in self._keys_to_read}
+        if all([data is not None for data in cached_data.values()]):
+          data_len = len(cached_data[self._main_data_key])
+          assert all([len(data) == data_len for data in cached_data.values()])
+          print("%r: loaded binary cache from %r." % (self, self._binary_cache_dir), file=log.v4)
+          with self._lock:
+            self._data.update(cached_data)
+            self._data_len = data_len
+          self._close_data_files()
+          return
+
       # First iterate once over the data to get the data len as fast as possible.
       data_len = 0
       while True:
@@ -1137,9 +1407,18 @@ class TranslationDataset(CachedDataset2):
           self._extend_data(k, data_strs)
         if not keys_to_read:
           break
-      for k, f in list(self._data_files.items()):
-        f.close()
-        self._data_files[k] = None
+      self._close_data_files()
+
+      if self._binary_cache_dir:
+        from Util import maybe_make_dirs
+        maybe_make_dirs(self._binary_cache_dir)
+        for k in self._keys_to_read:
+          with self._lock:
+            data = FlatTokenSeqs.from_seqs(self._data[k])
+          data.save(self._get_binary_cache_filename_prefix(k))
+          with self._lock:
+            self._data[k] = data  # more compact
+        print("%r: stored binary cache in %r." % (self, self._binary_cache_dir), file=log.v4)
 
     except Exception:
       sys.excepthook(*sys.exc_info())
@@ -1156,21 +1435,55 @@ class TranslationDataset(CachedDataset2):
       filename = Util.cf(filename)
     return filename
 
-  def _get_data_file(self, prefix):
+  def _close_data_files(self):
+    for k, f in list(self._data_files.items()):
+      f.close()
+      self._data_files[k] = None
+
+  def _get_binary_cache_filename_prefix(self, data_key):
+    """
+    The cache is only valid for the exact same data file, vocab and options,
+    thus we add a hash over these to the filename.
+
+    :param str data_key: e.g. "data" or "classes"
+    :return: filename prefix, see :class:`FlatTokenSeqs`
+    :rtype: str
+    """
+    import hashlib
+    prefix = {data_key_: prefix_ for (prefix_, data_key_) in self.MapToDataKeys.items()}[data_key]
+    filenames = [self._get_data_filename(prefix), "%s/%s.vocab.pkl" % (self.path, prefix)]
+    key = [self._binary_cache_version, self._add_postfix[data_key], self._unknown_label]
+    for filename in filenames:
+      st = os.stat(filename)
+      key += [os.path.abspath(filename), st.st_size, int(st.st_mtime)]
+    digest = hashlib.sha1(repr(key).encode("utf8")).hexdigest()[:16]
+    return "%s/%s.%s.%s" % (self._binary_cache_dir, prefix, self.file_postfix, digest)
+
+  def _get_data_filename(self, prefix):
     """
     :param str prefix: e.g. "source" or "target"
-    :return: full filename
-    :rtype: io.FileIO
+    :return: full filename, maybe with ".gz"
+    :rtype: str
     """
-    import os
     filename = "%s/%s.%s" % (self.path, prefix, self.file_postfix)
     if os.path.exists(filename):
-      return open(self._transform_filename(filename), "rb")
+      return filename
     if os.path.exists(filename + ".gz"):
-      import gzip
-      return gzip.GzipFile(self._transform_filename(filename + ".gz"), "rb")
+      return filename + ".gz"
     raise Exception("Data file not found: %r (.gz)?" % filename)
 
+  def _get_data_file(self, prefix):
+    """
+    :param str prefix: e.g. "source" or "target"
+    :return: opened file
+    :rtype: io.FileIO
+    """
+    filename = self._get_data_filename(prefix)
+    if filename.endswith(".gz"):
+      import gzip
+      return gzip.GzipFile(self._transform_filename(filename), "rb")
+    return open(self._transform_filename(filename), "rb")
+
   def _get_vocab(self, prefix):
     """
     :param str prefix: e.g. "source" or "target"
@@ -1353,6 +1666,7 @@ class ConfusionNetworkDataset(TranslationDataset):
   """
 
   MapToDataKeys = {"source": "sparse_inputs", "target": "classes"}
+  _support_binary_cache = False  # we have the additional "sparse_weights", which are not simple token seqs
 
   def __init__(self, max_density=20, **kwargs):
     """
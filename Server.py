@@ -8,6 +8,16 @@ task = "server"
 port = 10687
 max_engines = 2
 network = {"out" : { "class" : "softmax", "loss" : "ce", "target":"classes" }}
+
+Requests to a model are batched dynamically (see :class:`Model`),
+via these options in the model config:
+
+  batch_size: max number of frames per batch
+  max_seqs: max number of seqs per batch
+  server_max_latency: max time in seconds a request waits for other requests to be batched with it
+    (default is pause_after_first_seq)
+  server_bucket_boundaries: list of seq lengths. requests are only batched within the same length bucket
+  server_warmup: whether to run a dummy forward when the model is loaded (default True)
 """
 
 from __future__ import print_function
@@ -29,7 +39,6 @@ import numpy as np
 from tornado import locks
 from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
-from tornado.queues import Queue, QueueEmpty
 import tornado.web
 
 from Log import log
@@ -49,12 +58,37 @@ class ClassificationRequest:
   def __init__(self, data):
     self.data = data
     self.future = Future()
+    self.num_frames = data["data"].shape[0]
+    self.time_received = time.time()
+    self.time_compute_start = None
+    self.time_compute_end = None
+
+  def get_queue_latency(self):
+    """
+    :return: time in seconds from receiving the request until the start of its batch computation
+    :rtype: float
+    """
+    return self.time_compute_start - self.time_received
+
+  def get_compute_latency(self):
+    """
+    :return: time in seconds of the computation of its batch
+    :rtype: float
+    """
+    return self.time_compute_end - self.time_compute_start
 
 
 class Model:
+  """
+  Holds the engine for one config.
+  The classification requests are collected in length buckets,
+  and a bucket is forwarded as one batch when it is full (batch_size frames or max_seqs seqs),
+  or when its oldest request waited longer than server_max_latency.
+  Every model runs its batches in its own thread, so multiple models do not block each other.
+  """
+
   def __init__(self, config_file):
-    self.lock = locks.Lock()
-    self.classification_queue = Queue()
+    self.new_request_condition = locks.Condition()
 
     print('loading config %s' % config_file, file=log.v5)
     # Load and setup config
@@ -64,6 +98,8 @@ class Model:
       self.pause_after_first_seq = self.config.float('pause_after_first_seq', 0.2)
       self.batch_size = self.config.int('batch_size', 5000)
       self.max_seqs = self.config.int('max_seqs', -1)
+      self.max_latency = self.config.float('server_max_latency', self.pause_after_first_seq)
+      self.bucket_boundaries = sorted(self.config.int_list('server_bucket_boundaries', []))
     except Exception:
       print('Error: loading config %s failed' % config_file, file=log.v1)
       raise
@@ -82,6 +118,12 @@ class Model:
       print('Error: Loading network for config %s failed' % config_file, file=log.v1)
       raise
 
+    # One worker, as the devices of the engine can only run one batch at a time.
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    self.buckets = [[] for _ in range(len(self.bucket_boundaries) + 1)]  # type: list[list[ClassificationRequest]]
+    if self.config.bool('server_warmup', True):
+      self._warmup()
+
     IOLoop.current().spawn_callback(self.classify_in_background)
 
     self.last_used = datetime.datetime.now()
@@ -110,48 +152,133 @@ class Model:
       print("Devices: Used in multiprocessing mode.", file=log.v4)
     return devices
 
-  @tornado.gen.coroutine
-  def classify_in_background(self):
-    while True:
-      requests = []
-      # fetch first request
-      r = yield self.classification_queue.get()
-      requests.append(r)
-      # grab all other waiting requests
-      try:
-        while True:
-          requests.append(self.classification_queue.get_nowait())
-      except QueueEmpty:
-        pass
+  def _forward(self, data):
+    """
+    Runs in the executor thread.
 
-      output_dim = {}
-      # Do dataset creation and classification.
-      dataset = StaticDataset(data=[r.data for r in requests], output_dim=output_dim)
-      dataset.init_seq_order()
-      batches = dataset.generate_batches(recurrent_net=self.engine.network.recurrent,
-                                         batch_size=self.batch_size, max_seqs=self.max_seqs)
+    :param list[dict[str,numpy.ndarray]] data: seqs
+    :return: seq idx -> output
+    :rtype: dict[int,numpy.ndarray]
+    """
+    dataset = StaticDataset(data=data, output_dim={})
+    dataset.init_seq_order()
+    batches = dataset.generate_batches(recurrent_net=self.engine.network.recurrent,
+                                       batch_size=self.batch_size, max_seqs=self.max_seqs)
+    ctt = ForwardTaskThread(self.engine.network, self.devices, dataset, batches)
+    ctt.join()
+    return ctt.result
+
+  def _warmup(self):
+    """
+    Forwards a dummy seq, such that the first real request does not need to wait for initialization/compilation.
+    """
+    start_time = time.time()
+    try:
+      self._forward([{"data": np.zeros((10, self.engine.network.n_in), dtype="float32")}])
+    except Exception as e:
+      print('Warning: warmup failed: %s' % str(e), file=log.v2)
+    else:
+      print('Warmup took %.3f sec' % (time.time() - start_time), file=log.v4)
+
+  def _get_bucket_idx(self, num_frames):
+    """
+    :param int num_frames:
+    :rtype: int
+    """
+    for i, boundary in enumerate(self.bucket_boundaries):
+      if num_frames <= boundary:
+        return i
+    return len(self.bucket_boundaries)
 
-      with (yield self.lock.acquire()):
-        ctt = ForwardTaskThread(self.engine.network, self.devices, dataset, batches)
-        yield ctt.join()
+  def _is_bucket_ready(self, bucket, now):
+    """
+    :param list[ClassificationRequest] bucket:
+    :param float now:
+    :rtype: bool
+    """
+    if not bucket:
+      return False
+    if 0 < self.max_seqs <= len(bucket):
+      return True
+    if sum([r.num_frames for r in bucket]) >= self.batch_size:
+      return True
+    return now - bucket[0].time_received >= self.max_latency
+
+  def _pop_next_batch(self):
+    """
+    :return: requests for the next batch, or None if no bucket is ready yet.
+      From the ready buckets, the one with the oldest request is used.
+    :rtype: list[ClassificationRequest]|None
+    """
+    now = time.time()
+    ready_buckets = [bucket for bucket in self.buckets if self._is_bucket_ready(bucket, now=now)]
+    if not ready_buckets:
+      return None
+    bucket = min(ready_buckets, key=lambda b: b[0].time_received)
+    num_frames = 0
+    num_seqs = 0
+    for r in bucket:
+      if num_seqs > 0:
+        if num_frames + r.num_frames > self.batch_size or 0 < self.max_seqs <= num_seqs:
+          break
+      num_frames += r.num_frames
+      num_seqs += 1
+    requests = bucket[:num_seqs]
+    del bucket[:num_seqs]
+    return requests
+
+  def _get_next_deadline_timeout(self):
+    """
+    :return: time in seconds until the next bucket reaches the max latency, or None if there are no requests
+    :rtype: float|None
+    """
+    oldest = [bucket[0].time_received for bucket in self.buckets if bucket]
+    if not oldest:
+      return None
+    return max(min(oldest) + self.max_latency - time.time(), 0.)
 
+  @tornado.gen.coroutine
+  def classify_in_background(self):
+    while True:
+      requests = self._pop_next_batch()
+      if not requests:
+        timeout = self._get_next_deadline_timeout()
+        yield self.new_request_condition.wait(
+          timeout=datetime.timedelta(seconds=timeout) if timeout is not None else None)
+        continue
+
+      start_time = time.time()
+      for r in requests:
+        r.time_compute_start = start_time
       try:
-        for i in range(dataset.num_seqs):
-          requests[i].future.set_result(ctt.result[i])
-          self.classification_queue.task_done()
+        result = yield self.executor.submit(self._forward, [r.data for r in requests])
       except Exception as e:
-        print('exception', e)
-        raise
+        print('Error: classification failed: %s' % str(e), file=log.v1)
+        for r in requests:
+          r.future.set_exception(e)
+        continue
+      end_time = time.time()
+      for i, r in enumerate(requests):
+        r.time_compute_end = end_time
+        r.future.set_result(result[i])
+      num_frames = [r.num_frames for r in requests]
+      print('Batch of %i seqs, %i frames (%i with padding), max queue latency %.3f sec, compute %.3f sec' % (
+        len(requests), sum(num_frames), max(num_frames) * len(requests),
+        max([r.get_queue_latency() for r in requests]), end_time - start_time), file=log.v4)
 
   @tornado.gen.coroutine
   def classify(self, data):
+    """
+    :param dict[str,numpy.ndarray] data:
+    :return: the finished request, with the result in request.future
+    :rtype: ClassificationRequest
+    """
     self.last_used = datetime.datetime.now()
     request = ClassificationRequest(data)
-
-    yield self.classification_queue.put(request)
+    self.buckets[self._get_bucket_idx(request.num_frames)].append(request)
+    self.new_request_condition.notify()
     yield request.future
-
-    # return request.future.result()
+    return request
 
 
 class Server:
@@ -262,10 +389,16 @@ class ClassifyHandler(tornado.web.RequestHandler):
       shape = tuple(map(int, data_shape.split(',')))
       data['data'] = np.asarray(float_array.tolist(), dtype=data_type).reshape(shape)
 
-    result = yield model.classify(data)
-    print('writing results for request with shape %s' % data_shape)
+    request = yield model.classify(data)
+    result = request.future.result()
+    print('writing results for request with shape %s, queue latency %.3f sec, compute latency %.3f sec' % (
+      data_shape, request.get_queue_latency(), request.get_compute_latency()), file=log.v5)
+    self.set_header('X-Queue-Latency', '%.6f' % request.get_queue_latency())
+    self.set_header('X-Compute-Latency', '%.6f' % request.get_compute_latency())
     if data_format == 'json':
-      self.write({'result': result.tolist()})
+      self.write({
+        'result': result.tolist(),
+        'queue_latency': request.get_queue_latency(), 'compute_latency': request.get_compute_latency()})
     elif data_format == 'binary':
       size_info = struct.pack('<LL', *result.shape)
       self.write(size_info)
@@ -12,7 +12,8 @@ import sys
 import os
 import typing
 import array
-from struct import pack, unpack
+from collections import OrderedDict
+from struct import pack, unpack, unpack_from
 import numpy
 import zlib
 import mmap
@@ -112,7 +113,8 @@ class FileArchive:
     else:
       raise NotImplementedError("typ: %r" % typ)
     if isinstance(self.f, mmap.mmap):
-      res = numpy.frombuffer(self.f, t, size, self.f.tell())
+      # Copy, such that we do not keep references to the mmap, which would block closing it.
+      res = numpy.frombuffer(self.f, t, size, self.f.tell()).copy()
       self.f.seek(b * size, os.SEEK_CUR)
     else:
       res = numpy.fromfile(self.f, t, size, '')
@@ -173,12 +175,19 @@ class FileArchive:
   start_recovery_tag = 0xaa55aa55
   end_recovery_tag = 0x55aa55aa
 
-  def __init__(self, filename, must_exists=True):
-
+  def __init__(self, filename, must_exists=True, use_mmap=False):
+    """
+    :param str filename:
+    :param bool must_exists:
+    :param bool use_mmap: for reading, memory-map the archive instead of using buffered file reads
+    """
+    self.filename = filename
+    self.use_mmap = use_mmap
+    self._file = None
     self.ft = {}  # type: typing.Dict[str,FileInfo]
     if os.path.exists(filename):
       self.allophones = []
-      self.f = open(filename, 'rb')
+      self._open_for_read()
       header = self.read_str(len(self.SprintCacheHeader))
       assert header == self.SprintCacheHeader
 
@@ -200,7 +209,34 @@ class FileArchive:
       self._short_seg_names.clear()
 
   def __del__(self):
-    self.f.close()
+    self.close_handle()
+
+  def _open_for_read(self):
+    self._file = open(self.filename, 'rb')
+    if self.use_mmap:
+      self.f = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+      self.f = self._file
+
+  def is_open(self):
+    """
+    :return: whether we currently hold an open file handle
+    :rtype: bool
+    """
+    return getattr(self, "f", None) is not None
+
+  def close_handle(self):
+    """
+    Closes the underlying file handle (and mmap).
+    When reading, it will be reopened on demand by :func:`read`.
+    """
+    f = getattr(self, "f", None)
+    if f is not None:
+      f.close()
+    if self._file is not None and self._file is not f:
+      self._file.close()
+    self.f = None
+    self._file = None
 
   def file_list(self):
     """
@@ -253,35 +289,121 @@ class FileArchive:
   def scan_archive(self):
     """
     Scan archive.
+    This is used when there is no file info table.
+    We directly work on the memory-mapped file and search for the start recovery tags.
     """
-    i = 0
-    self.f.seek(0, 2)
-    end = self.f.tell()
-    self.f.seek(0)
-    while self.f.tell() < end:
-      if self.read_U32() != self.start_recovery_tag:
-        continue
-
-      fn_len = self.read_u32()
-      name = self.read_str(fn_len)
-      pos = self.f.tell()
-      size = self.read_u32()
-      comp = self.read_u32()
-      self.read_u32()  # chk
-
-      self.f.seek(size, 1)
-      self.ft[name] = FileInfo(name, pos, size, comp, i)
-      i += 1
-
-      self.read_U32()  # end tag
-
-      # raise NotImplementedError("Need to scan archive if no "
-      #                           "file info table found.")
+    if isinstance(self.f, mmap.mmap):
+      buf = self.f
+    else:
+      buf = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      start_tag = pack("I", self.start_recovery_tag)
+      i = 0
+      pos = buf.find(start_tag, len(self.SprintCacheHeader) + 1)
+      while pos >= 0:
+        pos += 4
+        fn_len, = unpack_from("i", buf, pos)
+        pos += 4
+        name = buf[pos:pos + fn_len].decode("ascii")
+        pos += fn_len
+        size, comp, _ = unpack_from("iii", buf, pos)  # size, comp, chk
+        self.ft[name] = FileInfo(name, pos, size, comp, i)
+        i += 1
+        pos += 12 + (comp or size) + 4  # header, content, end tag
+        pos = buf.find(start_tag, pos)
+    finally:
+      if buf is not self.f:
+        buf.close()
+
+  # These types are parsed directly from the raw entry bytes, see :func:`_parse_buffer`.
+  BufferReadTypes = ("feat_array", "align_raw_array")
+
+  @classmethod
+  def _parse_buffer(cls, buf, typ):
+    """
+    :param bytes buf: the (uncompressed) entry content
+    :param str typ: "feat_array" or "align_raw_array"
+    :return: "feat_array" -> (time, data), "align_raw_array" -> align,
+      where time is a float64 array of shape (T,2), data is a float32 array of shape (T,D),
+      align is an int32 array of shape (T,) of raw allophone-state indices (like "align_raw").
+    :rtype: (numpy.ndarray,numpy.ndarray)|numpy.ndarray
+    """
+    if typ == "feat_array":
+      return cls._parse_feat_array(buf)
+    elif typ == "align_raw_array":
+      return cls._parse_align_raw_array(buf)
+    raise NotImplementedError("typ: %r" % typ)
+
+  @staticmethod
+  def _parse_feat_array(buf):
+    """
+    :param bytes buf:
+    :return: (time, data), float64 of shape (T,2), float32 of shape (T,D)
+    :rtype: (numpy.ndarray,numpy.ndarray)
+    """
+    type_len, = unpack_from("I", buf, 0)
+    typ = bytes(buf[4:4 + type_len]).decode("ascii")
+    assert typ == "vector-f32"
+    pos = 4 + type_len
+    count, = unpack_from("I", buf, pos)
+    pos += 4
+    if count == 0:
+      return numpy.zeros((0, 2), dtype="float64"), numpy.zeros((0, 0), dtype="float32")
+    dim, = unpack_from("I", buf, pos)
+    # Each frame is stored as: size (u32), size x f32, 2 x f64. With a constant size, this is a fixed record.
+    frame_dtype = numpy.dtype([("size", "=u4"), ("data", "=f4", (dim,)), ("time", "=f8", (2,))])
+    # With varying sizes, the entry would usually not match the fixed records, so check that before we parse it.
+    if len(buf) < pos + count * frame_dtype.itemsize:
+      raise NotImplementedError("vector-f32 with varying dimension not supported for feat_array")
+    frames = numpy.frombuffer(buf, dtype=frame_dtype, count=count, offset=pos)
+    if not (frames["size"] == dim).all():
+      raise NotImplementedError("vector-f32 with varying dimension not supported for feat_array")
+    return numpy.ascontiguousarray(frames["time"]), numpy.ascontiguousarray(frames["data"])
+
+  @staticmethod
+  def _parse_align_raw_array(buf):
+    """
+    :param bytes buf:
+    :return: raw allophone-state indices, int32 of shape (T,)
+    :rtype: numpy.ndarray
+    """
+    type_len, = unpack_from("I", buf, 0)
+    typ = bytes(buf[4:4 + type_len]).decode("ascii")
+    assert typ == "flow-alignment"
+    pos = 4 + type_len + 4  # flag
+    typ = bytes(buf[pos:pos + 8]).decode("ascii")
+    pos += 8
+    if typ not in ["ALIGNRLE", "AALPHRLE"]:
+      raise Exception("No valid alignment header found (found: %r). Wrong cache?" % typ)
+    size, = unpack_from("I", buf, pos)
+    pos += 4
+    if size >= (1 << 31):
+      raise NotImplementedError("No support for weighted alignments yet.")
+    # RLE scheme. See _raw_read(). We only need the labels, thus we skip explicit time stamps.
+    runs = []
+    num_frames = 0
+    while num_frames < size:
+      n, = unpack_from("b", buf, pos)
+      pos += 1
+      if n > 0:
+        runs.append(numpy.frombuffer(buf, dtype="=i4", count=n, offset=pos))
+        pos += 4 * n
+        num_frames += n
+      elif n < 0:
+        mix, = unpack_from("i", buf, pos)
+        pos += 4
+        runs.append(numpy.full((-n,), mix, dtype="int32"))
+        num_frames += -n
+      else:
+        pos += 4  # time
+    if not runs:
+      return numpy.zeros((0,), dtype="int32")
+    return numpy.concatenate(runs).astype("int32", copy=False)
 
   def _raw_read(self, size, typ):
     """
     :param int|None size: needed for typ == "str"
-    :param str typ: "str", "feat" or "align"
+    :param str typ: "str", "feat", "align" or "align_raw"
     :return: depending on typ, "str" -> string, "feat" -> (time, data), "align" -> align,
       where string is a str,
       time is list of time-stamp tuples (start-time,end-time) in millisecs,
@@ -309,6 +431,7 @@ class FileArchive:
       return time_, data
 
     elif typ in ["align", "align_raw"]:
+      raw = typ == "align_raw"
       type_len = self.read_U32()
       typ = self.read_str(type_len)
       assert typ == "flow-alignment"
@@ -328,7 +451,7 @@ class FileArchive:
             if n > 0:
               while n > 0:
                 mix, state = self.read_u32(), None
-                if typ != "align_raw":
+                if not raw:
                   mix, state = self.get_state(mix)
                 # print(mix, state)
                 # print(time, self.allophones[mix])
@@ -337,7 +460,7 @@ class FileArchive:
                 n -= 1
             elif n < 0:
               mix, state = self.read_u32(), None
-              if typ != "align_raw":
+              if not raw:
                 mix, state = self.get_state(mix)
               while n < 0:
                 # print(mix, state)
@@ -362,17 +485,30 @@ class FileArchive:
     """
     return filename in self.ft
 
+  def get_entry_size(self, filename):
+    """
+    :param str filename: the entry-name in the archive
+    :return: size in bytes of the entry, as stored in the file info table
+    :rtype: int
+    """
+    if filename not in self.ft:
+      if filename in self._short_seg_names:
+        filename = self._short_seg_names[filename]
+    return self.ft[filename].size
+
   def read(self, filename, typ):
     """
     :param str filename: the entry-name in the archive
-    :param str typ: "str", "feat" or "align"
+    :param str typ: "str", "feat", "align", "align_raw", "feat_array" or "align_raw_array"
     :return: depending on typ, "str" -> string, "feat" -> (time, data), "align" -> align,
       where string is a str,
       time is list of time-stamp tuples (start-time,end-time) in millisecs,
         data is a list of features, each a numpy vector,
       align is a list of (time, allophone, state), time is an int from 0 to len of align,
         allophone is some int, state is e.g. in [0,1,2].
-    :rtype: str|(list[numpy.ndarray],list[numpy.ndarray])|list[(int,int,int)]
+      "feat_array" and "align_raw_array" return the same as "feat" and "align_raw" but as whole numpy arrays,
+      see :func:`_parse_buffer`. This is much faster.
+    :rtype: str|(list[numpy.ndarray],list[numpy.ndarray])|list[(int,int,int)]|numpy.ndarray|(numpy.ndarray,numpy.ndarray)
     """
 
     if filename not in self.ft:
@@ -380,6 +516,8 @@ class FileArchive:
         filename = self._short_seg_names[filename]
 
     fi = self.ft[filename]
+    if not self.is_open():
+      self._open_for_read()
     self.f.seek(fi.pos)
     size = self.read_U32()
     comp = self.read_U32()
@@ -387,12 +525,15 @@ class FileArchive:
     if size == 0:
       return None
 
+    if typ in self.BufferReadTypes:
+      if comp > 0:
+        return self._parse_buffer(zlib.decompress(self.f.read(comp), 15+32), typ=typ)
+      # With mmap, this is a plain copy of the entry bytes, such that we do not keep references to the mmap.
+      return self._parse_buffer(self.f.read(fi.size), typ=typ)
+
     if comp > 0:
-      # read compressed bytes into memory as 'bytearray'
-      a = array.array('b')
-      a.fromfile(self.f, comp)
-      # unpack
-      b = zlib.decompress(a.tostring(), 15+32)
+      # read compressed bytes into memory and unpack
+      b = zlib.decompress(self.f.read(comp), 15+32)
       # substitute self.f by an anonymous memmap file object
       # restore original file handle after we're done
       backup_f = self.f
@@ -496,15 +637,22 @@ class FileArchiveBundle:
   File archive bundle.
   """
 
-  def __init__(self, filename=None):
+  def __init__(self, filename=None, use_mmap=False, max_open_archives=None):
     """
     :param str|None filename: .bundle file
+    :param bool use_mmap: see :class:`FileArchive`
+    :param int|None max_open_archives: if set, keeps at most that many file handles open at the same time.
+      The least recently used archives get closed, and reopened on demand.
     """
+    self.use_mmap = use_mmap
+    self.max_open_archives = max_open_archives
     # filename -> FileArchive
     self.archives = {}  # type: typing.Dict[str,FileArchive]
     # archive content file -> FileArchive
     self.files = {}  # type: typing.Dict[str,FileArchive]
     self._short_seg_names = {}
+    self._pending_archives = []  # type: typing.List[str]  # not yet opened, see _open_pending_archives
+    self._open_archives = OrderedDict()  # type: typing.Dict[str,FileArchive]  # LRU order, last is most recent
     if filename is not None:
       self.add_bundle(filename=filename)
 
@@ -518,14 +666,36 @@ class FileArchiveBundle:
   def add_archive(self, filename):
     """
     :param str filename: single archive
+
+    The archive is opened lazily, i.e. on the first access to any of the content.
     """
-    if filename in self.archives:
+    if filename in self.archives or filename in self._pending_archives:
       return
-    self.archives[filename] = a = FileArchive(filename, must_exists=True)
-    for f in a.ft.keys():
-      self.files[f] = a
-    # noinspection PyProtectedMember
-    self._short_seg_names.update(a._short_seg_names)
+    self._pending_archives.append(filename)
+
+  def _open_pending_archives(self):
+    """
+    Opens all archives which were added but not yet opened, and reads their file info tables.
+    """
+    while self._pending_archives:
+      filename = self._pending_archives.pop(0)
+      self.archives[filename] = a = FileArchive(filename, must_exists=True, use_mmap=self.use_mmap)
+      for f in a.ft.keys():
+        self.files[f] = a
+      # noinspection PyProtectedMember
+      self._short_seg_names.update(a._short_seg_names)
+      self._mark_used(a)
+
+  def _mark_used(self, archive):
+    """
+    :param FileArchive archive: will be read from now. this closes the least recently used ones if needed.
+    """
+    self._open_archives.pop(archive.filename, None)
+    self._open_archives[archive.filename] = archive
+    if self.max_open_archives:
+      while len(self._open_archives) > self.max_open_archives:
+        _, old_archive = self._open_archives.popitem(last=False)
+        old_archive.close_handle()
 
   def add_bundle_or_archive(self, filename):
     """
@@ -541,6 +711,7 @@ class FileArchiveBundle:
     :rtype: list[str]
     :returns: list of content-filenames (which can be used for self.read())
     """
+    self._open_pending_archives()
     return self.files.keys()
 
   def has_entry(self, filename):
@@ -548,46 +719,65 @@ class FileArchiveBundle:
     :param str filename: argument for self.read()
     :return: True if we have this entry
     """
+    self._open_pending_archives()
     return filename in self.files
 
   def read(self, filename, typ):
     """
     :param str filename: the entry-name in the archive
-    :param str typ: "str", "feat" or "align"
+    :param str typ: "str", "feat", "align", "align_raw", "feat_array" or "align_raw_array"
     :return: depending on typ, "str" -> string, "feat" -> (time, data), "align" -> align,
       where string is a str,
       time is list of time-stamp tuples (start-time,end-time) in millisecs,
         data is a list of features, each a numpy vector,
       align is a list of (time, allophone, state), time is an int from 0 to len of align,
         allophone is some int, state is e.g. in [0,1,2].
-    :rtype: str|(list[numpy.ndarray],list[numpy.ndarray])|list[(int,int,int)]
+    :rtype: str|(list[numpy.ndarray],list[numpy.ndarray])|list[(int,int,int)]|numpy.ndarray|(numpy.ndarray,numpy.ndarray)
 
     Uses FileArchive.read().
     """
+    self._open_pending_archives()
+    if filename not in self.files:
+      if filename in self._short_seg_names:
+        filename = self._short_seg_names[filename]
+    archive = self.files[filename]
+    self._mark_used(archive)
+    return archive.read(filename, typ)
+
+  def get_entry_size(self, filename):
+    """
+    :param str filename: the entry-name in the archive
+    :return: size in bytes of the entry, as stored in the file info table
+    :rtype: int
+    """
+    self._open_pending_archives()
     if filename not in self.files:
       if filename in self._short_seg_names:
         filename = self._short_seg_names[filename]
-    return self.files[filename].read(filename, typ)
+    return self.files[filename].ft[filename].size
 
   def set_allophones(self, filename):
     """
     :param str filename: allophone filename
     """
+    self._open_pending_archives()
     for a in self.archives.values():
       a.set_allophones(filename)
 
 
-def open_file_archive(archive_filename, must_exists=True):
+def open_file_archive(archive_filename, must_exists=True, use_mmap=False, max_open_archives=None):
   """
   :param str archive_filename:
   :param bool must_exists:
+  :param bool use_mmap: see :class:`FileArchive`
+  :param int|None max_open_archives: see :class:`FileArchiveBundle`
   :rtype: FileArchiveBundle|FileArchive
   """
   if archive_filename.endswith(".bundle"):
     assert must_exists
-    return FileArchiveBundle(archive_filename)
+    return FileArchiveBundle(archive_filename, use_mmap=use_mmap, max_open_archives=max_open_archives)
   else:
-    return FileArchive(archive_filename, must_exists=must_exists)
+    return FileArchive(archive_filename, must_exists=must_exists, use_mmap=use_mmap)
 
 
 def is_sprint_cache_file(filename):
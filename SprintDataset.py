@@ -989,16 +989,19 @@ class SprintCacheDataset(CachedDataset2):
     """
     Helper class to read a Sprint cache directly.
     """
-    def __init__(self, data_key, filename, data_type=None, allophone_labeling=None):
+    def __init__(self, data_key, filename, data_type=None, allophone_labeling=None,
+                 use_mmap=False, max_open_archives=None):
       """
       :param str data_key: e.g. "data" or "classes"
       :param str filename: to Sprint cache archive
       :param str|None data_type: "feat" or "align"
       :param dict[str] allophone_labeling: kwargs for :class:`AllophoneLabeling`
+      :param bool use_mmap: memory-map the archives, see :class:`SprintCache.FileArchive`
+      :param int|None max_open_archives: for bundles, see :class:`SprintCache.FileArchiveBundle`
       """
       self.data_key = data_key
       from SprintCache import open_file_archive
-      self.sprint_cache = open_file_archive(filename)
+      self.sprint_cache = open_file_archive(filename, use_mmap=use_mmap, max_open_archives=max_open_archives)
       if not data_type:
         if data_key == "data":
           data_type = "feat"
@@ -1045,12 +1048,10 @@ class SprintCacheDataset(CachedDataset2):
       """
       assert self.type == "feat"
       assert self.content_keys
-      times, feats = self.sprint_cache.read(self.content_keys[0], "feat")
-      assert len(times) == len(feats) > 0
-      feat = feats[0]
-      assert isinstance(feat, numpy.ndarray)
-      assert feat.ndim == 1
-      return feat.shape[0]
+      times, feats = self.sprint_cache.read(self.content_keys[0], "feat_array")
+      assert isinstance(feats, numpy.ndarray)
+      assert feats.ndim == 2 and len(times) == feats.shape[0] > 0
+      return feats.shape[1]
 
     def read(self, name):
       """
@@ -1058,20 +1059,19 @@ class SprintCacheDataset(CachedDataset2):
       :return: numpy array of shape (time, [num_labels])
       :rtype: numpy.ndarray
       """
-      res = self.sprint_cache.read(name, typ=self.type)
-      if self.type == "align":
-        label_seq = numpy.array([self.allophone_labeling.get_label_idx(a, s) for (t, a, s) in res], dtype=self.dtype)
-        assert label_seq.shape == (len(res),)
-        return label_seq
-      elif self.type == "align_raw":
-        label_seq = numpy.array(
-          [self.allophone_labeling.state_tying_by_allo_state_idx[a] for (t, a, s) in res], dtype=self.dtype)
-        assert label_seq.shape == (len(res),)
+      if self.type in ["align", "align_raw"]:
+        allo_state_idxs = self.sprint_cache.read(name, typ="align_raw_array")
+        # There are only few distinct allophone states per seq, so map only those.
+        uniq_idxs, inverse = numpy.unique(allo_state_idxs, return_inverse=True)
+        uniq_labels = numpy.array(
+          [self.allophone_labeling.get_label_idx_by_allo_state_idx(int(a)) for a in uniq_idxs], dtype=self.dtype)
+        label_seq = uniq_labels[inverse.reshape(allo_state_idxs.shape)]
+        assert label_seq.shape == allo_state_idxs.shape
         return label_seq
       elif self.type == "feat":
-        times, feats = res
-        assert len(times) == len(feats) > 0
-        feat_mat = numpy.array(feats, dtype=self.dtype)
+        times, feat_mat = self.sprint_cache.read(name, typ="feat_array")
+        assert len(times) > 0
+        feat_mat = feat_mat.astype(self.dtype, copy=False)
         assert feat_mat.shape == (len(times), self.num_labels)
         return feat_mat
       else:
@@ -1126,7 +1126,7 @@ class SprintCacheDataset(CachedDataset2):
       :param int s:
       :rtype: int
       """
-      return data0.sprint_cache.ft[self.seq_list_original[s]].size
+      return data0.sprint_cache.get_entry_size(self.seq_list_original[s])
     seq_index = self.get_seq_order_for_epoch(epoch, self.num_seqs, get_seq_len=get_seq_size)
     self.seq_list_ordered = [self.seq_list_original[s] for s in seq_index]
     return True
@@ -140,7 +140,7 @@ try:
 except ImportError:
   # noinspection PyCompatibility,PyUnresolvedReferences
   from queue import Queue
-from threading import Thread, Condition
+from threading import Thread, Condition, Lock
 
 import numpy
 import tensorflow as tf
@@ -926,6 +926,213 @@ class DataProviderBase(object):
     raise NotImplementedError
 
 
+class PaddedBatchBufferPool(object):
+  """
+  Reusable Numpy buffers for the padded batch data of :class:`FeedDictDataProvider`.
+
+  Allocating new zeroed arrays for every data key of every batch causes a lot of allocator churn
+  and page faults for big batches.
+  Instead, we keep a list of free flat buffers per data key and dtype.
+  A buffer grows (geometrically) when a bigger batch comes in,
+  so after a few batches, the buffers have the max shape (as in :func:`Dataset.shapes_for_batches`)
+  and no further allocations happen.
+  The returned arrays are not zeroed, i.e. the user must take care of the padding
+  (see :func:`FeedDictDataProvider._zero_unwritten_padding`).
+  The arrays must be given back via :func:`release` once they are not used anymore,
+  i.e. after the session run which consumes them has returned.
+  """
+
+  GrowFactor = 1.5
+
+  def __init__(self):
+    self.lock = Lock()
+    self.free_buffers = {}  # type: typing.Dict[typing.Tuple[str,str],typing.List[numpy.ndarray]]  # (key,dtype)
+    self.used_buffers = {}  # type: typing.Dict[int,typing.Tuple[typing.Tuple[str,str],numpy.ndarray]]  # by id(array)
+    self.num_allocations = 0
+
+  def get_array(self, key, shape, dtype):
+    """
+    :param str key: data key
+    :param list[int]|tuple[int] shape:
+    :param str|numpy.dtype dtype:
+    :return: uninitialized C-contiguous array of the given shape, which is a view into one of our buffers
+    :rtype: numpy.ndarray
+    """
+    dtype = numpy.dtype(dtype)
+    size = int(numpy.prod(shape))
+    buf_key = (key, dtype.str)
+    with self.lock:
+      free_list = self.free_buffers.setdefault(buf_key, [])
+      buf = free_list.pop() if free_list else None
+      if buf is None or buf.size < size:
+        new_size = size
+        if buf is not None:
+          new_size = max(size, int(buf.size * self.GrowFactor))
+        buf = numpy.empty((new_size,), dtype=dtype)
+        self.num_allocations += 1
+      array = buf[:size].reshape(shape)
+      self.used_buffers[id(array)] = (buf_key, buf)
+    return array
+
+  def release(self, data):
+    """
+    :param dict[str,numpy.ndarray|list]|None data: any arrays from :func:`get_array` will be put back to the free list
+    """
+    if not data:
+      return
+    with self.lock:
+      for value in data.values():
+        if id(value) not in self.used_buffers:
+          continue
+        buf_key, buf = self.used_buffers.pop(id(value))
+        self.free_buffers[buf_key].append(buf)
+
+
+class DataProviderWorkerPool(object):
+  """
+  Pool of worker processes which build the batch data for :class:`FeedDictDataProvider`.
+
+  Each worker is forked and thus gets its own (copy-on-write) copy of the dataset,
+  which must already be initialized for the current epoch (via ``init_seq_order``).
+  Worker i restricts its copy to the shard i (see :func:`Dataset.set_shard`),
+  i.e. it gets every num_workers-th seq of the seq order of the epoch,
+  and then generates and loads its own batches of this shard, in the order of its shard.
+  Thus every seq is loaded (and e.g. its features are extracted) only by one worker,
+  and the main process does not touch the dataset at all.
+  The results are retrieved round-robin over the workers (skipping workers which are finished),
+  so the resulting batch order is deterministic for a given number of workers,
+  although it is not the same as without the pool.
+  Big arrays are sent back via shared memory (:class:`TaskSystem.SharedNumpyArray`),
+  everything else is pickled through the pipe.
+
+  Note that this does not work for datasets which depend on background threads or sub processes
+  (e.g. :class:`SprintDataset.ExternSprintDataset`), because these do not survive the fork.
+  """
+
+  def __init__(self, dataset, generate_batches_kwargs, num_workers, collect_batch_data, capacity=2, name=None):
+    """
+    :param Dataset dataset: initialized for the epoch. the workers will shard it
+    :param dict[str] generate_batches_kwargs: for :func:`Dataset.generate_batches`, called in the worker
+    :param int num_workers:
+    :param ((EngineBatch.Batch)->dict[str]) collect_batch_data: called in the worker, with the worker copy of the dataset
+    :param int capacity: max number of pending batches per worker
+    :param str|None name:
+    """
+    from TaskSystem import AsyncTask
+    from functools import partial
+    assert num_workers > 0 and capacity > 0
+    assert dataset.supports_sharding(), "%s does not support sharding" % dataset
+    self.dataset = dataset
+    self.epoch = dataset.epoch
+    self.generate_batches_kwargs = generate_batches_kwargs
+    self.num_workers = num_workers
+    self.capacity = capacity
+    self.collect_batch_data = collect_batch_data
+    self.name = name or self.__class__.__name__
+    self.workers = [
+      AsyncTask(
+        func=partial(self._worker_main, shard_index=i), name="%s worker %i" % (self.name, i), mustExec=False)
+      for i in range(num_workers)]
+    self.next_worker_idx = 0
+    self.num_pending = [0] * num_workers  # number of requests per worker for which we did not get the result yet
+    self.finished = [False] * num_workers
+    self.complete_frac = [0.] * num_workers  # per worker, of its shard
+    for worker_idx in range(num_workers):
+      for _ in range(capacity):
+        self._request(worker_idx)
+
+  def _worker_main(self, task, shard_index):
+    """
+    Runs in the forked worker process.
+    For every request, this sends the data of the next batch of our shard, or None at the end.
+
+    :param TaskSystem.AsyncTask task:
+    :param int shard_index:
+    """
+    import TaskSystem
+    TaskSystem.SharedMemNumpyConfig["enabled"] = True
+    self.dataset.set_shard(shard_index=shard_index, num_shards=self.num_workers)
+    self.dataset.init_seq_order(epoch=self.epoch)
+    batches = self.dataset.generate_batches(**self.generate_batches_kwargs)
+    while True:
+      request = task.get()
+      if request is None:
+        break
+      if not batches.has_more():
+        task.put(None)  # end of our shard
+        continue
+      batch, = batches.peek_next_n(1)
+      data = self.collect_batch_data(batch)
+      batches.advance(1)
+      task.put({"data": data, "complete_frac": batches.completed_frac()})
+
+  def _request(self, worker_idx):
+    """
+    :param int worker_idx:
+    """
+    self.workers[worker_idx].put(True)
+    self.num_pending[worker_idx] += 1
+
+  def have_more(self):
+    """
+    :return: whether some worker might still have more batches
+    :rtype: bool
+    """
+    return not all(self.finished)
+
+  def get_next_result(self):
+    """
+    This will block until the result of the next batch is available.
+
+    :return: batch data, as returned by collect_batch_data, or None if all workers are finished
+    :rtype: dict[str]|None
+    """
+    from TaskSystem import numpy_copy_and_set_unused
+    while self.have_more():
+      worker_idx = self.next_worker_idx
+      self.next_worker_idx = (worker_idx + 1) % self.num_workers
+      if self.finished[worker_idx]:
+        continue
+      res = self.workers[worker_idx].get()
+      self.num_pending[worker_idx] -= 1
+      if res is None:
+        # All further requests to this worker will also get None.
+        for _ in range(self.num_pending[worker_idx]):
+          assert self.workers[worker_idx].get() is None
+        self.num_pending[worker_idx] = 0
+        self.finished[worker_idx] = True
+        self.complete_frac[worker_idx] = 1.
+        continue
+      self._request(worker_idx)
+      self.complete_frac[worker_idx] = res["complete_frac"]
+      # Copy such that the worker can reuse the shared memory right away.
+      return numpy_copy_and_set_unused(res["data"])
+    return None
+
+  def get_complete_frac(self):
+    """
+    :return: average over the shards. they are of the same size (up to one seq)
+    :rtype: float
+    """
+    return max(sum(self.complete_frac) / self.num_workers, 1e-10)
+
+  def stop(self):
+    """
+    Stops all the workers. Pending results are discarded.
+    """
+    from TaskSystem import ProcConnectionDied
+    for worker_idx, worker in enumerate(self.workers):
+      if self.num_pending[worker_idx] == 0 and worker.is_alive():
+        try:
+          worker.put(None)
+          worker.join(timeout=10)
+        except ProcConnectionDied:
+          pass
+      if worker.is_alive():
+        worker.terminate()
+    self.num_pending = [0] * self.num_workers
+
+
 class FeedDictDataProvider(DataProviderBase):
   """
   This class will fill all the placeholders used for training or forwarding or evaluation etc.
@@ -934,7 +1141,7 @@ class FeedDictDataProvider(DataProviderBase):
   """
 
   def __init__(self, tf_session, dataset, batches, enforce_min_len1=False, capacity=10, tf_queue=None,
-               batch_slice=None, **kwargs):
+               batch_slice=None, num_workers=0, worker_capacity=2, use_buffer_pool=False, **kwargs):
     """
     :param tf.Session|tf.InteractiveSession tf_session:
     :param Dataset dataset:
@@ -945,6 +1152,18 @@ class FeedDictDataProvider(DataProviderBase):
     :param int capacity:
     :param TFDataQueues|None tf_queue:
     :param slice|None batch_slice: select a subset of the batches
+    :param int num_workers: if >0, the batches are generated and built in this many forked worker processes,
+      each with its own shard of the dataset. See :class:`DataProviderWorkerPool`.
+      Note that the batches are then not the same as with num_workers == 0 (and depend on num_workers).
+      The dataset must support this (:func:`Dataset.supports_sharding`),
+      and the batches must come from :func:`Dataset.generate_batches`.
+      The worker processes are not used if the "seq_idx" data key is used,
+      as the seq idx of a shard does not refer to the seq order of the whole dataset.
+    :param int worker_capacity: max number of batches which are in flight per worker
+    :param bool use_buffer_pool: reuse the batch arrays. See :class:`PaddedBatchBufferPool`.
+      The arrays of one batch are recycled in the next call to :func:`get_feed_dict`,
+      i.e. the session run consuming them must have returned by then.
+      Only used when the batches are built in this process (i.e. num_workers == 0).
     """
     super(FeedDictDataProvider, self).__init__(**kwargs)
     self.tf_session = tf_session
@@ -961,11 +1180,42 @@ class FeedDictDataProvider(DataProviderBase):
     self.thread_finished = False
     self.cur_batch_idx = 0
     self.reached_end = False
+    self.num_workers = num_workers
+    self.worker_capacity = worker_capacity
+    self.worker_pool = None  # type: typing.Optional[DataProviderWorkerPool]
+    self.worker_pool_complete_frac = None  # type: typing.Optional[float]
+    self.buffer_pool = None  # type: typing.Optional[PaddedBatchBufferPool]
+    if use_buffer_pool and not num_workers:
+      self.buffer_pool = PaddedBatchBufferPool()
+    self._last_output = None  # type: typing.Optional[typing.Dict[str]]
 
   def start_threads(self):
     """
-    Start the thread.
-    """
+    Start the thread (and the worker processes, if num_workers > 0).
+    """
+    if self.num_workers > 0 and "seq_idx" in self.data_keys:
+      print("%s: seq_idx is used, thus not using the %i worker processes (data_provider_num_workers)." % (
+        self, self.num_workers), file=log.v3)
+    elif self.num_workers > 0:
+      if not self.dataset.supports_sharding():
+        raise Exception(
+          "%s: num_workers (data_provider_num_workers) needs a dataset which supports sharding "
+          "(e.g. OggZipDataset, LmDataset), such that every worker can load its own seqs, but %s does not." % (
+            self, self.dataset))
+      if self.batches.generate_batches_kwargs is None:
+        raise Exception(
+          "%s: num_workers (data_provider_num_workers) needs batches from Dataset.generate_batches, "
+          "as every worker generates the batches of its shard, but got %r "
+          "(e.g. horovod_batch_assignment 'cost_balanced' is not supported)." % (self, self.batches))
+      print(
+        ("WARNING: %s: with %i worker processes (data_provider_num_workers), every worker builds the batches "
+         "of its own shard of the dataset, thus the batches and their order differ from those without workers, "
+         "and also depend on the number of workers.") % (self, self.num_workers), file=log.v2)
+      # Fork the workers before we start our own thread, such that they get a clean copy of the dataset.
+      self.worker_pool = DataProviderWorkerPool(
+        dataset=self.dataset, generate_batches_kwargs=self.batches.generate_batches_kwargs,
+        num_workers=self.num_workers, collect_batch_data=self._collect_batch_data,
+        capacity=self.worker_capacity, name="%s %s" % (self.__class__.__name__, self.dataset.name))
     thread = Thread(target=self._thread_main, name="DataProvider thread")
     thread.daemon = True  # Thread will close when parent quits.
     thread.start()
@@ -980,6 +1230,33 @@ class FeedDictDataProvider(DataProviderBase):
     self.coord.request_stop()
     self._flush_all_data()
     self.thread.join()
+    if self.worker_pool:
+      self.worker_pool_complete_frac = self.worker_pool.get_complete_frac()
+      self.worker_pool.stop()
+      self.worker_pool = None
+    if self.buffer_pool:
+      self.buffer_pool.release(self._last_output)
+    self._last_output = None
+
+  def _is_batch_idx_in_slice(self, batch_idx):
+    """
+    :param int batch_idx:
+    :return: whether this batch is selected by self.batch_slice
+    :rtype: bool
+    """
+    if self.batch_slice is None:
+      return True
+    assert (self.batch_slice.start or 0) >= 0
+    start = self.batch_slice.start or 0
+    assert (self.batch_slice.step or 1) >= 1
+    step = self.batch_slice.step or 1
+    if batch_idx < start:
+      return False
+    if self.batch_slice.stop is not None and batch_idx >= self.batch_slice.stop:
+      return False
+    if step > 1 and (batch_idx - start) % step != 0:
+      return False
+    return True
 
   def get_next_batch(self, consider_batch_slice):
     """
@@ -989,22 +1266,25 @@ class FeedDictDataProvider(DataProviderBase):
     :returns: batch-data-value-dict or None. if not consider_batch_slice, will never be None
     :rtype: dict[str,numpy.ndarray]|None
     """
-    # See EngineUtil.assign_dev_data() for reference.
     cur_batch_idx = self.cur_batch_idx
     batch, = self.batches.peek_next_n(1)
     self.cur_batch_idx += 1
-    if consider_batch_slice and self.batch_slice is not None:
-      assert (self.batch_slice.start or 0) >= 0
-      start = self.batch_slice.start or 0
-      assert (self.batch_slice.step or 1) >= 1
-      step = self.batch_slice.step or 1
-      if cur_batch_idx < start:
-        return None
-      if self.batch_slice.stop is not None and cur_batch_idx >= self.batch_slice.stop:
-        return None
-      if step > 1 and (cur_batch_idx - start) % step != 0:
-        return None
+    if consider_batch_slice and not self._is_batch_idx_in_slice(cur_batch_idx):
+      return None
+    return self._collect_batch_data(batch)
+
+  def _collect_batch_data(self, batch):
+    """
+    Loads the seqs of the batch from the dataset and creates the padded batch data.
+    This is also called from the worker processes (see :class:`DataProviderWorkerPool`).
+
+    :param EngineBatch.Batch batch:
+    :returns: batch-data-value-dict
+    :rtype: dict[str,numpy.ndarray|list[str]|list[int]]
+    """
+    # See EngineUtil.assign_dev_data() for reference.
     from Dataset import Batch, shapes_for_batches
+    from EngineBatch import BatchShapeStats
     assert isinstance(batch, Batch)
     # In Returnn with Theano, we usually have the shape (time,batch,feature).
     # In TensorFlow, the default is (batch,time,feature).
@@ -1012,8 +1292,14 @@ class FeedDictDataProvider(DataProviderBase):
     # This must match the Data specification in TFNetwork.ExternData.init_from_config().
     shapes = shapes_for_batches(
       [batch], data_keys=self.data_keys, extern_data=self.extern_data, enforce_min_len1=self.enforce_min_len1)
-    data = {k: numpy.zeros(shape=shapes[k], dtype=self.extern_data.data[k].dtype)
-            for k in self.data_keys if self.extern_data.data[k].dtype != "string"}
+    if self.buffer_pool:
+      # Not initialized. The padding is set to zero below.
+      data = {k: self.buffer_pool.get_array(k, shape=shapes[k], dtype=self.extern_data.data[k].dtype)
+              for k in self.data_keys if self.extern_data.data[k].dtype != "string"}
+    else:
+      data = {k: numpy.zeros(shape=shapes[k], dtype=self.extern_data.data[k].dtype)
+              for k in self.data_keys if self.extern_data.data[k].dtype != "string"}
+    written = {}  # type: typing.Dict[typing.Tuple[str,int],typing.List[typing.Tuple[int,int]]]  # (key,slice)->ranges
     # Numpy cannot handle "string" dtype. Just make it a list[str], which is what TF can handle.
     data.update({k: [""] * batch.num_slices
                  for k in self.data_keys if self.extern_data.data[k].dtype == "string"})
@@ -1048,31 +1334,77 @@ class FeedDictDataProvider(DataProviderBase):
                 self.dataset.get_seq_length(seq.seq_idx)))
             data[k][q, o[k]:o[k] + ls] = v
             seq_lens[k][q] = max(seq_lens[k][q], o[k] + ls)
+            written.setdefault((k, q), []).append((o[k], o[k] + ls))
           else:  # no time-axis
             data[k][q] = v
+            written.setdefault((k, q), [])
         data["seq_idx"][q] = seq.seq_idx
         data["seq_tag"][q] = self.dataset.get_tag(seq.seq_idx)
+    if self.buffer_pool:
+      self._zero_unwritten_padding(data=data, written=written)
     for k in seq_lens.keys():
       data["%s_seq_lens" % k] = seq_lens[k]
+    data["batch_info"] = BatchShapeStats.get_batch_info(batch, data_keys=[
+      k for k in self.data_keys
+      if k not in ["seq_idx", "seq_tag"] and k not in self.extern_data.extra_added_keys])
     return data
 
+  def _zero_unwritten_padding(self, data, written):
+    """
+    With the buffer pool, the arrays are not initialized.
+    Here we set everything to zero which was not written in :func:`_collect_batch_data`,
+    which is usually only the padded tail of each slice.
+
+    :param dict[str,numpy.ndarray|list] data:
+    :param dict[(str,int),list[(int,int)]] written: (key,slice) -> list of written (start,end) frame ranges
+    """
+    for k in self.data_keys:
+      v = data.get(k)
+      if not isinstance(v, numpy.ndarray):
+        continue
+      have_time_axis = self.extern_data.data[k].have_time_axis()
+      for q in range(v.shape[0]):
+        if (k, q) not in written:
+          v[q] = 0
+          continue
+        if not have_time_axis:
+          continue
+        pos = 0
+        for start, end in sorted(written[(k, q)]):
+          if start > pos:
+            v[q, pos:start] = 0
+          pos = max(pos, end)
+        if pos < v.shape[1]:
+          v[q, pos:] = 0
+
+  def _enqueue(self, enqueue_args):
+    """
+    :param dict[str,numpy.ndarray|list] enqueue_args: from self.get_next_batch()
+    """
+    if self.queue:
+      self.queue.put(enqueue_args)
+    else:
+      self.tf_queue.enqueue(tf_session=self.tf_session, data=enqueue_args)
+      if self.buffer_pool:
+        self.buffer_pool.release(enqueue_args)  # TF has copied it already
+    with self.state_change_cond:
+      self.state_change_cond.notifyAll()
+
   def _thread_main(self):
     try:
       import better_exchook
       better_exchook.install()
 
-      while self.batches.has_more() and not self.coord.should_stop():
-        enqueue_args = self.get_next_batch(consider_batch_slice=True)
-        if enqueue_args is not None:
-          if self.queue:
-            self.queue.put(enqueue_args)
-          else:
-            self.tf_queue.enqueue(tf_session=self.tf_session, data=enqueue_args)
-        with self.state_change_cond:
-          self.state_change_cond.notifyAll()
-        self.batches.advance(1)
-
-      self.reached_end = not self.batches.has_more()
+      if self.worker_pool:
+        self._thread_main_loop_worker_pool()
+        self.reached_end = not self.worker_pool.have_more()
+      else:
+        while self.batches.has_more() and not self.coord.should_stop():
+          enqueue_args = self.get_next_batch(consider_batch_slice=True)
+          if enqueue_args is not None:
+            self._enqueue(enqueue_args)
+          self.batches.advance(1)
+        self.reached_end = not self.batches.has_more()
 
     except Exception as exc:
       print("Exception in DataProvider thread: %r" % exc, file=log.v1)
@@ -1083,6 +1415,21 @@ class FeedDictDataProvider(DataProviderBase):
         self.thread_finished = True
         self.state_change_cond.notifyAll()
 
+  def _thread_main_loop_worker_pool(self):
+    """
+    Like the loop in :func:`_thread_main`, but the batches are generated and collected by the worker processes.
+    The batch slice refers to the order in which we get the batches from the workers.
+    """
+    pool = self.worker_pool
+    while pool.have_more() and not self.coord.should_stop():
+      enqueue_args = pool.get_next_result()
+      if enqueue_args is None:
+        break
+      cur_batch_idx = self.cur_batch_idx
+      self.cur_batch_idx += 1
+      if self._is_batch_idx_in_slice(cur_batch_idx):
+        self._enqueue(enqueue_args)
+
   def have_more_data(self, session):
     """
     :param tf.Session|None session:
@@ -1112,7 +1459,9 @@ class FeedDictDataProvider(DataProviderBase):
     """
     while self.have_more_data(None):
       if self.queue:
-        self.queue.get()
+        output = self.queue.get()
+        if self.buffer_pool:
+          self.buffer_pool.release(output)
       else:
         raise NotImplementedError
 
@@ -1124,11 +1473,16 @@ class FeedDictDataProvider(DataProviderBase):
 
     :param bool single_threaded: whether to not use the queue
     :returns: we dequeue one batch from the queue and provide it for all placeholders of our external data,
-      and additionally return some meta information.
+      and additionally return some meta information,
+      such as the batch shape info (see :func:`EngineBatch.BatchShapeStats.get_batch_info`).
     :rtype: (dict[tf.Tensor,numpy.ndarray],dict[str])
     """
     if self.tf_queue:
       return {}  # not needed to feed anything, it gets it via the queues
+    if self.buffer_pool:
+      # The session run which consumed the last batch has returned by now, so we can recycle its arrays.
+      self.buffer_pool.release(self._last_output)
+      self._last_output = None
     if single_threaded:
       assert self.batches.has_more()
       assert self.batch_slice is None
@@ -1136,6 +1490,8 @@ class FeedDictDataProvider(DataProviderBase):
     else:
       output = self.queue.get()
     assert isinstance(output, dict)
+    if self.buffer_pool:
+      self._last_output = output
     # The data itself.
     d = {
       self.extern_data.get_data(k).placeholder: output[k]
@@ -1153,7 +1509,7 @@ class FeedDictDataProvider(DataProviderBase):
           raise Exception(
             "dataset currently does not support variable shape in other dimensions than the first. "
             "dim=%i, placeholder=%r" % (dim, len_placeholder))
-    return d, {"seq_idx": output["seq_idx"], "seq_tag": output["seq_tag"]}
+    return d, {"seq_idx": output["seq_idx"], "seq_tag": output["seq_tag"], "batch_info": output["batch_info"]}
 
   def get_dataset_name(self):
     """
@@ -1171,6 +1527,10 @@ class FeedDictDataProvider(DataProviderBase):
     """
     :rtype: float
     """
+    if self.worker_pool:
+      return self.worker_pool.get_complete_frac()
+    if self.worker_pool_complete_frac is not None:
+      return self.worker_pool_complete_frac
     return self.batches.completed_frac()
 
 
@@ -29,12 +29,13 @@ from tensorflow.python.client import timeline
 
 from EngineBase import EngineBase
 from Dataset import Dataset, Batch, BatchSetGenerator
+from EngineBatch import BatchPlanCache, BatchShapeStats
 from LearningRateControl import load_learning_rate_control_from_config, LearningRateControl
 from Log import log
 from Pretrain import pretrain_from_config
-from TFNetwork import TFNetwork, help_on_tf_exception
+from TFNetwork import TFNetwork, AsyncCheckpointSaver, help_on_tf_exception
 from TFUpdater import Updater
-from Util import hms, NumbersDict, BackendEngine
+from Util import hms, hms_fraction, NumbersDict, BackendEngine
 from pprint import pprint
 
 
@@ -49,6 +50,9 @@ class Runner(object):
   This encapsulates the logic around TF ``session.run``, i.e. iterating over the dataset.
   """
 
+  # The parts of a step which we measure, see :func:`_add_step_timing`. "other" is whatever is left.
+  TimingParts = ("data_wait", "feed_dict", "session_run", "eval_info", "extra_fetches", "horovod_sync", "other")
+
   # noinspection PyShadowingBuiltins
   def __init__(self, engine, dataset, batches, train, eval=True, train_flag=None,
                extra_fetches=None, extra_fetches_callback=None):
@@ -79,6 +83,7 @@ class Runner(object):
     self._should_train = train
     self._should_eval = eval
     self.store_metadata_mod_step = engine.config.int("store_metadata_mod_step", 0)
+    self.trace_steps = self._parse_trace_steps(engine.config.typed_value("tf_trace_steps", None))
     self.reset_updater_vars_mod_step = engine.config.int("reset_updater_vars_mod_step", 0)
     self.finalized = False
     self.cancel_flag = False
@@ -94,6 +99,9 @@ class Runner(object):
     self.score = {}  # type: typing.Dict[str,float]  # entries like "cost:output"
     self.error = {}  # type: typing.Dict[str,float]  # entries like "error:output"
     self.stats = {}  # type: typing.Dict[str,typing.Union[float,numpy.ndarray,'Util.Stats']]  # entries like "stats:..."
+    self.batch_shape_stats = BatchShapeStats()  # real vs padded frames, etc.
+    self.step_timings = {}  # type: typing.Dict[str,float]  # last step, see TimingParts. secs
+    self.timings = NumbersDict()  # accumulated over all steps, see TimingParts. secs
     self.extra_fetches = extra_fetches
     if extra_fetches is not None:
       assert extra_fetches_callback
@@ -104,6 +112,96 @@ class Runner(object):
     terminal_width, _ = terminal_size()
     self._show_interactive_process_bar = (log.verbose[3] and (not log.verbose[5]) and terminal_width >= 0)
 
+  @classmethod
+  def _parse_trace_steps(cls, trace_steps):
+    """
+    :param int|str|list[int|str|(int,int)]|None trace_steps: e.g. 100, [100, 200], [(100, 105)], or "100-105,200"
+    :return: list of (start, end) ranges of the (global) steps, end exclusive
+    :rtype: list[(int,int)]
+    """
+    if trace_steps is None:
+      return []
+    if isinstance(trace_steps, str):
+      trace_steps = [part.strip() for part in trace_steps.split(",") if part.strip()]
+    if not isinstance(trace_steps, (list, tuple)):
+      trace_steps = [trace_steps]
+    ranges = []
+    for entry in trace_steps:
+      if isinstance(entry, str):
+        if "-" in entry:
+          start, end = entry.split("-", 1)
+          entry = (int(start), int(end) + 1)  # "100-105" is inclusive
+        else:
+          entry = int(entry)
+      if isinstance(entry, int):
+        entry = (entry, entry + 1)
+      assert isinstance(entry, (list, tuple)) and len(entry) == 2, "invalid tf_trace_steps entry %r" % (entry,)
+      ranges.append((int(entry[0]), int(entry[1])))
+    return ranges
+
+  def _is_trace_step(self, global_step):
+    """
+    :param int global_step: step + step_offset, i.e. the same as in the TF summaries
+    :return: whether we should capture a full trace for this step, via tf_trace_steps
+    :rtype: bool
+    """
+    for start, end in self.trace_steps:
+      if start <= global_step < end:
+        return True
+    return False
+
+  def _add_step_timing(self, part, start_time):
+    """
+    :param str part: see :data:`TimingParts`
+    :param float start_time: via time.time()
+    :return: current time, which can be used as start time for the next part
+    :rtype: float
+    """
+    now = time.time()
+    self.step_timings[part] = self.step_timings.get(part, 0.0) + now - start_time
+    return now
+
+  def _finish_step_timings(self, step_start_time):
+    """
+    Called at the end of a step. Adds "other" and "step" to :data:`step_timings`, and accumulates them.
+
+    :param float step_start_time: via time.time(), when we started waiting for the data of this step
+    """
+    self.step_timings["step"] = time.time() - step_start_time
+    self.step_timings["other"] = max(
+      self.step_timings["step"] - sum([v for (k, v) in self.step_timings.items() if k != "step"]), 0.0)
+    for k, v in self.step_timings.items():
+      self.timings[k] = self.timings.dict.get(k, 0.0) + v
+
+  def _print_timings(self, report_prefix, num_steps):
+    """
+    :param str report_prefix:
+    :param int num_steps:
+    """
+    total = self.timings.dict.get("step", 0.0)
+    if not num_steps or total <= 0:
+      return
+    print("%s, step timings (total, per step, fraction):" % report_prefix, file=log.v4)
+    for part in self.TimingParts:
+      value = self.timings.dict.get(part, 0.0)
+      print("  %s: %s, %.4f sec, %.1f%%" % (
+        part, hms_fraction(value, decimals=2), value / num_steps, value / total * 100.), file=log.v4)
+    if self.engine.config.is_true("use_horovod"):
+      # noinspection PyPackageRequirements,PyUnresolvedReferences
+      import horovod.tensorflow as hvd
+      print("%s, Horovod rank %i utilization (session run time / step time): %.1f%%" % (
+        report_prefix, hvd.rank(), self.timings.dict.get("session_run", 0.0) / total * 100.), file=log.v3)
+
+  @staticmethod
+  def _write_chrome_trace(run_metadata, filename):
+    """
+    :param tf.RunMetadata run_metadata:
+    :param str filename: the trace can be viewed in Chrome via chrome://tracing
+    """
+    tl = timeline.Timeline(run_metadata.step_stats)
+    with open(filename, 'w') as f:
+      f.write(tl.generate_chrome_trace_format(show_memory=True))
+
   def _get_fetches_dict(self):
     """
     :return: values and actions which should be calculated and executed in self.run() by the TF session for each step
@@ -160,12 +258,13 @@ class Runner(object):
 
     return d
 
-  def _print_process(self, report_prefix, step, step_duration, eval_info):
+  def _print_process(self, report_prefix, step, step_duration, eval_info, batch_info=None):
     """
     :param str report_prefix:
     :param int step:
     :param float step_duration: in secs
     :param dict[str] eval_info: via :func:`_collect_eval_info`
+    :param dict[str]|None batch_info: via :func:`EngineBatch.BatchShapeStats.get_batch_info`
     :return: nothing, will be printed to log
     """
     if not self._show_interactive_process_bar and not log.v[5]:
@@ -181,6 +280,12 @@ class Runner(object):
         "step %i" % step]
       if eval_info:  # Such as score.
         info += ["%s %s" % item for item in sorted(eval_info.items())]
+      if batch_info:
+        info += ["num_seqs %i" % batch_info["num_seqs"]]
+        info += [
+          "padding:%s %.1f%%" % (k, BatchShapeStats.get_padding_ratio(
+            batch_info["num_frames"][k], max_frames * batch_info["num_slices"]) * 100.)
+          for (k, max_frames) in sorted(batch_info["max_frames"].items())]
       info += [
         "%.3f sec/step" % step_duration,
         "elapsed %s" % hms(start_elapsed),
@@ -472,6 +577,8 @@ class Runner(object):
     """
     :param str report_prefix: prefix for logging, e.g. "train"
     """
+    from Debug import StartupProfiler
+    StartupProfiler.finish(file=log.v1)  # only the first time, if enabled
     sess = self.engine.tf_session
     if self.engine.config.has("tf_log_dir"):
       logdir = self.engine.config.value("tf_log_dir", None)
@@ -526,18 +633,26 @@ class Runner(object):
       if writer:
         writer.add_graph(sess.graph)
       hvd_stop = hvd_error = False
+      step_start_time = time.time()
       while self.data_provider.have_more_data(session=sess):
+        self.step_timings = {}
+        t = self._add_step_timing("data_wait", step_start_time)
         hvd_stop, hvd_error = self._horovod_signal_have_more_data()
+        t = self._add_step_timing("horovod_sync", t)
         if hvd_error:
           raise Exception("Some other Horovod peer failed.")
         if hvd_stop:
           # Some other peer does not have data anymore, but no error occurred.
           break
         feed_dict, meta_step_info = self.data_provider.get_feed_dict()
+        batch_info = meta_step_info.get("batch_info")
+        if batch_info:
+          self.batch_shape_stats.collect(batch_info)
         if isinstance(self.engine.network.train_flag, tf.Tensor):
           feed_dict[self.engine.network.train_flag] = self._train_flag
         if isinstance(self.engine.network.epoch_step, tf.Tensor):
           feed_dict[self.engine.network.epoch_step] = step
+        self._add_step_timing("feed_dict", t)
         start_time = time.time()
         if self._should_train and self.reset_updater_vars_mod_step and step % self.reset_updater_vars_mod_step == 0:
           print("Reset updater vars in step %i." % step, file=log.v5)
@@ -560,7 +675,8 @@ class Runner(object):
 
         # Now do one calculation step. Optionally with metadata.
         try:
-          if self.store_metadata_mod_step and step % self.store_metadata_mod_step == 0:
+          trace_step = self._is_trace_step(step + step_offset)
+          if (self.store_metadata_mod_step and step % self.store_metadata_mod_step == 0) or trace_step:
             # Slow run that stores extra information for debugging.
             print('Storing metadata', file=log.v5)
             run_options = tf.RunOptions(
@@ -573,17 +689,25 @@ class Runner(object):
               options=run_options,
               run_metadata=run_metadata)  # type: typing.Dict[str,typing.Union[numpy.ndarray,str]]
             elapsed_time_tf += time.time() - session_run_start_time
-            writer.add_summary(fetches_results["summary"], step + step_offset)
-            writer.add_run_metadata(run_metadata, 'step_{:04d}'.format(step + step_offset))
-            tl = timeline.Timeline(run_metadata.step_stats)
-            timeline_path = os.path.join(logdir, 'timeline.trace')
-            with open(timeline_path, 'w') as f:
-              f.write(tl.generate_chrome_trace_format(show_memory=True))
+            self._add_step_timing("session_run", session_run_start_time)
+            if writer and "summary" in fetches_results:
+              writer.add_summary(fetches_results["summary"], step + step_offset)
+            if writer:
+              writer.add_run_metadata(run_metadata, 'step_{:04d}'.format(step + step_offset))
+            if not logdir:
+              print("No log dir, thus not writing the Chrome trace of step %i" % (step + step_offset), file=log.v4)
+            elif trace_step:
+              timeline_path = os.path.join(logdir, 'timeline-step%i.trace.json' % (step + step_offset))
+              print("Write Chrome trace of step %i to %s" % (step + step_offset, timeline_path), file=log.v4)
+              self._write_chrome_trace(run_metadata, timeline_path)
+            else:
+              self._write_chrome_trace(run_metadata, os.path.join(logdir, 'timeline.trace'))
           else:
             session_run_start_time = time.time()
             fetches_results = sess.run(
               fetches_dict, feed_dict=feed_dict)  # type: typing.Dict[str,typing.Union[numpy.ndarray,str]]
             elapsed_time_tf += time.time() - session_run_start_time
+            self._add_step_timing("session_run", session_run_start_time)
             if writer and "summary" in fetches_results:
               writer.add_summary(fetches_results["summary"], step + step_offset)
         except tf.errors.OpError as exc:
@@ -591,11 +715,24 @@ class Runner(object):
           # Extra info will be printed below.
           raise
 
+        t = time.time()
         eval_info = self._collect_eval_info(fetches_results=fetches_results)
+        t = self._add_step_timing("eval_info", t)
         self._maybe_handle_extra_fetches(fetches_results)
+        t = self._add_step_timing("extra_fetches", t)
         elapsed_time_tf += self._horovod_sync_params(local_step=step)
+        self._add_step_timing("horovod_sync", t)
         duration = time.time() - start_time
-        self._print_process(report_prefix=report_prefix, step=step, step_duration=duration, eval_info=eval_info)
+        self._print_process(
+          report_prefix=report_prefix, step=step, step_duration=duration, eval_info=eval_info, batch_info=batch_info)
+        self._finish_step_timings(step_start_time)
+        if writer:
+          summary_values = [("timing/%s" % k, v) for (k, v) in sorted(self.step_timings.items())]
+          if batch_info:
+            summary_values += BatchShapeStats.get_batch_summary_values(batch_info)
+          writer.add_summary(
+            tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value) for (tag, value) in summary_values]),
+            step + step_offset)
 
         if self.engine.config.bool("stop_on_nonfinite_train_score", True):
           score_values = self._results_accumulated.values()
@@ -607,6 +744,7 @@ class Runner(object):
         step += 1
         if self.cancel_flag:
           raise CancelTrainingException("cancel_flag is set")
+        step_start_time = time.time()
 
       self._print_finish_process()
 
@@ -625,6 +763,10 @@ class Runner(object):
         print("Stats:", file=log.v1)
         for k, v in sorted(self.stats.items()):
           print("  %s:" % k, v, file=log.v1)
+      if self.batch_shape_stats.num_batches:
+        print("%s, batch shape stats:" % report_prefix, file=log.v3)
+        self.batch_shape_stats.dump(stream=log.v3, stream_prefix="  ")
+      self._print_timings(report_prefix=report_prefix, num_steps=step)
       elapsed = time.time() - self.start_time
       elapsed_tf_percentage = (elapsed_time_tf / elapsed) if (elapsed > 0) else 0.0
       print("%s, finished after %i steps, %s elapsed (%.1f%% computing time)" % (
@@ -688,6 +830,9 @@ class Engine(EngineBase):
     self._checked_uninitialized_vars = False
     self._merge_all_summaries = None
     self.dataset_batches = {}  # type: typing.Dict[str,BatchSetGenerator]
+    self.batch_plan_cache = None  # type: typing.Optional[BatchPlanCache]
+    if config.value("batch_plan_cache_dir", None):
+      self.batch_plan_cache = BatchPlanCache(cache_dir=config.value("batch_plan_cache_dir", None))
     self.train_data = None  # type: typing.Optional[Dataset]
     self.start_epoch = None  # type: typing.Optional[int]
     self.use_dynamic_train_flag = False
@@ -697,11 +842,15 @@ class Engine(EngineBase):
     self._const_cache = {}  # type: typing.Dict[str,tf.Tensor]
     self.preload_from_files = None  # type: typing.Optional[typing.Dict[str,typing.Dict[str]]]
     self.max_seqs = None  # type: typing.Optional[int]
+    self._async_saver = None  # type: typing.Optional[AsyncCheckpointSaver]
+    if config.bool("save_model_async", False):
+      self._async_saver = AsyncCheckpointSaver()
 
   def finalize(self):
     """
     Finalizes the TF session, network, graph.
     """
+    self.wait_for_async_save()
     self._close_tf_session()
     self._reset_graph()
 
@@ -809,6 +958,7 @@ class Engine(EngineBase):
       assert not filename
       filename = self.get_epoch_model_filename(epoch=epoch)
     print("Load model %s" % (filename,), file=log.v4)
+    self.wait_for_async_save()
     self.network.load_params_from_file(filename, session=self.tf_session)
 
   def save_model(self, filename=None):
@@ -820,7 +970,16 @@ class Engine(EngineBase):
     if not filename:
       filename = self.get_epoch_model_filename()
     print("Save model under %s" % (filename,), file=log.v4)
-    self.network.save_params_to_file(filename, session=self.tf_session)
+    self.network.save_params_to_file(filename, session=self.tf_session, async_saver=self._async_saver)
+
+  def wait_for_async_save(self):
+    """
+    With ``save_model_async``, this waits until all pending checkpoints are written (and old models cleaned up).
+    """
+    if self._async_saver:
+      if self._async_saver.is_busy():
+        print("Waiting for the async model saving to finish...", file=log.v4)
+      self._async_saver.wait()
 
   @staticmethod
   def delete_model(filename):
@@ -887,6 +1046,7 @@ class Engine(EngineBase):
       self.max_seq_length = NumbersDict(self.max_seq_length)
     assert isinstance(self.max_seq_length, (int, float, NumbersDict))
     self.max_pad_size = config.typed_value("max_pad_size", None)
+    self.batch_bucket_boundaries = config.typed_value("batch_bucket_boundaries", None)
     # And also initialize the network. That depends on some vars here such as pretrain.
     self.init_network_from_config(config)
 
@@ -1151,7 +1311,18 @@ class Engine(EngineBase):
       from Util import dict_diff_str
       print("reinit because network description differs. Diff:",
             dict_diff_str(self.network.layers_desc, net_desc), file=log.v3)
-    old_network_params = self.network.get_params_serialized(self.tf_session)
+    # With init_new_network_stream_params, we keep the old session (and graph) alive
+    # while we construct the new network, and then copy the params layer by layer,
+    # instead of having a copy of all params on the host. This needs device memory for both networks instead.
+    # The init_new_network_callback expects the values, thus we cannot stream in that case.
+    stream_params = (
+      self.config.bool("init_new_network_stream_params", False) and
+      not self.config.has("init_new_network_callback"))
+    start_time = time.time()
+    old_network_params = self.network.get_params_serialized(self.tf_session, lazy=stream_params)
+    transfer_time = time.time() - start_time
+    if stream_params:
+      self.tf_session = None  # such that _init_network does not close it
     self._init_network(net_desc)
     if self.is_pretrain_epoch() and not self.pretrain.copy_output_layer:
       # "ifpossible" logic handled below. copy_output_layer=True is currently not enforced.
@@ -1171,11 +1342,19 @@ class Engine(EngineBase):
     # In pretraining it can happen, that the dimension of output parameters of the previous epoch is
     # not equal to the dimension in the current epoch, due to difference in layer size.
     # In that case initialize output parameters randomly.
+    start_time = time.time()
     self.network.set_params_by_serialized(
       old_network_params, session=self.tf_session,
       ignore_wrong_shape=self.is_pretrain_epoch(),
       copy_param_mode=self.pretrain.copy_param_mode if self.is_pretrain_epoch() else None,
       ignore_non_existing=self.is_pretrain_epoch())
+    if old_network_params.session:
+      old_network_params.session.close()
+    from Util import human_bytes_size
+    print("Copied %s of params from the old network (%s) in %.3f sec." % (
+      human_bytes_size(old_network_params.get_num_bytes()),
+      "streamed from old session" if stream_params else "via host copy",
+      transfer_time + time.time() - start_time), file=log.v3)
 
   def train(self):
     """
@@ -1229,6 +1408,7 @@ class Engine(EngineBase):
       if self.epoch != self.final_epoch:
         print("Stopped after epoch %i and not %i as planned." % (self.epoch, self.final_epoch), file=log.v3)
 
+    self.wait_for_async_save()
     print("Finished training in epoch %i." % self.epoch, file=log.v3)
 
   def init_train_epoch(self):
@@ -1313,9 +1493,11 @@ class Engine(EngineBase):
         max_seqs=self.max_seqs,
         max_seq_length=self.max_seq_length,
         max_pad_size=self.max_pad_size,
+        bucket_boundaries=self.batch_bucket_boundaries,
         seq_drop=self.seq_drop,
         shuffle_batches=self.shuffle_batches,
-        used_data_keys=self.network.get_used_data_keys())
+        used_data_keys=self.network.get_used_data_keys(),
+        batch_plan_cache=self.batch_plan_cache)
     else:
       print("reusing previous dataset batch order for 'train' dataset", file=log.v4)
       self.dataset_batches['train'].reset()
@@ -1331,6 +1513,7 @@ class Engine(EngineBase):
     if not trainer.finalized:
       if trainer.device_crash_batch is not None:  # Otherwise we got an unexpected exception - a bug in our code.
         self.save_model(self.get_epoch_model_filename() + ".crash_%i" % trainer.device_crash_batch)
+        self.wait_for_async_save()
       print("Trainer not finalized, quitting.", file=log.v1)
       sys.exit(1)
 
@@ -1338,6 +1521,7 @@ class Engine(EngineBase):
       print("Model seems broken, got inf or nan final score: %s" % trainer.score, file=log.v1)
       if self.config.bool("stop_on_nonfinite_train_score", True):
         self.save_model(self.get_epoch_model_filename() + ".broken")
+        self.wait_for_async_save()
         sys.exit(1)
 
     should_call_graph_reset_callbacks = False
@@ -1552,7 +1736,8 @@ class Engine(EngineBase):
           batch_size=self.batch_size,
           max_seqs=self.max_seqs,
           max_seq_length=(self.max_seq_length if dataset_name == 'dev' else sys.maxsize),
-          used_data_keys=self.network.get_used_data_keys())
+          used_data_keys=self.network.get_used_data_keys(),
+          batch_plan_cache=self.batch_plan_cache)
       else:
         print("reusing previous dataset batch order for %r dataset" % dataset_name, file=log.v4)
         self.dataset_batches[dataset_name].reset()
@@ -1623,14 +1808,28 @@ class Engine(EngineBase):
     """
     if not self._do_save():
       return
-    from Util import CollectionReadCheckCovered, human_bytes_size, confirm
-    from itertools import count
-    opts = CollectionReadCheckCovered(self.config.get_of_type("cleanup_old_models", dict, {}))
-    existing_models = self.get_existing_models(config=self.config)
     if hasattr(self, "learning_rate_control"):
       lr_control = self.learning_rate_control
     else:
       lr_control = load_learning_rate_control_from_config(self.config)
+    # Copy the scores, as the cleanup might run in the background (while they are updated).
+    epoch_errors = {epoch: dict(data.error) for (epoch, data) in lr_control.epoch_data.items()}
+    if self._async_saver and not ask_for_confirmation:
+      # Do it after the pending model saving (such that the new model is taken into account),
+      # and also do the deletion in the background.
+      self._async_saver.add_job(lambda: self._cleanup_old_models(epoch_errors=epoch_errors))
+      return
+    self._cleanup_old_models(epoch_errors=epoch_errors, ask_for_confirmation=ask_for_confirmation)
+
+  def _cleanup_old_models(self, epoch_errors, ask_for_confirmation=False):
+    """
+    :param dict[int,dict[str,float]] epoch_errors: epoch -> scores, like in LearningRateControl.epoch_data
+    :param bool ask_for_confirmation: if True, will ask the user interactively to confirm
+    """
+    from Util import CollectionReadCheckCovered, human_bytes_size, confirm
+    from itertools import count
+    opts = CollectionReadCheckCovered(self.config.get_of_type("cleanup_old_models", dict, {}))
+    existing_models = self.get_existing_models(config=self.config)
     epochs = sorted(existing_models.keys())
     if not epochs:
       print("Cannot cleanup models, no models found.", file=log.v2)
@@ -1672,13 +1871,13 @@ class Engine(EngineBase):
     keep_epochs.update(epochs[-keep_last_n:])
     score_keys = set()  # e.g. "dev_error", "dev_score", etc.
     # Collect all possible score keys. Note that we could have different ones for different epochs.
-    for data in lr_control.epoch_data.values():
-      score_keys.update(data.error.keys())
+    for errors in epoch_errors.values():
+      score_keys.update(errors.keys())
     assert score_keys
     score_keys = sorted(score_keys)
     score_values = {key: [] for key in score_keys}
     for epoch in epochs:
-      epoch_scores = lr_control.epoch_data[epoch].error
+      epoch_scores = epoch_errors[epoch]
       for key in epoch_scores.keys():
         score_values[key].append(epoch_scores[key])
     for key in list(score_keys):
@@ -1692,7 +1891,7 @@ class Engine(EngineBase):
     worst_score_values = {key: max(scores) for (key, scores) in score_values.items()}
     for key in score_keys:
       scores = sorted([
-        (lr_control.epoch_data[epoch].error.get(key, worst_score_values[key]), epoch) for epoch in epochs])
+        (epoch_errors[epoch].get(key, worst_score_values[key]), epoch) for epoch in epochs])
       scores = scores[:keep_best_n]
       keep_epochs.update([v[1] for v in scores])
     keep_epochs.intersection_update(epochs)
@@ -1754,16 +1953,59 @@ class Engine(EngineBase):
     if self.config.is_true("use_horovod"):
       # noinspection PyPackageRequirements,PyUnresolvedReferences
       import horovod.tensorflow as hvd
-      batch_slice = slice(hvd.rank(), None, hvd.size())
+      batch_assignment = self.config.value("horovod_batch_assignment", "round_robin")
+      if batch_assignment == "round_robin":
+        batch_slice = slice(hvd.rank(), None, hvd.size())
+      elif batch_assignment == "cost_balanced":
+        batches = self._get_horovod_cost_balanced_batches(
+          dataset=dataset, batches=batches, rank=hvd.rank(), num_ranks=hvd.size())
+      else:
+        raise ValueError("invalid horovod_batch_assignment %r" % batch_assignment)
     from TFDataPipeline import FeedDictDataProvider
     data_provider = FeedDictDataProvider(
       tf_session=self.tf_session, extern_data=self.network.extern_data,
       data_keys=self.network.get_used_data_keys(),
       dataset=dataset, batches=batches,
       batch_slice=batch_slice,
+      num_workers=self.config.int("data_provider_num_workers", 0),
+      use_buffer_pool=self.config.bool("data_provider_buffer_pool", False),
       enforce_min_len1=self.config.is_true("enforce_min_len1", False))
     return data_provider
 
+  @staticmethod
+  def _get_horovod_cost_balanced_batches(dataset, batches, rank, num_ranks):
+    """
+    Every rank generates the same batch plan, so every rank can calculate the same assignment on its own.
+    See :func:`EngineBatch.assign_batches_by_cost`.
+
+    :param Dataset.Dataset dataset:
+    :param BatchSetGenerator batches: the whole batch plan (for all ranks)
+    :param int rank:
+    :param int num_ranks:
+    :return: the batches for this rank
+    :rtype: BatchSetGenerator
+    """
+    from EngineBatch import assign_batches_by_cost, get_ranks_utilization
+    if not dataset.supports_random_access():
+      raise Exception(
+        "horovod_batch_assignment 'cost_balanced': the batches of a rank are not in seq order, "
+        "thus the dataset needs to support random access (e.g. HDFDataset), but %r does not. "
+        "Use horovod_batch_assignment 'round_robin' for this dataset." % dataset)
+    all_batches = batches.read_all()
+    assignment = assign_batches_by_cost(all_batches, num_ranks=num_ranks)
+    round_robin = [list(range(r, len(all_batches), num_ranks)) for r in range(num_ranks)]
+    utilization = get_ranks_utilization(all_batches, assignment)
+    print("Horovod cost balanced batch assignment for %r: %i batches, %i steps per rank, %i batches unused." % (
+      dataset.name, len(all_batches), len(assignment[0]), len(all_batches) - sum(map(len, assignment))), file=log.v4)
+    print("  estimated utilization per rank: %s (round robin: %s)" % (
+      ", ".join(["%.1f%%" % (u * 100.) for u in utilization]),
+      ", ".join(["%.1f%%" % (u * 100.) for u in get_ranks_utilization(all_batches, round_robin)])), file=log.v4)
+    rank_batches = BatchSetGenerator(
+      dataset=dataset, generator=iter([all_batches[i] for i in assignment[rank]]), shuffle_batches=False)
+    rank_batches.read_all()
+    rank_batches.reset()  # now the cache is complete, which gives a correct completed_frac()
+    return rank_batches
+
   def get_specific_feed_dict(self, dataset, seq_idx):
     """
     :param Dataset.Dataset dataset:
@@ -1872,7 +2114,11 @@ class Engine(EngineBase):
     else:
       assert not os.path.exists(output_file)
     print("Forward output:", output, file=log.v3)
-    writer = SimpleHDFWriter(filename=output_file, dim=output.dim, ndim=output.ndim, labels=labels)
+    writer = SimpleHDFWriter(
+      filename=output_file, dim=output.dim, ndim=output.ndim, labels=labels,
+      buffer_num_frames=self.config.int("forward_hdf_buffer_num_frames", 0) or None,
+      async_flush=self.config.bool("forward_hdf_async_flush", False),
+      compression=self.config.value("forward_hdf_compression", None))
 
     def extra_fetches_cb(inputs, seq_tag, **kwargs):
       """
@@ -1899,7 +2145,8 @@ class Engine(EngineBase):
       recurrent_net=self.network.recurrent,
       batch_size=batch_size,
       max_seqs=self.max_seqs,
-      used_data_keys=self.network.get_used_data_keys())
+      used_data_keys=self.network.get_used_data_keys(),
+      batch_plan_cache=self.batch_plan_cache)
     forwarder = Runner(
       engine=self, dataset=data, batches=batches,
       train=False, eval=False,
@@ -1944,7 +2191,8 @@ class Engine(EngineBase):
       batch_size=batch_size,
       max_seqs=max_seqs,
       max_seq_length=max_seq_length,
-      used_data_keys=self.network.get_used_data_keys())
+      used_data_keys=self.network.get_used_data_keys(),
+      batch_plan_cache=self.batch_plan_cache)
     analyzer = Runner(engine=self, dataset=data, batches=batches, train=False)
     analyzer.run(report_prefix=self.get_epoch_str() + " analyze")
 
@@ -1964,15 +2212,18 @@ class Engine(EngineBase):
       sys.exit(1)
     return analyzer
 
-  def search(self, dataset, do_eval=True, output_layer_names="output", output_file=None, output_file_format="txt"):
+  def search(self, dataset, do_eval=True, output_layer_names="output", output_file=None, output_file_format="txt",
+             output_file_resume=False):
     """
     :param Dataset dataset:
     :param bool do_eval: calculate errors. can only be done if we have the reference target
     :param str|list[str] output_layer_names:
     :param str output_file:
     :param str output_file_format: "txt" or "py"
+    :param bool output_file_resume: if output_file exists, skip the seqs which are already written there
     """
     from TFNetworkLayer import LayerBase
+    from EngineUtil import SearchOutputWriter
     print("Search with network on %r." % dataset, file=log.v1)
     if not self.use_search_flag or not self.network or self.use_dynamic_train_flag:
       self.use_search_flag = True
@@ -1999,13 +2250,46 @@ class Engine(EngineBase):
     assert not max_seq_length, (
       "Set max_seq_length = 0 for search (i.e. no maximal length). We want to keep all source sentences.")
 
+    output_writer = None  # type: typing.Optional[SearchOutputWriter]
+    if output_file:
+      assert output_file_format in {"txt", "py"}
+      if isinstance(output_layer_names, list):
+        assert output_file_format == "py", "Text format not supported in the case of multiple output layers."
+      print("Will write outputs to: %s" % output_file, file=log.v2)
+      output_writer = SearchOutputWriter(
+        filename=output_file, output_format=output_file_format, resume=output_file_resume)
+      done_seq_tags = output_writer.get_done_seq_tags(dataset)
+      if done_seq_tags:
+        # Skip them already in the seq order, such that we do not waste time on them.
+        # The output writer also skips them, in case the dataset does not support seq_tags_filter.
+        try:
+          seq_tags_filter = dataset.seq_tags_filter or set(dataset.get_all_tags())
+        except NotImplementedError:
+          seq_tags_filter = None
+        if seq_tags_filter is not None:
+          dataset.seq_tags_filter = seq_tags_filter - done_seq_tags
+          if not dataset.seq_tags_filter:
+            print("All seqs are already in the search output file, nothing to do.", file=log.v1)
+            output_writer.close()
+            return
+
     dataset.init_seq_order(epoch=self.epoch)
+    if output_writer:
+      if dataset.have_corpus_seq_idx():
+        # Write the seqs in the order of the corpus.
+        output_writer.set_order(sorted(
+          dataset.get_corpus_seq_idx(seq_idx) for seq_idx in range(dataset.num_seqs)))
+      else:
+        # Only valid with seq_ordering "default", where the seq idx is the order of the corpus.
+        # Otherwise get_corpus_seq_idx() below asserts, as it did before the output writer.
+        output_writer.set_order(None)
     batches = dataset.generate_batches(
       recurrent_net=self.network.recurrent,
       batch_size=self.config.int('batch_size', 1),
       max_seqs=self.config.int('max_seqs', -1),
       max_seq_length=max_seq_length,
-      used_data_keys=self.network.get_used_data_keys())
+      used_data_keys=self.network.get_used_data_keys(),
+      batch_plan_cache=self.batch_plan_cache)
 
     output_is_dict = isinstance(output_layer_names, list)
     if not output_is_dict:
@@ -2031,19 +2315,8 @@ class Engine(EngineBase):
       out_beam_sizes.append(out_beam.beam_size if out_beam else None)
       target_keys.append(output_layer.target or self.network.extern_data.default_target)
 
-    out_cache = None
-    seq_idx_to_tag = {}
-    if output_file:
-      assert output_file_format in {"txt", "py"}
-      if output_is_dict:
-        assert output_file_format == "py", "Text format not supported in the case of multiple output layers."
+    if output_writer:
       assert all(dataset.can_serialize_data(target_key) for target_key in target_keys)
-      assert not os.path.exists(output_file)
-      print("Will write outputs to: %s" % output_file, file=log.v2)
-      output_file = open(output_file, "w")
-      # corpus-seq-idx -> str|list[(float,str)]|dict[str -> str|list[(float,str)]],
-      # depending on output_is_dict and whether output is after decision
-      out_cache = {}
     if not log.verbose[4]:
       print("Set log_verbosity to level 4 or higher to see seq info on stdout.", file=log.v2)
 
@@ -2082,13 +2355,9 @@ class Engine(EngineBase):
           outputs[target_idx] = bytearray(outputs[target_idx]).decode("utf8")
 
       for batch_idx in range(len(seq_idx)):
-        corpus_seq_idx = None
-        if out_cache is not None:
-          corpus_seq_idx = dataset.get_corpus_seq_idx(seq_idx[batch_idx])
-          assert corpus_seq_idx not in out_cache
-          seq_idx_to_tag[corpus_seq_idx] = seq_tag[batch_idx]
-          if output_is_dict:
-            out_cache[corpus_seq_idx] = {}
+        # str|list[(float,str)]|dict[str -> str|list[(float,str)]],
+        # depending on output_is_dict and whether output is after decision
+        out_data = {} if output_is_dict else None
 
         # noinspection PyShadowingNames
         for target_idx in range(num_targets):
@@ -2103,36 +2372,37 @@ class Engine(EngineBase):
               outputs[target_idx][batch_idx * out_beam_sizes[target_idx]:(batch_idx + 1)*out_beam_sizes[target_idx]]),
                   file=log.v4)
             out_idx = batch_idx * out_beam_sizes[target_idx]
-          if target_keys[target_idx] and dataset.can_serialize_data(target_keys[target_idx]):
-            print("  ref:", dataset.serialize_data(key=target_keys[target_idx], data=targets[target_idx][batch_idx]),
-                  file=log.v4)
+          if (
+                (output_writer or log.verbose[4]) and
+                target_keys[target_idx] and dataset.can_serialize_data(target_keys[target_idx])):
+            # Serialize each hyp only once, and only if we need it.
             if out_beam_sizes[target_idx] is None:
-              print("  hyp:", dataset.serialize_data(key=target_keys[target_idx], data=outputs[target_idx][out_idx]),
-                    file=log.v4)
+              target_out_data = dataset.serialize_data(key=target_keys[target_idx], data=outputs[target_idx][out_idx])
             else:
               assert beam_scores[target_idx] is not None
-              for beam_idx in range(out_beam_sizes[target_idx]):
-                print(
-                  "  hyp %i, score %f:" % (beam_idx, beam_scores[target_idx][batch_idx][beam_idx]),
-                  dataset.serialize_data(key=target_keys[target_idx], data=outputs[target_idx][out_idx + beam_idx]),
-                  file=log.v4)
-
-            if out_cache is not None:
+              target_out_data = [
+                (beam_scores[target_idx][batch_idx][beam_idx],
+                 dataset.serialize_data(key=target_keys[target_idx], data=outputs[target_idx][out_idx + beam_idx]))
+                for beam_idx in range(out_beam_sizes[target_idx])]
+            if log.verbose[4]:
+              print("  ref:", dataset.serialize_data(key=target_keys[target_idx], data=targets[target_idx][batch_idx]),
+                    file=log.v4)
               if out_beam_sizes[target_idx] is None:
-                  out_data = dataset.serialize_data(key=target_keys[target_idx], data=outputs[target_idx][out_idx])
+                print("  hyp:", target_out_data, file=log.v4)
               else:
-                assert beam_scores[target_idx] is not None
-                out_data = [
-                    (beam_scores[target_idx][batch_idx][beam_idx],
-                     dataset.serialize_data(key=target_keys[target_idx], data=outputs[target_idx][out_idx + beam_idx]))
-                    for beam_idx in range(out_beam_sizes[target_idx])]
-
-              if output_is_dict:
-                assert output_layer_names[target_idx] not in out_cache[corpus_seq_idx]
-                out_cache[corpus_seq_idx][output_layer_names[target_idx]] = out_data
-              else:
-                assert corpus_seq_idx not in out_cache
-                out_cache[corpus_seq_idx] = out_data
+                for beam_idx, (score, hyp) in enumerate(target_out_data):
+                  print("  hyp %i, score %f:" % (beam_idx, score), hyp, file=log.v4)
+
+            if output_is_dict:
+              assert output_layer_names[target_idx] not in out_data
+              out_data[output_layer_names[target_idx]] = target_out_data
+            else:
+              out_data = target_out_data
+
+        if output_writer:
+          # Asserts have_corpus_seq_idx() if the seq ordering is not "default".
+          output_writer.write(
+            key=dataset.get_corpus_seq_idx(seq_idx[batch_idx]), seq_tag=seq_tag[batch_idx], output=out_data)
 
     train = self._maybe_prepare_train_in_eval(targets_via_search=True)
 
@@ -2158,22 +2428,8 @@ class Engine(EngineBase):
       sys.exit(1)
     print("Search done. Num steps %i, Final: score %s error %s" % (
       runner.num_steps, self.format_score(runner.score), self.format_score(runner.error)), file=log.v1)
-    if output_file:
-      assert out_cache
-      assert 0 in out_cache
-      assert len(out_cache) - 1 in out_cache
-      if output_file_format == "txt":
-        for i in range(len(out_cache)):
-          output_file.write("%s\n" % out_cache[i])
-      elif output_file_format == "py":
-        from Util import better_repr
-        output_file.write("{\n")
-        for i in range(len(out_cache)):
-          output_file.write("%r: %s,\n" % (seq_idx_to_tag[i], better_repr(out_cache[i])))
-        output_file.write("}\n")
-      else:
-        raise Exception("invalid output_file_format %r" % output_file_format)
-      output_file.close()
+    if output_writer:
+      output_writer.close()
 
   def search_single(self, dataset, seq_idx, output_layer_name=None):
     """
@@ -2312,7 +2568,8 @@ class Engine(EngineBase):
       batch_size=batch_size,
       max_seq_length=max_seq_length,
       max_seqs=max_seqs,
-      used_data_keys=self.network.get_used_data_keys())
+      used_data_keys=self.network.get_used_data_keys(),
+      batch_plan_cache=self.batch_plan_cache)
     forwarder = Runner(
       engine=self, dataset=dataset, batches=batches,
       train=False, eval=False,
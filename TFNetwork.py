@@ -11,6 +11,13 @@ import re
 import numpy
 import contextlib
 import typing
+from threading import Thread
+try:
+  # noinspection PyCompatibility
+  from Queue import Queue
+except ImportError:
+  # noinspection PyCompatibility
+  from queue import Queue
 from Log import log
 from TFNetworkLayer import LayerBase, get_layer_class
 import TFUtil
@@ -1295,10 +1302,14 @@ class TFNetwork(object):
       layers[layer.name] = layer.get_param_values_dict(session)
     return layers
 
-  def set_param_values_by_dict(self, values_dict, ignore_non_existing=False, **kwargs):
+  def set_param_values_by_dict(self, values_dict, ignore_non_existing=False, source_session=None, **kwargs):
     """
-    :param dict[str,dict[str,numpy.ndarray]] values_dict:
+    :param dict[str,dict[str,numpy.ndarray|tf.Variable]] values_dict:
     :param bool ignore_non_existing:
+    :param tf.Session|None source_session: if given, values_dict contains the variables of another network,
+      and their values are fetched from this session layer by layer (one session run per layer),
+      right before they are set.
+      Thus at most the values of a single layer are on the host at any time.
     :param kwargs: passed to :func:`LayerBase.set_param_values_by_dict`
 
     Note that this excludes auxiliary params.
@@ -1309,6 +1320,8 @@ class TFNetwork(object):
         if ignore_non_existing and layer_name not in layers:
           print("Will not set layer %r because it does not exist." % (layer_name,), file=log.v3)
           continue
+        if source_session:
+          layer_values_dict = source_session.run(layer_values_dict)  # all params of the layer in one run
         layers[layer_name].set_param_values_by_dict(values_dict=layer_values_dict, **kwargs)
 
   def get_auxiliary_params(self):
@@ -1317,11 +1330,19 @@ class TFNetwork(object):
     """
     return [self.global_train_step]
 
-  def get_params_serialized(self, session):
+  def get_params_serialized(self, session, lazy=False):
     """
     :param tf.Session session:
+    :param bool lazy: if True, do not fetch the values now, but only keep references to the variables.
+      The values are fetched when they are set (:func:`set_params_by_serialized`),
+      thus the session (and its graph) must be kept alive until then.
     :rtype: TFNetworkParamsSerialized
     """
+    if lazy:
+      return TFNetworkParamsSerialized(
+        values_dict={layer.name: layer.get_saveable_params_dict() for layer in self._get_all_layers()},
+        global_train_step=self.get_global_train_step(session=session),
+        session=session)
     return TFNetworkParamsSerialized(
       values_dict=self.get_param_values_dict(session=session),
       global_train_step=self.get_global_train_step(session=session))
@@ -1332,7 +1353,8 @@ class TFNetwork(object):
     :param tf.Session session:
     :param kwargs: passed to :func:`set_param_values_by_dict`
     """
-    self.set_param_values_by_dict(serialized.values_dict, session=session, **kwargs)
+    self.set_param_values_by_dict(
+      serialized.values_dict, session=session, source_session=serialized.session, **kwargs)
     self.set_global_train_step(serialized.global_train_step, session=session)
 
   def set_global_train_step(self, step, session):
@@ -1376,13 +1398,14 @@ class TFNetwork(object):
       self.saver = tf.train.Saver(
         var_list=self.get_saveable_params_list(), max_to_keep=2 ** 31 - 1)
 
-  def save_params_to_file(self, filename, session):
+  def save_params_to_file(self, filename, session, async_saver=None):
     """
     Will save the model parameters to the filename.
     Note that the model parameters live inside the current TF session.
 
     :param str filename:
     :param tf.Session session:
+    :param AsyncCheckpointSaver|None async_saver: if given, the file will be written in the background
     """
     import os
     filename = os.path.abspath(filename)  # TF needs absolute path
@@ -1390,6 +1413,9 @@ class TFNetwork(object):
     maybe_make_dirs(os.path.dirname(filename))
     if not self.saver:
       self._create_saver()
+    if async_saver:
+      async_saver.save(saver=self.saver, session=session, filename=filename)
+      return
     # We add some extra logic to try again for DiskQuota and other errors.
     # This could save us multiple hours of computation.
     try_again_wait_time = 10
@@ -1933,14 +1959,33 @@ class TFNetwork(object):
 class TFNetworkParamsSerialized(object):
   """
   Holds all the params as numpy arrays, including auxiliary params.
+  If ``session`` is set, ``values_dict`` instead holds the variables (of the graph of this session),
+  and the values are only fetched when needed. See :func:`TFNetwork.get_params_serialized`.
   """
-  def __init__(self, values_dict, global_train_step):
+  def __init__(self, values_dict, global_train_step, session=None):
     """
-    :param dict[str,dict[str,numpy.ndarray]] values_dict: dict: layer_name -> param_name -> variable numpy array
+    :param dict[str,dict[str,numpy.ndarray|tf.Variable]] values_dict:
+      dict: layer_name -> param_name -> variable numpy array (or variable if session is set)
     :param int global_train_step:
+    :param tf.Session|None session:
     """
     self.values_dict = values_dict
     self.global_train_step = global_train_step
+    self.session = session
+
+  def get_num_bytes(self):
+    """
+    :return: size of all the param values in bytes
+    :rtype: int
+    """
+    num_bytes = 0
+    for layer_values_dict in self.values_dict.values():
+      for value in layer_values_dict.values():
+        if isinstance(value, numpy.ndarray):
+          num_bytes += value.nbytes
+        elif isinstance(value, tf.Variable):
+          num_bytes += value.get_shape().num_elements() * value.dtype.base_dtype.size
+    return num_bytes
 
 
 class LossHolder:
@@ -3030,6 +3075,147 @@ class CustomCheckpointLoader:
       set_custom_post_init(var=var, func=make_var_post_init(var))
 
 
+class AsyncCheckpointSaver(object):
+  """
+  Saves checkpoints in a background thread.
+  In :func:`save`, the values of all saved variables are copied to host memory (that is the only blocking part),
+  and then the checkpoint is written in the background, while the training can continue.
+  The files are written under a temporary name and then renamed, the ``.index`` file at the very end,
+  such that other processes (or a restarted training) never see an incomplete checkpoint.
+  The result is the same as via ``tf.train.Saver.save``, except that the ``checkpoint`` state file is not updated.
+
+  Other file operations which should happen after the saving (e.g. cleaning up old models)
+  can be scheduled via :func:`add_job`. Everything is executed in order.
+  If :func:`save` is called while the previous save is still in progress, it will wait for it.
+  """
+
+  def __init__(self):
+    self.queue = None  # type: typing.Optional[Queue]
+    self.thread = None  # type: typing.Optional[Thread]
+    self.exception = None  # type: typing.Optional[BaseException]
+
+  def add_job(self, func):
+    """
+    :param ()->None func: will be called in the background thread
+    """
+    self._check_exception()
+    if not self.thread:
+      self.queue = Queue()
+      self.thread = Thread(target=self._thread_main, name="AsyncCheckpointSaver")
+      self.thread.daemon = True
+      self.thread.start()
+    self.queue.put(func)
+
+  def _thread_main(self):
+    while True:
+      func = self.queue.get()
+      try:
+        if self.exception is None:  # after an exception, skip all remaining jobs
+          func()
+      except BaseException as exc:
+        print("AsyncCheckpointSaver: exception %r" % exc, file=log.v1)
+        sys.excepthook(*sys.exc_info())
+        self.exception = exc
+      finally:
+        self.queue.task_done()
+
+  def _check_exception(self):
+    """
+    Re-raises the exception from the background thread, if there was one.
+    """
+    if self.exception is not None:
+      exc, self.exception = self.exception, None
+      raise exc
+
+  def wait(self):
+    """
+    Waits until all scheduled jobs are done.
+    """
+    if self.queue:
+      self.queue.join()
+    self._check_exception()
+
+  def is_busy(self):
+    """
+    :rtype: bool
+    """
+    return bool(self.queue) and self.queue.unfinished_tasks > 0
+
+  @staticmethod
+  def _get_save_op(saver, graph):
+    """
+    :param tf.train.Saver saver:
+    :param tf.Graph graph:
+    :return: the SaveV2 op of the saver, which has the inputs (prefix, tensor_names, shape_and_slices, *tensors)
+    :rtype: tf.Operation
+    """
+    save_tensor = graph.get_tensor_by_name(saver.saver_def.save_tensor_name)
+    # The save tensor is the filename, with a control dependency on the actual save op.
+    save_ops = [op for op in save_tensor.op.control_inputs if op.type == "SaveV2"]
+    assert len(save_ops) == 1, "unexpected saver %r (sharded?), save tensor %r" % (saver, save_tensor)
+    return save_ops[0]
+
+  def save(self, saver, session, filename):
+    """
+    :param tf.train.Saver saver:
+    :param tf.Session session:
+    :param str filename: absolute filename prefix, like for ``saver.save``
+    """
+    import os
+    self.wait()  # only one snapshot in memory at a time
+    save_op = self._get_save_op(saver, graph=session.graph)
+    tensor_names, shape_and_slices, values = session.run(
+      (save_op.inputs[1], save_op.inputs[2], list(save_op.inputs[3:])))
+    tmp_filename = "%s.tmp-%i" % (filename, os.getpid())
+    saver.export_meta_graph(tmp_filename + ".meta")  # the graph can change later, thus do it now
+    self.add_job(lambda: self._write(
+      tensor_names=tensor_names, shape_and_slices=shape_and_slices, values=values,
+      tmp_filename=tmp_filename, filename=filename))
+
+  @staticmethod
+  def _write(tensor_names, shape_and_slices, values, tmp_filename, filename):
+    """
+    :param numpy.ndarray tensor_names:
+    :param numpy.ndarray shape_and_slices:
+    :param list[numpy.ndarray] values:
+    :param str tmp_filename: prefix
+    :param str filename: prefix
+    """
+    import os
+    from glob import glob
+    from tensorflow.python.ops import io_ops
+    # Use a separate graph and session, independent from the (training) graph, which can change in the meantime.
+    with tf.Graph().as_default() as graph:
+      prefix_placeholder = tf.placeholder(tf.string, shape=(), name="prefix")
+      value_placeholders = [
+        tf.placeholder(tf.as_dtype(value.dtype), shape=value.shape, name="value_%i" % i)
+        for (i, value) in enumerate(values)]
+      save_op = io_ops.save_v2(
+        prefix_placeholder, tf.constant(tensor_names), tf.constant(shape_and_slices), value_placeholders)
+      feed_dict = dict(zip(value_placeholders, values))
+      feed_dict[prefix_placeholder] = tmp_filename
+      with tf.Session(graph=graph, config=tf.ConfigProto(device_count={"GPU": 0})) as session:
+        # Like TFNetwork.save_params_to_file, try again for DiskQuota and other errors.
+        try_again_wait_time = 10
+        while True:
+          try:
+            session.run(save_op, feed_dict=feed_dict)
+            break
+          except (IOError, tf.errors.ResourceExhaustedError, tf.errors.UnavailableError) as exc:
+            import errno
+            import time
+            if not isinstance(exc, IOError) or exc.errno in [errno.EBUSY, errno.EDQUOT, errno.EIO, errno.ENOSPC]:
+              print("Exception while saving:", exc, file=log.v3)
+              print("Trying again in %s secs." % try_again_wait_time, file=log.v3)
+              time.sleep(try_again_wait_time)
+              continue
+            raise
+    # The index file comes last. Only when it exists, the checkpoint is considered to be complete.
+    for tmp_fn in sorted(glob(tmp_filename + ".data-*")) + [tmp_filename + ".meta", tmp_filename + ".index"]:
+      os.rename(tmp_fn, filename + tmp_fn[len(tmp_filename):])
+    print("Saved model %s (async)." % filename, file=log.v4)
+
+
 def set_custom_post_init(var, func):
   """
   It registers the provided `func` such that it gets called for this variable
@@ -9813,25 +9813,50 @@ def get_loss_class(loss):
   return _LossClassDict[loss]
 
 
-_LayerClassDictInitialized = False
+_LayerClassDictInitialized = False  # whether all the layer class modules are registered
 _LayerClassDict = {}  # type: typing.Dict[str,typing.Type[LayerBase]]
+_LayerClassModules = ["TFNetworkRecLayer", "TFNetworkSigProcLayer", "TFNetworkSegModLayer", "TFNetworkNeuralTransducer"]
+_LayerClassModulesRegistered = set()  # type: typing.Set[str]  # this module and from _LayerClassModules
 
 
-def _init_layer_class_dict():
+def _init_layer_class_dict(name=None):
+  """
+  Registers the layer classes of this module, and of the other layer modules (_LayerClassModules).
+  If a name is given, this is lazy, and only the module which defines this layer class is imported,
+  such that we only import what is actually used by the network.
+
+  :param str|None name: layer class name. if None, registers all layer classes
+  """
   global _LayerClassDictInitialized
+  if __name__ not in _LayerClassModulesRegistered:
+    _LayerClassModulesRegistered.add(__name__)
+    auto_register_layer_classes(list(globals().values()))
+    for alias, v in {"forward": LinearLayer, "hidden": LinearLayer}.items():
+      assert alias not in _LayerClassDict
+      _LayerClassDict[alias] = v
+  if name is not None:
+    if name in _LayerClassDict:
+      return
+    from Util import get_module_source_names
+    mod_name = get_module_source_names(_LayerClassModules, r'^\s+layer_class = "([^"]+)"').get(name)
+    if mod_name:
+      _register_layer_class_module(mod_name)
+      if name in _LayerClassDict:
+        return
   _LayerClassDictInitialized = True
-  import TFNetworkRecLayer
-  import TFNetworkSigProcLayer
-  import TFNetworkSegModLayer
-  import TFNetworkNeuralTransducer
+  for mod_name in _LayerClassModules:
+    _register_layer_class_module(mod_name)
 
-  auto_register_layer_classes(list(globals().values()))
-  for mod in [TFNetworkRecLayer, TFNetworkSigProcLayer, TFNetworkSegModLayer, TFNetworkNeuralTransducer]:
-    auto_register_layer_classes(list(vars(mod).values()))
 
-  for alias, v in {"forward": LinearLayer, "hidden": LinearLayer}.items():
-    assert alias not in _LayerClassDict
-    _LayerClassDict[alias] = v
+def _register_layer_class_module(mod_name):
+  """
+  :param str mod_name: e.g. "TFNetworkRecLayer"
+  """
+  if mod_name in _LayerClassModulesRegistered:
+    return
+  _LayerClassModulesRegistered.add(mod_name)
+  from importlib import import_module
+  auto_register_layer_classes(import_module(mod_name))
 
 
 def auto_register_layer_classes(vars_values):
@@ -9874,8 +9899,8 @@ def get_layer_class(name):
   :param str name: matches layer_class
   :rtype: (() -> LayerBase) | type[LayerBase] | LayerBase
   """
-  if not _LayerClassDictInitialized:
-    _init_layer_class_dict()
+  if name not in _LayerClassDict and not _LayerClassDictInitialized:
+    _init_layer_class_dict(name=name)
   if name not in _LayerClassDict:
     raise Exception("unknown layer class %r" % name)
   return _LayerClassDict[name]
@@ -10,7 +10,6 @@ from __future__ import division
 import subprocess
 from subprocess import CalledProcessError
 
-import h5py
 from collections import deque
 import inspect
 import os
@@ -429,6 +428,7 @@ def hdf5_dimension(filename, dimension):
   :param str dimension:
   :rtype: numpy.ndarray|int
   """
+  import h5py
   fin = h5py.File(filename, "r")
   if '/' in dimension:
     res = fin['/'.join(dimension.split('/')[:-1])].attrs[dimension.split('/')[-1]]
@@ -444,6 +444,7 @@ def hdf5_group(filename, dimension):
   :param str dimension:
   :rtype: dict[str]
   """
+  import h5py
   fin = h5py.File(filename, "r")
   res = {k: fin[dimension].attrs[k] for k in fin[dimension].attrs}
   fin.close()
@@ -456,6 +457,7 @@ def hdf5_shape(filename, dimension):
   :param dimension:
   :rtype: tuple[int]
   """
+  import h5py
   fin = h5py.File(filename, "r")
   res = fin[dimension].shape
   fin.close()
@@ -474,6 +476,7 @@ def hdf5_strings(handle, name, data):
     dset = handle.create_dataset(name, (len(data),), dtype="S" + str(s))
     dset[...] = data
   except Exception:
+    import h5py
     # noinspection PyUnresolvedReferences
     dt = h5py.special_dtype(vlen=unicode)
     del handle[name]
@@ -1050,7 +1053,7 @@ def init_thread_join_hack():
       # them for delayed handling to the main thread which hangs.
       # See CPython signalmodule.c.
       # Currently the best solution I can think of:
-      while thread_obj.isAlive():
+      while thread_obj.is_alive():
         join_orig(thread_obj, timeout=0.1)
     elif thread.get_ident() == main_thread_id and timeout > 0.1:
       # Limit the timeout. This should not matter for the underlying code.
@@ -1730,9 +1733,23 @@ class NumbersDict:
     if result is None:
       result = NumbersDict()
     assert isinstance(result, NumbersDict)
-    for k in self.keys_set | other.keys_set:
-      result[k] = cls.bin_op_scalar_optional(self.get(k, None), other.get(k, None), zero=zero, op=op)
-    result.value = cls.bin_op_scalar_optional(self.value, other.value, zero=zero, op=op)
+    # This is performance critical, e.g. in Dataset._generate_batches, thus we directly access the dicts.
+    # Note that self.get(k, None) == self.dict.get(k, self.value).
+    self_dict, self_value = self.dict, self.value
+    other_dict, other_value = other.dict, other.value
+    if self_dict.keys() == other_dict.keys():  # common case
+      keys = list(self_dict.keys())
+    else:
+      keys = list(set(self_dict.keys()) | set(other_dict.keys()))
+    res_dict = result.dict
+    for k in keys:
+      a = self_dict.get(k, self_value)
+      b = other_dict.get(k, other_value)
+      if a is not None and b is not None:
+        res_dict[k] = op(a, b)
+      else:
+        res_dict[k] = cls.bin_op_scalar_optional(a, b, zero=zero, op=op)
+    result.value = cls.bin_op_scalar_optional(self_value, other_value, zero=zero, op=op)
     return result
 
   def __add__(self, other):
@@ -1843,20 +1860,28 @@ class NumbersDict:
     :param ((object,object)->True) cmp:
     :rtype: True
     """
-    for key in self.keys():
-      if key in other.keys():
-        if cmp(self[key], other[key]):
+    other_dict, other_value = other.dict, other.value
+    for key, value in self.dict.items():
+      if key in other_dict:
+        if cmp(value, other_dict[key]):
           return True
-      elif other.value is not None:
-        if cmp(self[key], other.value):
+      elif other_value is not None:
+        if cmp(value, other_value):
           return True
-    if self.value is not None and other.value is not None:
-      if cmp(self.value, other.value):
+    if self.value is not None and other_value is not None:
+      if cmp(self.value, other_value):
         return True
     return False
 
   @staticmethod
   def _max(*args):
+    if len(args) == 2:  # common case, fast path
+      a, b = args
+      if a is None:
+        return b
+      if b is None:
+        return a
+      return max(a, b)
     args = [a for a in args if a is not None]
     if not args:
       return None
@@ -1866,6 +1891,13 @@ class NumbersDict:
 
   @staticmethod
   def _min(*args):
+    if len(args) == 2:  # common case, fast path
+      a, b = args
+      if a is None:
+        return b
+      if b is None:
+        return a
+      return min(a, b)
     args = [a for a in args if a is not None]
     if not args:
       return None
@@ -3062,6 +3094,7 @@ class NativeCodeCompiler(object):
   """
 
   CacheDirName = "returnn_native"
+  CacheDirRoot = None  # type: typing.Optional[str]  # see get_cache_dir_root()
   CollectedCompilers = None  # type: None|typing.List[NativeCodeCompiler]
 
   def __init__(self, base_name, code_version, code,
@@ -3089,7 +3122,7 @@ class NativeCodeCompiler(object):
     if self.CollectedCompilers is not None:
       self.CollectedCompilers.append(self)
     self.verbose = verbose
-    self.cache_dir = "%s/%s" % (get_temp_dir(), self.CacheDirName)
+    self.cache_dir = "%s/%s" % (self.get_cache_dir_root(), self.CacheDirName)
     self._include_paths = list(include_paths)
     self.base_name = base_name
     self.code_version = code_version
@@ -3113,6 +3146,19 @@ class NativeCodeCompiler(object):
   def __repr__(self):
     return "<%s %r in %r>" % (self.__class__.__name__, self.base_name, self._mod_path)
 
+  @staticmethod
+  def get_cache_dir_root():
+    """
+    The op dirs in the cache are content-addressed (by the hash of the code and all compile options),
+    and the compilation is synchronized via :class:`LockFile`.
+    Thus the cache dir can also be shared (e.g. on a network file system) across nodes, containers and jobs
+    (see config option ``native_op_cache_dir`` and ``tools/compile_native_op.py``).
+
+    :return: NativeCodeCompiler.CacheDirRoot, or env RETURNN_NATIVE_CACHE_DIR, or get_temp_dir()
+    :rtype: str
+    """
+    return NativeCodeCompiler.CacheDirRoot or os.environ.get("RETURNN_NATIVE_CACHE_DIR") or get_temp_dir()
+
   @property
   def _mod_path(self):
     return "%s/%s/%s" % (self.cache_dir, self.base_name, self.static_version_name or self._hash[:10])
@@ -3159,7 +3205,8 @@ class NativeCodeCompiler(object):
       if not os.path.exists(so_path):
         self._cleanup_old_path(full_dir_path, reason="corrupt dir, missing so")
         continue
-      dt = time.time() - os.path.getmtime(so_path)
+      # The info file gets touched whenever the op is used (see _maybe_compile).
+      dt = time.time() - max(os.path.getmtime(so_path), os.path.getmtime(info_path))
       if dt > cleanup_time_limit_secs:
         self._cleanup_old_path(full_dir_path, reason="%s old" % hms(dt))
 
@@ -3261,6 +3308,10 @@ class NativeCodeCompiler(object):
       if os.path.exists(self._mod_path):
         self._cleanup_old_path(self._mod_path, reason="need recompile")
     with lock:
+      # Another process might have compiled it in the meantime (e.g. with a shared cache dir).
+      if not self._need_recompile():
+        os.utime(self._info_filename, None)
+        return
       self._maybe_compile_inner()
 
   def _get_compiler_bin(self):
@@ -3309,7 +3360,9 @@ class NativeCodeCompiler(object):
     common_opts += ["-D_GLIBCXX_USE_CXX11_ABI=%i" % (1 if self.use_cxx11_abi else 0)]
     common_opts += ["-D%s=%s" % item for item in sorted(self.c_macro_defines.items())]
     common_opts += ["-g"]
-    opts = common_opts + [self._c_filename, "-o", self._so_filename]
+    # Compile to a temporary file and then rename it, such that other processes never see an incomplete lib.
+    tmp_so_filename = "%s/%s.tmp-%i.so" % (self._mod_path, self.base_name, os.getpid())
+    opts = common_opts + [self._c_filename, "-o", tmp_so_filename]
     opts += list(map(self._transform_ld_flag, self.ld_flags))
     cmd_bin = self._get_compiler_bin()
     cmd_args = [cmd_bin] + opts
@@ -3327,13 +3380,14 @@ class NativeCodeCompiler(object):
         print("This might be the error: https://github.com/tensorflow/tensorflow/issues/22766")
         print()
       raise CalledProcessError(returncode=proc.returncode, cmd=cmd_args)
-    assert os.path.exists(self._so_filename)
+    assert os.path.exists(tmp_so_filename)
     with open("%s/compile.log" % self._mod_path, "wb") as f:
       if self.verbose:
         print("%s: write compile log to: %s" % (self.__class__.__name__, f.name))
       f.write(("+ %s\n" % " ".join(cmd_args)).encode("utf8"))
       f.write(stdout)
     self._save_info()
+    os.rename(tmp_so_filename, self._so_filename)  # atomic, after the info file, see _need_recompile
     assert not self._need_recompile()
 
   def load_lib_ctypes(self):
@@ -3766,6 +3820,37 @@ def binary_search_any(cmp, low, high):
   return low
 
 
+_module_source_names_cache = {}  # type: typing.Dict[typing.Tuple[str,str],typing.Dict[str,str]]
+
+
+def get_module_source_names(mod_names, regexp):
+  """
+  Finds names in the source code of the given RETURNN modules, without importing them.
+  This is much faster than importing them (which might e.g. import TensorFlow),
+  and is used to only import the module which is needed for a given name
+  (e.g. see :func:`TFNetworkLayer.get_layer_class` or :func:`Dataset.get_dataset_class`).
+
+  :param list[str] mod_names: module names, where the source file is in the RETURNN root dir
+  :param str regexp: with one group for the name, used with re.MULTILINE, e.g. ``r"^class (\w+)\("``
+  :return: name -> module name (the first one in mod_names which matches). modules without source are skipped
+  :rtype: dict[str,str]
+  """
+  res = {}
+  pattern = re.compile(regexp, re.MULTILINE)
+  for mod_name in mod_names:
+    key = (mod_name, regexp)
+    if key not in _module_source_names_cache:
+      _module_source_names_cache[key] = {}
+      filename = "%s/%s.py" % (my_dir, mod_name)
+      if os.path.exists(filename):
+        with open(filename, "rb") as f:
+          source = f.read().decode("utf8", "replace")
+        _module_source_names_cache[key] = {name: mod_name for name in pattern.findall(source)}
+    for name, name_mod_name in _module_source_names_cache[key].items():
+      res.setdefault(name, name_mod_name)
+  return res
+
+
 def generic_import_module(filename):
   """
   :param str filename:
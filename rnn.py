@@ -23,12 +23,16 @@ import os
 import sys
 import time
 import typing
+if __name__ == '__main__' and "--profile_startup" in sys.argv[1:]:
+  # Install it as early as possible, such that we also cover the imports below.
+  from Debug import StartupProfiler
+  StartupProfiler.install()
 import numpy
 from Log import log
 from Config import Config
 from Dataset import Dataset, init_dataset, init_dataset_via_str
-from HDFDataset import HDFDataset
 from Debug import init_ipython_kernel, init_better_exchook, init_faulthandler, init_cuda_not_in_main_proc_check
+from Debug import StartupProfiler
 from Util import init_thread_join_hack, describe_returnn_version, describe_theano_version, \
   describe_tensorflow_version, BackendEngine, get_tensorflow_version_tuple
 
@@ -228,8 +232,10 @@ def load_data(config, cache_byte_size, files_config_key, **kwargs):
     config_str = config.value(files_config_key, "")
     data = init_dataset_via_str(config_str, config=config, cache_byte_size=cache_byte_size, **kwargs)
   cache_leftover = 0
-  if isinstance(data, HDFDataset):
-    cache_leftover = data.definite_cache_leftover
+  if "HDFDataset" in sys.modules:  # otherwise it cannot be a HDFDataset, and we avoid the import
+    from HDFDataset import HDFDataset
+    if isinstance(data, HDFDataset):
+      cache_leftover = data.definite_cache_leftover
   return data, cache_leftover
 
 
@@ -321,6 +327,10 @@ def init_backend_engine():
   Initializes ``engine``, which is either :class:`TFEngine.Engine` or Theano :class:`Engine.Engine`.
   """
   BackendEngine.select_engine(config=config)
+  if config.value("native_op_cache_dir", None):
+    from Util import NativeCodeCompiler
+    NativeCodeCompiler.CacheDirRoot = config.value("native_op_cache_dir", None)
+    print("Native op cache dir:", NativeCodeCompiler.CacheDirRoot, file=log.v4)
   if BackendEngine.is_theano_selected():
     print("Theano:", describe_theano_version(), file=log.v3)
     import TheanoUtil
@@ -376,9 +386,14 @@ def init(config_filename=None, command_line_options=(), config_updates=None, ext
   :param dict[str]|None config_updates: see :func:`init_config`
   :param str|None extra_greeting:
   """
-  init_better_exchook()
+  with StartupProfiler.phase("better_exchook"):
+    init_better_exchook()
   init_thread_join_hack()
-  init_config(config_filename=config_filename, command_line_options=command_line_options, extra_updates=config_updates)
+  with StartupProfiler.phase("config"):
+    init_config(
+      config_filename=config_filename, command_line_options=command_line_options, extra_updates=config_updates)
+  if config.bool("profile_startup", False):
+    StartupProfiler.install()
   if config.bool("patch_atfork", False):
     from Util import maybe_restart_returnn_with_atfork_patch
     maybe_restart_returnn_with_atfork_patch()
@@ -387,7 +402,8 @@ def init(config_filename=None, command_line_options=(), config_updates=None, ext
     print(extra_greeting, file=log.v1)
   returnn_greeting(config_filename=config_filename, command_line_options=command_line_options)
   init_faulthandler()
-  init_backend_engine()
+  with StartupProfiler.phase("backend_engine"):
+    init_backend_engine()
   if BackendEngine.is_theano_selected():
     if config.value('task', 'train') == "theano_graph":
       config.set("multiprocessing", False)
@@ -396,16 +412,19 @@ def init(config_filename=None, command_line_options=(), config_updates=None, ext
   if config.bool('ipython', False):
     init_ipython_kernel()
   init_config_json_network()
-  devices = init_theano_devices()
+  with StartupProfiler.phase("devices"):
+    devices = init_theano_devices()
   if need_data():
-    init_data()
+    with StartupProfiler.phase("data"):
+      init_data()
   print_task_properties(devices)
-  if config.value('task', 'train') == 'server':
-    import Server
-    global server
-    server = Server.Server(config)
-  else:
-    init_engine(devices)
+  with StartupProfiler.phase("engine"):
+    if config.value('task', 'train') == 'server':
+      import Server
+      global server
+      server = Server.Server(config)
+    else:
+      init_engine(devices)
 
 
 def finalize():
@@ -448,7 +467,8 @@ def execute_main_task():
     print("Dry run, will not save anything.", file=log.v1)
   if task == 'train':
     assert train_data.have_seqs(), "no train files specified, check train option: %s" % config.value('train', None)
-    engine.init_train_from_config(config, train_data, dev_data, eval_data)
+    with StartupProfiler.phase("init_network"):
+      engine.init_train_from_config(config, train_data, dev_data, eval_data)
     engine.train()
   elif task == "eval":
     epoch = config.int("epoch", -1)
@@ -460,7 +480,8 @@ def execute_main_task():
     else:
       assert load_epoch >= 0, "specify epoch or load_epoch"
       engine.epoch = load_epoch
-    engine.init_train_from_config(config, train_data, dev_data, eval_data)
+    with StartupProfiler.phase("init_network"):
+      engine.init_train_from_config(config, train_data, dev_data, eval_data)
     print("Evaluate epoch", engine.epoch, file=log.v4)
     engine.eval_model(
       output_file=config.value("eval_output_file", None),
@@ -474,14 +495,16 @@ def execute_main_task():
     engine.use_search_flag = config.bool("forward_use_search", False)
     if config.has("epoch"):
       config.set('load_epoch', config.int('epoch', 0))
-    engine.init_network_from_config(config)
+    with StartupProfiler.phase("init_network"):
+      engine.init_network_from_config(config)
     output_file = config.value('output_file', 'dump-fwd-epoch-%i.hdf' % engine.epoch)
     engine.forward_to_hdf(
       data=eval_data, output_file=output_file, combine_labels=combine_labels,
       batch_size=config.int('forward_batch_size', 0))
   elif task == "search":
     engine.use_search_flag = True
-    engine.init_network_from_config(config)
+    with StartupProfiler.phase("init_network"):
+      engine.init_network_from_config(config)
     if config.value("search_data", "eval") in ["train", "dev", "eval"]:
       data = {"train": train_data, "dev": dev_data, "eval": eval_data}[config.value("search_data", "eval")]
       assert data, "set search_data"
@@ -492,7 +515,8 @@ def execute_main_task():
       do_eval=config.bool("search_do_eval", True),
       output_layer_names=config.typed_value("search_output_layer", "output"),
       output_file=config.value("search_output_file", ""),
-      output_file_format=config.value("search_output_file_format", "txt"))
+      output_file_format=config.value("search_output_file_format", "txt"),
+      output_file_resume=config.bool("search_output_file_resume", False))
   elif task == 'compute_priors':
     assert train_data is not None, 'train data for priors should be provided'
     engine.init_network_from_config(config)
@@ -640,6 +664,7 @@ def main(argv):
     assert len(argv) >= 2, "usage: %s <config>" % argv[0]
     init(command_line_options=argv[1:])
     execute_main_task()
+    StartupProfiler.finish(file=log.v1)  # if not done already at the first step
   except KeyboardInterrupt:
     return_code = 1
     print("KeyboardInterrupt", file=getattr(log, "v3", sys.stderr))
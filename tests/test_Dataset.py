@@ -7,7 +7,8 @@ import sys
 sys.path += ["."]  # Python 3 hack
 
 import unittest
-from nose.tools import assert_equal, assert_is_instance, assert_in, assert_not_in, assert_true, assert_false
+from nose.tools import assert_equal, assert_is_instance, assert_in, assert_not_in, assert_true, assert_false, \
+  assert_almost_equal
 from GeneratingDataset import GeneratingDataset, DummyDataset, DummyDatasetMultipleSequenceLength
 from EngineBatch import Batch
 from Dataset import DatasetSeq
@@ -39,6 +40,111 @@ def test_generate_batches_recurrent():
     batch_gen.advance(1)
 
 
+def _get_padding_ratio(batches, key="data"):
+  """
+  :param list[Batch] batches:
+  :param str key:
+  :rtype: float
+  """
+  num_frames = sum([batch.get_total_num_frames()[key] for batch in batches])
+  num_padded_frames = sum([batch.get_all_slices_num_frames()[key] for batch in batches])
+  return 1. - float(num_frames) / num_padded_frames
+
+
+def test_generate_batches_bucket_boundaries():
+  import tempfile
+  from GeneratingDataset import StaticDataset
+  from HDFDataset import HDFDataset, HDFDatasetWriter
+  rnd = np.random.RandomState(42)
+  seq_lens = rnd.randint(1, 100, size=(200,))
+  static_dataset = StaticDataset(
+    data=[{"data": np.zeros((n, 2), dtype="float32"), "classes": np.zeros((n,), dtype="int32")} for n in seq_lens],
+    output_dim={"data": (2, 2), "classes": (3, 1)})
+  static_dataset.init_seq_order(epoch=1)
+  # The batches are not in seq order anymore, thus the dataset must support random access.
+  try:
+    list(static_dataset._generate_batches(recurrent_net=True, batch_size=400, bucket_boundaries=[10]))
+  except AssertionError as exc:
+    print("Expected exception:", exc)
+  else:
+    assert False, "expected AssertionError"
+  hdf_fn = tempfile.mktemp(suffix=".hdf")
+  writer = HDFDatasetWriter(hdf_fn)
+  writer.dump_from_dataset(static_dataset)
+  writer.close()
+  dataset = HDFDataset(files=[hdf_fn], seq_ordering="random")
+  dataset.init_seq_order(epoch=1)
+  batch_opts = dict(recurrent_net=True, max_seqs=10, batch_size=400)
+  ref_batches = list(dataset._generate_batches(**batch_opts))
+  for bucket_boundaries in [[10, 20, 40, 70], 5]:
+    batches = list(dataset._generate_batches(bucket_boundaries=bucket_boundaries, **batch_opts))
+    seq_idxs = [seq.seq_idx for batch in batches for seq in batch.seqs]
+    assert_equal(sorted(seq_idxs), list(range(len(seq_lens))))
+    for batch in batches:
+      assert_true(batch.get_all_slices_num_frames()["data"] <= 400 or batch.num_slices == 1)
+      assert_true(batch.num_slices <= 10)
+    print("padding ratio:", _get_padding_ratio(batches), "ref:", _get_padding_ratio(ref_batches))
+    assert_true(_get_padding_ratio(batches) < _get_padding_ratio(ref_batches))
+    # Deterministic.
+    batches2 = list(dataset._generate_batches(bucket_boundaries=bucket_boundaries, **batch_opts))
+    assert_equal(
+      [[seq.seq_idx for seq in batch.seqs] for batch in batches2],
+      [[seq.seq_idx for seq in batch.seqs] for batch in batches])
+
+
+def test_BatchShapeStats():
+  from GeneratingDataset import StaticDataset
+  from EngineBatch import BatchShapeStats
+  dataset = StaticDataset(data=[
+    {"data": np.zeros((n, 2), dtype="float32"), "classes": np.zeros((n // 2,), dtype="int32")}
+    for n in [3, 5, 8, 2, 7]], output_dim={"data": (2, 2), "classes": (3, 1)})
+  dataset.init_seq_order(epoch=1)
+  batches = list(dataset._generate_batches(recurrent_net=True, max_seqs=2, batch_size=100))
+  stats = BatchShapeStats()
+  for batch in batches:
+    batch_info = stats.collect_batch(batch, data_keys=["data", "classes"])
+    assert_equal(batch_info["num_seqs"], len(batch.seqs))
+    assert_equal(batch_info["max_frames"]["data"], max([seq.frame_length["data"] for seq in batch.seqs]))
+    summary = dict(BatchShapeStats.get_batch_summary_values(batch_info))
+    assert_equal(summary["batch_stats/data/num_padded_frames"], batch.get_all_slices_num_frames()["data"])
+  assert_equal(stats.num_batches, 3)
+  assert_equal(stats.num_seqs, 5)
+  assert_equal(stats.max_num_seqs, 2)
+  assert_equal(stats.num_frames["data"], 25)
+  assert_equal(stats.num_frames["classes"], 11)
+  assert_equal(stats.num_padded_frames["data"], 5 * 2 + 8 * 2 + 7)
+  assert_equal(stats.max_batch_shape["data"], (2, 8))
+  assert_almost_equal(stats.get_padding_ratios()["data"], _get_padding_ratio(batches, key="data"))
+  stats.dump(stream=sys.stdout)
+
+
+def test_assign_batches_by_cost():
+  from GeneratingDataset import StaticDataset
+  from EngineBatch import assign_batches_by_cost, get_ranks_utilization, get_batch_cost
+  rnd = np.random.RandomState(42)
+  seq_lens = rnd.randint(1, 100, size=(100,))
+  dataset = StaticDataset(data=[{"data": np.zeros((n, 2), dtype="float32")} for n in seq_lens], output_dim={})
+  dataset.seq_ordering = "random"
+  dataset.init_seq_order(epoch=1)
+  batches = list(dataset._generate_batches(recurrent_net=True, max_seqs=3, batch_size=1000))
+  num_ranks = 4
+  assignment = assign_batches_by_cost(batches, num_ranks=num_ranks)
+  assert_equal(len(assignment), num_ranks)
+  num_steps = len(batches) // num_ranks
+  assert_equal([len(batch_idxs) for batch_idxs in assignment], [num_steps] * num_ranks)
+  all_idxs = sorted(sum(assignment, []))
+  assert_equal(len(set(all_idxs)), num_steps * num_ranks)
+  totals = [sum([get_batch_cost(batches[i]) for i in batch_idxs]) for batch_idxs in assignment]
+  print("rank costs:", totals)
+  assert_true(max(totals) - min(totals) <= max([get_batch_cost(batch) for batch in batches]))
+  round_robin = [list(range(r, len(batches), num_ranks)) for r in range(num_ranks)]
+  utilization = get_ranks_utilization(batches, assignment)
+  utilization_round_robin = get_ranks_utilization(batches, round_robin)
+  print("utilization:", utilization, "round robin:", utilization_round_robin)
+  assert_true(min(utilization) > min(utilization_round_robin))
+  assert_true(all([0 < u <= 1 for u in utilization]))
+
+
 def test_iterate_seqs_no_chunking_1():
   dataset = DummyDataset(input_dim=2, output_dim=3, num_seqs=2, seq_len=11)
   dataset.init_seq_order(1)
@@ -326,6 +432,93 @@ def test_task12ax_window():
   assert_equal(list(data2a[-1, 2]), [0] * input_dim)  # zero-padded right
 
 
+def _get_seq_order_dataset(seq_lens, seq_ordering, **kwargs):
+  """
+  :param list[int] seq_lens:
+  :param str seq_ordering:
+  :rtype: DummyDataset
+  """
+  dataset = DummyDataset(input_dim=2, output_dim=3, num_seqs=len(seq_lens), seq_ordering=seq_ordering, **kwargs)
+  dataset.get_all_seq_lens = lambda: np.array(seq_lens)
+  return dataset
+
+
+def test_get_seq_order_for_epoch_sorted():
+  from random import Random
+  rnd = Random(42)
+  seq_lens = [rnd.randint(1, 10) for _ in range(100)]  # many equal lengths, to check the stable sort
+  dataset = _get_seq_order_dataset(seq_lens, "sorted")
+  assert_equal(
+    dataset.get_seq_order_for_epoch(epoch=1, num_seqs=len(seq_lens)),
+    sorted(range(len(seq_lens)), key=lambda i: seq_lens[i]))
+  dataset = _get_seq_order_dataset(seq_lens, "sorted_reverse")
+  assert_equal(
+    dataset.get_seq_order_for_epoch(epoch=1, num_seqs=len(seq_lens)),
+    sorted(range(len(seq_lens)), key=lambda i: seq_lens[i], reverse=True))
+
+
+def test_get_seq_order_for_epoch_random():
+  from random import Random
+  num_seqs = 50
+  dataset = _get_seq_order_dataset([1] * num_seqs, "random")
+  for epoch in [1, 2]:
+    seq_index = list(range(num_seqs))
+    Random(epoch).shuffle(seq_index)
+    seq_order = dataset.get_seq_order_for_epoch_array(epoch=epoch, num_seqs=num_seqs)
+    assert_is_instance(seq_order, np.ndarray)
+    assert_equal(seq_order.tolist(), seq_index)
+
+
+def test_get_seq_order_for_epoch_laplace():
+  from random import Random
+  rnd = Random(42)
+  seq_lens = [rnd.randint(1, 20) for _ in range(101)]
+  dataset = _get_seq_order_dataset(seq_lens, "laplace:.10")
+  seq_order = dataset.get_seq_order_for_epoch(epoch=3, num_seqs=len(seq_lens))
+  assert_equal(sorted(seq_order), list(range(len(seq_lens))))
+  bins = len(seq_lens) // 10
+  for i in range(bins):
+    part = [seq_lens[j] for j in seq_order[i * len(seq_lens) // bins:(i + 1) * len(seq_lens) // bins]]
+    assert_equal(part, sorted(part, reverse=(i % 2 == 1)))
+
+
+def test_get_seq_order_for_epoch_unique_seq_tags():
+  num_seqs = 20
+  dataset = _get_seq_order_dataset([1] * num_seqs, "reverse", unique_seq_tags=True)
+  dataset.get_all_tags = lambda: ["tag-%i" % (i // 3) for i in range(num_seqs)]
+  assert_equal(dataset.get_seq_order_for_epoch(epoch=1, num_seqs=num_seqs), [19, 17, 14, 11, 8, 5, 2])
+
+
+def test_serialize_data():
+  dataset = DummyDataset(input_dim=2, output_dim=3, num_seqs=1)
+  dataset.labels["bytes"] = [chr(i) for i in range(256)]
+  dataset.labels["chars"] = [u"\u00e4", "b", "c"]
+  dataset.labels["words"] = ["hello", "world", "!"]
+  assert_equal(dataset.serialize_data("bytes", np.array(list(b"ab\xc3\xa4"))), u"ab\u00e4")
+  assert_equal(dataset.serialize_data("bytes", np.array([0xe4, ord("b")])), u"\u00e4b")  # no valid utf8
+  assert_equal(dataset.serialize_data("chars", np.array([0, 1, 2])), u"\u00e4bc")
+  assert_equal(dataset.serialize_data("words", [0, 1, 2]), "hello world !")
+  assert_equal(dataset.serialize_data("words", np.array([], dtype="int32")), "")
+  assert_equal(dataset.serialize_data("words", []), "")
+  assert_equal(dataset.serialize_data("bytes", []), "")
+  dataset.labels["words"] = ["foo", "bar"]  # the lookup table must be updated
+  assert_equal(dataset.serialize_data("words", np.array([1, 0])), "bar foo")
+
+
+def test_get_dataset_class():
+  from Dataset import get_dataset_class
+  from HDFDataset import HDFDataset
+  from MetaDataset import MetaDataset
+  from Util import get_module_source_names
+  assert_equal(get_dataset_class("HDFDataset"), HDFDataset)
+  assert_equal(get_dataset_class("MetaDataset"), MetaDataset)
+  assert_equal(get_dataset_class("DummyDataset"), DummyDataset)
+  assert get_dataset_class("DoesNotExistDataset") is None
+  names = get_module_source_names(["GeneratingDataset", "MetaDataset"], r"^class (\w+)\(")
+  assert_equal(names["DummyDataset"], "GeneratingDataset")
+  assert_equal(names["MetaDataset"], "MetaDataset")
+
+
 if __name__ == "__main__":
   better_exchook.install()
   if len(sys.argv) <= 1:
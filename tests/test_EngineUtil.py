@@ -4,7 +4,7 @@ sys.path += ["."]  # Python 3 hack
 
 from nose.tools import assert_equal, assert_is_instance, assert_in, assert_not_in, assert_true, assert_false
 from Device import Device
-from EngineUtil import assign_dev_data, assign_dev_data_single_seq
+from EngineUtil import assign_dev_data, assign_dev_data_single_seq, SearchOutputWriter
 from EngineBatch import Batch
 import TheanoUtil
 from Log import log
@@ -88,3 +88,74 @@ def test_assign_dev_data():
   success, num_batches = assign_dev_data(device, dataset, batches)
   assert_true(success)
   assert_equal(num_batches, len(batches))
+
+
+def test_SearchOutputWriter_py_resume():
+  import tempfile
+  import os
+  from Util import better_repr
+  tmp_dir = tempfile.mkdtemp()
+  filename = os.path.join(tmp_dir, "search_out.py")
+  writer = SearchOutputWriter(filename=filename, output_format="py")
+  writer.set_order([3, 5, 8])
+  writer.write(key=5, seq_tag="seq-5", output=[(-1.5, "b b"), (-2.5, "b")])
+  assert_equal(open(filename).read(), "{\n")  # seq 3 is not finished yet
+  writer.write(key=3, seq_tag="seq-3", output=[(-0.5, "a"), (-0.75, "a a")])
+  # Simulate a crash in the middle of writing the last entry.
+  with open(filename, "a") as f:
+    f.write("'seq-8': [\n(-1.0, 'c'),\n")
+  writer.file.close()
+  writer = SearchOutputWriter(filename=filename, output_format="py", resume=True)
+  assert_equal(writer.num_done, 2)
+  assert_equal(writer.get_done_seq_tags(dataset=None), {"seq-3", "seq-5"})
+  writer.set_order(None)
+  writer.write(key=0, seq_tag="seq-8", output=[(-1.0, "c"), (-3.0, "c c")])
+  writer.write(key=1, seq_tag="seq-3", output=[(-0.5, "a"), (-0.75, "a a")])  # already written, skipped
+  writer.close()
+  assert_equal(writer.num_written, 1)
+  content = open(filename).read()
+  assert_equal(content, "{\n%s}\n" % "".join(
+    "%r: %s,\n" % (tag, better_repr(out)) for (tag, out) in [
+      ("seq-3", [(-0.5, "a"), (-0.75, "a a")]),
+      ("seq-5", [(-1.5, "b b"), (-2.5, "b")]),
+      ("seq-8", [(-1.0, "c"), (-3.0, "c c")])]))
+  assert_equal(eval(content)["seq-8"], [(-1.0, "c"), (-3.0, "c c")])
+
+
+def test_SearchOutputWriter_txt_resume():
+  import tempfile
+  import os
+  from GeneratingDataset import StaticDataset
+  tmp_dir = tempfile.mkdtemp()
+  filename = os.path.join(tmp_dir, "search_out.txt")
+  dataset = StaticDataset([{"data": np.zeros((2, 1), dtype="float32")} for _ in range(4)])
+  dataset.init_seq_order(epoch=1)
+  dataset.load_seqs(0, 4)
+  with open(filename, "w") as f:
+    f.write("hello\nworld\nincomp")
+  writer = SearchOutputWriter(filename=filename, output_format="txt", resume=True)
+  assert_equal(writer.num_done, 2)
+  assert_equal(writer.get_done_seq_tags(dataset), {"seq-0", "seq-1"})
+  writer.set_order(None)
+  writer.write(key=1, seq_tag="seq-3", output="bar")
+  writer.write(key=0, seq_tag="seq-2", output="foo")
+  writer.close()
+  assert_equal(open(filename).read(), "hello\nworld\nfoo\nbar\n")
+
+
+def test_SearchOutputWriter_txt_resume_seq_tags_filter():
+  import tempfile
+  import os
+  from GeneratingDataset import StaticDataset
+  tmp_dir = tempfile.mkdtemp()
+  filename = os.path.join(tmp_dir, "search_out.txt")
+  dataset = StaticDataset([{"data": np.zeros((2, 1), dtype="float32")} for _ in range(4)])
+  dataset.seq_tags_filter = {"seq-1", "seq-3"}
+  dataset.init_seq_order(epoch=1)
+  dataset.load_seqs(0, dataset.num_seqs)
+  with open(filename, "w") as f:
+    f.write("hello\n")
+  writer = SearchOutputWriter(filename=filename, output_format="txt", resume=True)
+  assert_equal(writer.num_done, 1)
+  assert_equal(writer.get_done_seq_tags(dataset), {"seq-1"})
+  writer.close()
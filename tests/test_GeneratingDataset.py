@@ -144,6 +144,198 @@ def test_BytePairEncoding_unicode():
     u"råt råt iz ďër iz ďër ám à@@ n iz ďër ë låk ë k@@ o@@ d áv d@@ r@@ e@@ s w@@ ër yù w@@ ê@@ k dù ďë à@@ s@@ k")
 
 
+def _have_soundfile():
+  """
+  :rtype: bool
+  """
+  try:
+    # noinspection PyPackageRequirements,PyUnresolvedReferences
+    import soundfile
+  except ImportError:
+    return False
+  return True
+
+
+def _make_ogg_zip_with_wavs(tmp_dir, num_seqs=5, sample_rate=16000):
+  """
+  :param str tmp_dir:
+  :param int num_seqs:
+  :param int sample_rate:
+  :return: zip filename, in the format which OggZipDataset expects
+  :rtype: str
+  """
+  import io
+  import wave
+  import zipfile
+  name = "dataset"
+  zip_filename = "%s/%s.zip" % (tmp_dir, name)
+  rnd = numpy.random.RandomState(42)
+  entries = []
+  with zipfile.ZipFile(zip_filename, "w") as zip_file:
+    for i in range(num_seqs):
+      num_samples = (2 + (i * 3) % num_seqs) * sample_rate // 10
+      samples = (rnd.uniform(-0.5, 0.5, size=(num_samples,)) * 32767).astype("int16")
+      raw_bytes = io.BytesIO()
+      wav_file = wave.open(raw_bytes, "wb")
+      wav_file.setnchannels(1)
+      wav_file.setsampwidth(2)
+      wav_file.setframerate(sample_rate)
+      wav_file.writeframes(samples.tobytes())
+      wav_file.close()
+      filename = "seq%i.wav" % i
+      zip_file.writestr("%s/%s" % (name, filename), raw_bytes.getvalue())
+      entries.append({
+        "file": filename, "seq_name": "seq-%i" % i, "text": "hello %i" % i,
+        "duration": float(num_samples) / sample_rate})
+    zip_file.writestr("%s.txt" % name, repr(entries))
+  return zip_filename
+
+
+def _get_all_features(dataset, epoch=1):
+  """
+  :param Dataset dataset:
+  :param int epoch:
+  :return: seq tag -> features, in the seq order of the epoch
+  :rtype: list[(str,numpy.ndarray)]
+  """
+  dataset.init_seq_order(epoch=epoch)
+  res = []
+  seq_idx = 0
+  while dataset.is_less_than_num_seqs(seq_idx):
+    dataset.load_seqs(seq_idx, seq_idx + 1)
+    res.append((dataset.get_tag(seq_idx), dataset.get_data(seq_idx, "data")))
+    seq_idx += 1
+  dataset.finish_epoch()
+  return res
+
+
+def _assert_same_features(res1, res2):
+  """
+  :param list[(str,numpy.ndarray)] res1:
+  :param list[(str,numpy.ndarray)] res2:
+  """
+  assert_equal([tag for (tag, _) in res1], [tag for (tag, _) in res2])
+  for (tag, features1), (_, features2) in zip(res1, res2):
+    numpy.testing.assert_array_equal(features1, features2, err_msg="seq %r" % tag)
+
+
+def _ogg_zip_post_process(feature_data, seq_name=None):
+  """
+  :param numpy.ndarray feature_data:
+  :param str|None seq_name:
+  :rtype: numpy.ndarray
+  """
+  return feature_data * 2.
+
+
+@unittest.skipIf(not _have_soundfile(), "needs soundfile")
+def test_OggZipDataset_feature_workers_and_cache():
+  import tempfile
+  import shutil
+  import glob
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    zip_filename = _make_ogg_zip_with_wavs(tmp_dir)
+    audio_opts = {"features": "raw", "post_process": _ogg_zip_post_process}
+    opts = {"path": zip_filename, "audio": audio_opts, "targets": None, "seq_ordering": "random"}
+    serial = _get_all_features(OggZipDataset(**opts))
+    assert_equal(len(serial), 5)
+
+    dataset = OggZipDataset(num_feature_workers=2, num_prefetch_seqs=3, **opts)
+    _assert_same_features(serial, _get_all_features(dataset))
+    assert dataset._feature_worker_pool is None, "should be closed by finish_epoch"
+    _assert_same_features(serial, _get_all_features(dataset))  # creates the pool again
+
+    cache_dir = "%s/cache" % tmp_dir
+    dataset = OggZipDataset(num_feature_workers=2, feature_cache_dir=cache_dir, **opts)
+    _assert_same_features(serial, _get_all_features(dataset))
+    cache_files = glob.glob("%s/*/*.npy" % cache_dir)
+    assert_equal(len(cache_files), 5)
+    # Check that the cache is really used: Overwrite one cached entry, and we should get it back.
+    tag, features = serial[0]
+    cache_filename = dataset._get_feature_cache_filename(dataset.get_all_tags().index(tag))
+    assert cache_filename in cache_files
+    numpy.save(cache_filename, numpy.zeros_like(features))
+    for num_feature_workers in [0, 2]:
+      dataset = OggZipDataset(num_feature_workers=num_feature_workers, feature_cache_dir=cache_dir, **opts)
+      res = _get_all_features(dataset)
+      numpy.testing.assert_array_equal(dict(res)[tag], numpy.zeros_like(features))
+      _assert_same_features(serial[1:], [(tag_, v) for (tag_, v) in res if tag_ != tag])
+
+    # Another post_process function gives another cache key, i.e. it does not use the old cached entries.
+    audio_opts2 = dict(audio_opts, post_process=lambda feature_data, seq_name=None: feature_data * 2.)
+    dataset = OggZipDataset(feature_cache_dir=cache_dir, **dict(opts, audio=audio_opts2))
+    _assert_same_features(serial, _get_all_features(dataset))
+    assert_equal(len(glob.glob("%s/*/*.npy" % cache_dir)), 10)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+@unittest.skipIf(not _have_soundfile(), "needs soundfile")
+def test_OggZipDataset_feature_workers_random_augmentation():
+  import tempfile
+  import shutil
+
+  def pre_process(audio, sample_rate, random_state):
+    """
+    :param numpy.ndarray audio:
+    :param int sample_rate:
+    :param numpy.random.RandomState random_state:
+    :rtype: numpy.ndarray
+    """
+    return audio + random_state.uniform(-0.01, 0.01, size=audio.shape)
+
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    zip_filename = _make_ogg_zip_with_wavs(tmp_dir)
+    opts = {
+      "path": zip_filename, "audio": {"features": "raw", "pre_process": pre_process}, "targets": None,
+      "seq_ordering": "random"}
+    serial_dataset = OggZipDataset(**opts)
+    assert not serial_dataset.feature_extractor.is_deterministic()
+    dataset = OggZipDataset(num_feature_workers=2, feature_cache_dir="%s/cache" % tmp_dir, **opts)
+    assert dataset._feature_cache_dir is None
+    for epoch in [1, 2]:
+      # The workers only read the audio, and the augmentation is done in order, thus it is the same.
+      _assert_same_features(_get_all_features(serial_dataset, epoch=epoch), _get_all_features(dataset, epoch=epoch))
+    assert not os.path.exists("%s/cache" % tmp_dir)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_ExtractAudioFeatures_get_cache_key_post_process():
+  def post_process1(feature_data, seq_name=None):
+    """
+    :param numpy.ndarray feature_data:
+    :param str|None seq_name:
+    """
+    return feature_data * 2.
+
+  def post_process2(feature_data, seq_name=None):
+    """
+    :param numpy.ndarray feature_data:
+    :param str|None seq_name:
+    """
+    return feature_data * 3.
+
+  post_process2.__name__ = post_process1.__name__
+  key1 = ExtractAudioFeatures(post_process=post_process1).get_cache_key()
+  assert_equal(key1, ExtractAudioFeatures(post_process=post_process1).get_cache_key())
+  assert key1 != ExtractAudioFeatures(post_process=post_process2).get_cache_key()
+  assert key1 != ExtractAudioFeatures().get_cache_key()
+
+  # No source available, e.g. when defined in the config.
+  namespace1, namespace2 = {}, {}
+  exec("def post_process(feature_data, seq_name=None): return feature_data * 2.", namespace1)
+  exec("def post_process(feature_data, seq_name=None): return feature_data * 3.", namespace2)
+  assert_equal(
+    ExtractAudioFeatures(post_process=namespace1["post_process"]).get_cache_key(),
+    ExtractAudioFeatures(post_process=namespace1["post_process"]).get_cache_key())
+  assert (
+    ExtractAudioFeatures(post_process=namespace1["post_process"]).get_cache_key() !=
+    ExtractAudioFeatures(post_process=namespace2["post_process"]).get_cache_key())
+
+
 if __name__ == "__main__":
   better_exchook.install()
   if len(sys.argv) <= 1:
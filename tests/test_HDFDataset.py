@@ -254,6 +254,71 @@ def test_HDFDataset_partition_epoch():
       assert_equal(hdf_reader.data[key][seq_idx].tolist(), orig_reader.data[key][seq_idx].tolist())
 
 
+def test_HDFDataset_get_all_seq_lens():
+  num_seqs = 11
+  hdf_fn = generate_hdf_from_other({"class": "TaskNumberBaseConvertDataset", "num_seqs": num_seqs})
+  hdf = HDFDataset([hdf_fn, hdf_fn], seq_ordering="sorted")
+  seq_lens = hdf.get_all_seq_lens()
+  assert_equal(seq_lens.tolist(), [hdf._get_seq_length_by_real_idx(i)[0] for i in range(num_seqs * 2)])
+  hdf.init_seq_order(epoch=1)
+  assert_equal(hdf.get_current_seq_order(), sorted(range(num_seqs * 2), key=lambda i: seq_lens[i]))
+
+
+def test_HDFDataset_use_mmap():
+  num_seqs = 11
+  hdf_fn = generate_hdf_from_other({"class": "TaskNumberBaseConvertDataset", "num_seqs": num_seqs})
+  hdf = HDFDataset([hdf_fn], use_mmap=True)
+  assert_equal(sorted(hdf._file_mmaps[0].keys()), ["classes", "data"])
+  hdf_reader = DatasetTestReader(hdf)
+  hdf_reader.read_all()
+  orig_reader = DatasetTestReader(HDFDataset([hdf_fn]))
+  orig_reader.read_all()
+  assert hdf_reader.data_keys == orig_reader.data_keys == ["data", "classes"]
+  assert hdf_reader.num_seqs == orig_reader.num_seqs == num_seqs
+  for seq_idx in range(num_seqs):
+    for key in orig_reader.data_keys:
+      assert_equal(hdf_reader.seq_lens[seq_idx][key], orig_reader.seq_lens[seq_idx][key])
+      assert_equal(hdf_reader.data[key][seq_idx].tolist(), orig_reader.data[key][seq_idx].tolist())
+
+
+def test_HDFDataset_batch_plan_cache():
+  from EngineBatch import BatchPlanCache
+  import tempfile
+  import shutil
+  hdf_fn = generate_hdf_from_other({"class": "TaskNumberBaseConvertDataset", "num_seqs": 23})
+  cache_dir = tempfile.mkdtemp()
+  try:
+    batch_plan_cache = BatchPlanCache(cache_dir=cache_dir)
+
+    def get_batches(seq_ordering, use_cache):
+      hdf = HDFDataset([hdf_fn], seq_ordering=seq_ordering)
+      hdf.init_seq_order(epoch=1)
+      batch_gen = hdf.generate_batches(
+        recurrent_net=True, batch_size=50, max_seqs=4,
+        batch_plan_cache=batch_plan_cache if use_cache else None)
+      batches = []
+      while batch_gen.has_more():
+        batches.extend(batch_gen.peek_next_n(1))
+        batch_gen.advance(1)
+      def nd_to_list(d):
+        return [d.value] + sorted([(k, int(v)) for (k, v) in d.dict.items()])
+
+      return [[(part.seq_idx, nd_to_list(part.seq_start_frame), nd_to_list(part.seq_end_frame), part.batch_slice,
+                nd_to_list(part.batch_frame_offset))
+               for part in batch.seqs] + [batch.num_slices, nd_to_list(batch.max_num_frames_per_slice)]
+              for batch in batches]
+
+    for seq_ordering in ["default", "sorted"]:
+      ref = get_batches(seq_ordering, use_cache=False)
+      num_files = len(os.listdir(cache_dir))
+      assert_equal(get_batches(seq_ordering, use_cache=True), ref)  # generates and stores
+      assert_equal(len(os.listdir(cache_dir)), num_files + 1)
+      assert_equal(get_batches(seq_ordering, use_cache=True), ref)  # loads
+      assert_equal(len(os.listdir(cache_dir)), num_files + 1)
+  finally:
+    shutil.rmtree(cache_dir)
+
+
 def test_SimpleHDFWriter():
   fn = get_test_tmp_file(suffix=".hdf")
   os.remove(fn)  # SimpleHDFWriter expects that the file does not exist
@@ -404,6 +469,37 @@ def test_SimpleHDFWriter_ndim1_var_len():
       reader.data["sizes"][i],)
 
 
+def test_SimpleHDFWriter_buffered():
+  import h5py
+  rnd = numpy.random.RandomState(42)
+  n_dim = 5
+  batches = []
+  for n_batch in [3, 4, 1, 5]:
+    seq_lens = rnd.randint(1, 10, size=(n_batch,))
+    batches.append(dict(
+      inputs=rnd.normal(size=(n_batch, max(seq_lens), n_dim)).astype("float32"),
+      seq_len=seq_lens.tolist(),
+      seq_tag=["seq-%i" % (i + sum([len(b["seq_tag"]) for b in batches])) for i in range(n_batch)],
+      extra={"classes": rnd.randint(0, 7, size=(n_batch, max(seq_lens))).astype("int32")}))
+  contents = []
+  for opts in [{}, dict(buffer_num_frames=20), dict(buffer_num_frames=7, async_flush=True, compression="gzip")]:
+    fn = get_test_tmp_file(suffix=".hdf")
+    os.remove(fn)  # SimpleHDFWriter expects that the file does not exist
+    writer = SimpleHDFWriter(filename=fn, dim=n_dim, labels=None, **opts)
+    for batch in batches:
+      writer.insert_batch(**batch)
+    writer.close()
+    with h5py.File(fn, "r") as f:
+      contents.append({
+        key: f[key][...].tolist()
+        for key in ["inputs", "seqLengths", "seqTags", "targets/data/classes"]})
+      contents[-1].update({key: f.attrs[key].tolist() for key in ["numSeqs", "numTimesteps"]})
+      contents[-1]["classes_size"] = f["targets/size"].attrs["classes"].tolist()
+  assert_equal(contents[0]["numSeqs"], 13)
+  assert_equal(contents[1], contents[0])
+  assert_equal(contents[2], contents[0])
+
+
 @unittest.skip("unfinished...")
 def test_SimpleHDFWriter_swmr():
   fn = get_test_tmp_file(suffix=".hdf")
@@ -0,0 +1,140 @@
+
+import sys
+import os
+
+my_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path += [my_dir + "/.."]  # Python 3 hack
+
+from nose.tools import assert_equal, assert_true
+import tempfile
+import shutil
+import unittest
+
+from LmDataset import LmDataset, LmCorpusIndex, TranslationDataset, FlatTokenSeqs
+from Log import log
+from Util import BackendEngine
+
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+log.initialize(verbosity=[5])
+if BackendEngine.selectedEngine is None:
+  BackendEngine.select_engine(engine=BackendEngine.TensorFlow)  # only needed for the label dtype
+
+
+def _read_all_seqs(dataset, epoch, key="data"):
+  """
+  :param Dataset.Dataset dataset:
+  :param int epoch:
+  :param str key:
+  :return: list of (seq tag, label seq)
+  :rtype: list[(str,list[int])]
+  """
+  dataset.init_seq_order(epoch=epoch)
+  seqs = []
+  seq_idx = 0
+  while dataset.is_less_than_num_seqs(seq_idx):
+    dataset.load_seqs(seq_idx, seq_idx + 1)
+    seqs.append((dataset.get_tag(seq_idx), dataset.get_data(seq_idx, key).tolist()))
+    seq_idx += 1
+  return seqs
+
+
+def test_LmDataset_use_corpus_index():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    corpus_file = tmp_dir + "/corpus.txt"
+    with open(corpus_file, "wb") as f:
+      f.write(u"hello world\n\n  abc  \nworld hello hello\nx\näbc".encode("utf8"))
+    symbols_file = tmp_dir + "/symbols.txt"
+    with open(symbols_file, "wb") as f:
+      symbols = ["[END]", "hello", "world", "abc", "x", u"äbc"]
+      f.write("".join([u"%s %i\n" % (sym, i) for (i, sym) in enumerate(symbols)]).encode("utf8"))
+    opts = dict(
+      corpus_file=corpus_file, orth_symbols_map_file=symbols_file, word_based=True,
+      seq_ordering="laplace:2", partition_epoch=2)
+    ref = LmDataset(**opts)
+    dataset = LmDataset(use_corpus_index=True, **opts)
+    assert_true(os.path.exists(corpus_file + LmCorpusIndex.IndexFilePostfix))
+    assert_equal(len(dataset.corpus_index), 5)
+    assert_equal(dataset.get_all_seq_lens().tolist(), ref.get_all_seq_lens().tolist())
+    for epoch in [1, 2, 3]:
+      assert_equal(_read_all_seqs(dataset, epoch=epoch), _read_all_seqs(ref, epoch=epoch))
+    # Now it loads the stored index.
+    dataset = LmDataset(use_corpus_index=True, **opts)
+    assert_equal(_read_all_seqs(dataset, epoch=1), _read_all_seqs(ref, epoch=1))
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_TranslationDataset_binary_cache_dir():
+  import pickle
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    for prefix, lines in [("source", ["a b c", "b", "c a a a", "x"]), ("target", ["A", "B C", "C", "A A"])]:
+      with open("%s/%s.train" % (tmp_dir, prefix), "w") as f:
+        f.write("\n".join(lines) + "\n")
+      vocab = {w: i for (i, w) in enumerate(sorted(set(" ".join(lines).split()) | {"</S>", "<UNK>"}))}
+      with open("%s/%s.vocab.pkl" % (tmp_dir, prefix), "wb") as f:
+        pickle.dump(vocab, f)
+    opts = dict(
+      path=tmp_dir, file_postfix="train", source_postfix=" </S>", target_postfix=" </S>", unknown_label="<UNK>",
+      seq_ordering="laplace:2")
+    ref = TranslationDataset(**opts)
+    cache_dir = tmp_dir + "/cache"
+    for i in range(2):  # first run creates the cache, second run loads it
+      dataset = TranslationDataset(binary_cache_dir=cache_dir, **opts)
+      dataset._thread.join()
+      assert_equal(len(os.listdir(cache_dir)), 4)
+      assert_true(isinstance(dataset._data["data"], FlatTokenSeqs))
+      assert_equal(dataset._data["data"].get_seq_lens().tolist(), [4, 2, 5, 2])
+      for key in ["data", "classes"]:
+        assert_equal(_read_all_seqs(dataset, epoch=1, key=key), _read_all_seqs(ref, epoch=1, key=key))
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_LmDataset_set_shard():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    corpus_file = tmp_dir + "/corpus.txt"
+    with open(corpus_file, "w") as f:
+      f.write("".join(["%s\n" % " ".join(["hello", "world"][:1 + i % 2] * (1 + i % 3)) for i in range(11)]))
+    symbols_file = tmp_dir + "/symbols.txt"
+    with open(symbols_file, "w") as f:
+      f.write("[END] 0\nhello 1\nworld 2\n")
+    opts = dict(corpus_file=corpus_file, orth_symbols_map_file=symbols_file, word_based=True, seq_ordering="random")
+    ref = LmDataset(**opts)
+    assert_true(ref.supports_sharding())
+    for epoch in [1, 2]:
+      ref_seqs = _read_all_seqs(ref, epoch=epoch)
+      assert_equal(len(ref_seqs), 11)
+      for shard_index in range(3):
+        dataset = LmDataset(**opts)
+        dataset.set_shard(shard_index=shard_index, num_shards=3)
+        # Every shard loads its own seqs in its own order, i.e. seq idx 0 is the first seq of the shard.
+        assert_equal(_read_all_seqs(dataset, epoch=epoch), ref_seqs[shard_index::3])
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+  better_exchook.install()
+  if len(sys.argv) <= 1:
+    for k, v in sorted(globals().items()):
+      if k.startswith("test_"):
+        print("-" * 40)
+        print("Executing: %s" % k)
+        try:
+          v()
+        except unittest.SkipTest as exc:
+          print("SkipTest:", exc)
+        print("-" * 40)
+    print("Finished all tests.")
+  else:
+    assert len(sys.argv) >= 2
+    for arg in sys.argv[1:]:
+      print("Executing: %s" % arg)
+      if arg in globals():
+        globals()[arg]()  # assume function and execute
+      else:
+        eval(arg)  # assume Python code and execute
@@ -0,0 +1,178 @@
+
+import sys
+import os
+
+my_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path += [my_dir + "/.."]  # Python 3 hack
+
+from nose.tools import assert_equal, assert_true, assert_false
+from struct import pack
+import numpy
+import tempfile
+import unittest
+import zlib
+
+from SprintCache import FileArchive, FileArchiveBundle
+
+import better_exchook
+better_exchook.replace_traceback_format_tb()
+
+
+def _make_feat_entry(feats, times):
+  """
+  :param numpy.ndarray feats: (T,D)
+  :param numpy.ndarray times: (T,2)
+  :rtype: bytes
+  """
+  s = pack("I", len(b"vector-f32")) + b"vector-f32" + pack("I", len(feats))
+  for f, t in zip(feats, times):
+    s += pack("I", len(f)) + numpy.asarray(f, dtype="float32").tobytes() + pack("dd", *t)
+  return s
+
+
+def _make_align_entry(rle):
+  """
+  :param list[(int,list[int])|(int,int)] rle: (n, mixes) for n > 0, (n, mix) for n < 0, (0, time)
+  :rtype: bytes
+  """
+  size = sum([abs(n) for (n, _) in rle])
+  s = pack("I", len(b"flow-alignment")) + b"flow-alignment" + pack("i", 0) + b"ALIGNRLE" + pack("I", size)
+  for n, v in rle:
+    s += pack("b", n)
+    if n > 0:
+      s += b"".join([pack("i", m) for m in v])
+    else:
+      s += pack("i", v)
+  return s
+
+
+def _write_archive(filename, entries, compress=()):
+  """
+  Writes an archive without file info table, thus the reader has to scan it.
+
+  :param str filename:
+  :param list[(str,bytes)] entries:
+  :param list[str]|tuple[str] compress: entry names to zlib compress
+  """
+  with open(filename, "wb") as f:
+    f.write(FileArchive.SprintCacheHeader.encode("ascii"))
+    f.write(pack("b", 0))
+    for name, content in entries:
+      comp = 0
+      if name in compress:
+        compressed = zlib.compress(content)
+        comp = len(compressed)
+      f.write(pack("I", FileArchive.start_recovery_tag))
+      f.write(pack("i", len(name)) + name.encode("ascii"))
+      f.write(pack("iii", len(content), comp, 0))
+      f.write(compressed if comp else content)
+      f.write(pack("I", FileArchive.end_recovery_tag))
+
+
+def _get_test_entries():
+  rnd = numpy.random.RandomState(42)
+  feats = {"seq-%i" % i: rnd.normal(size=(5 + i, 3)).astype("float32") for i in range(3)}
+  entries = []
+  for name, feat in sorted(feats.items()):
+    times = numpy.array([(t, t + 1) for t in range(len(feat))], dtype="float64")
+    entries.append((name, _make_feat_entry(feat, times)))
+  align = [(2, [3, 1 << 26]), (-3, 5), (0, 0), (1, [7])]
+  entries.append(("align-0", _make_align_entry(align)))
+  return feats, entries
+
+
+def test_FileArchive_feat_array():
+  feats, entries = _get_test_entries()
+  tmp_dir = tempfile.mkdtemp()
+  filename = tmp_dir + "/feat.cache"
+  _write_archive(filename, entries, compress=["seq-1"])
+  for use_mmap in [False, True]:
+    archive = FileArchive(filename, use_mmap=use_mmap)
+    assert_equal(sorted(archive.file_list()), sorted([name for (name, _) in entries]))
+    for name, feat in sorted(feats.items()):
+      times, data = archive.read(name, "feat_array")
+      old_times, old_data = archive.read(name, "feat")
+      assert_equal(data.dtype, numpy.float32)
+      assert_equal(data.shape, feat.shape)
+      numpy.testing.assert_array_equal(data, feat)
+      numpy.testing.assert_array_equal(data, numpy.array(old_data))
+      numpy.testing.assert_array_equal(times, numpy.array(old_times))
+    archive.close_handle()
+    assert_false(archive.is_open())
+    times, data = archive.read("seq-0", "feat_array")  # reopens
+    numpy.testing.assert_array_equal(data, feats["seq-0"])
+
+
+def test_FileArchive_feat_array_varying_dim():
+  tmp_dir = tempfile.mkdtemp()
+  filename = tmp_dir + "/feat.cache"
+  # The later frames are smaller, thus the entry is smaller than count fixed records of the first dim.
+  feats = [numpy.ones((3,), dtype="float32"), numpy.ones((1,), dtype="float32"), numpy.ones((1,), dtype="float32")]
+  _write_archive(filename, [("seq-0", _make_feat_entry(feats, [(0., 1.), (1., 2.), (2., 3.)]))])
+  for use_mmap in [False, True]:
+    archive = FileArchive(filename, use_mmap=use_mmap)
+    try:
+      archive.read("seq-0", "feat_array")
+    except NotImplementedError as exc:
+      print("Expected exception: %s" % exc)
+    else:
+      assert False, "expected NotImplementedError"
+    times, data = archive.read("seq-0", "feat")
+    assert_equal([len(x) for x in data], [3, 1, 1])
+
+
+def test_FileArchive_align_raw_array():
+  _, entries = _get_test_entries()
+  tmp_dir = tempfile.mkdtemp()
+  filename = tmp_dir + "/align.cache"
+  _write_archive(filename, entries)
+  for use_mmap in [False, True]:
+    archive = FileArchive(filename, use_mmap=use_mmap)
+    align = archive.read("align-0", "align_raw_array")
+    old_align = archive.read("align-0", "align_raw")
+    assert_equal(align.tolist(), [3, 1 << 26, 5, 5, 5, 7])
+    assert_equal(align.tolist(), [a for (t, a, s) in old_align])
+
+
+def test_FileArchiveBundle_max_open_archives():
+  feats, entries = _get_test_entries()
+  tmp_dir = tempfile.mkdtemp()
+  filenames = []
+  for i, entry in enumerate(entries[:3]):
+    filenames.append("%s/part-%i.cache" % (tmp_dir, i))
+    _write_archive(filenames[-1], [entry])
+  with open(tmp_dir + "/all.bundle", "w") as f:
+    f.write("\n".join(filenames) + "\n")
+  bundle = FileArchiveBundle(tmp_dir + "/all.bundle", use_mmap=True, max_open_archives=2)
+  assert_equal(bundle.archives, {})  # lazily opened
+  assert_true(bundle.has_entry("seq-2"))
+  assert_equal(len(bundle.archives), 3)
+  for name in ["seq-0", "seq-1", "seq-2", "seq-0"]:
+    times, data = bundle.read(name, "feat_array")
+    numpy.testing.assert_array_equal(data, feats[name])
+    assert_equal(sum([a.is_open() for a in bundle.archives.values()]), 2)
+  assert_false(bundle.files["seq-1"].is_open())
+  assert_equal(bundle.get_entry_size("seq-1"), len(entries[1][1]))
+
+
+if __name__ == "__main__":
+  better_exchook.install()
+  if len(sys.argv) <= 1:
+    for k, v in sorted(globals().items()):
+      if k.startswith("test_"):
+        print("-" * 40)
+        print("Executing: %s" % k)
+        try:
+          v()
+        except unittest.SkipTest as exc:
+          print("SkipTest:", exc)
+        print("-" * 40)
+    print("Finished all tests.")
+  else:
+    assert len(sys.argv) >= 2
+    for arg in sys.argv[1:]:
+      print("Executing: %s" % arg)
+      if arg in globals():
+        globals()[arg]()  # assume function and execute
+      else:
+        eval(arg)  # assume Python code and execute
@@ -159,6 +159,116 @@ def test_DataProvider():
   assert_equal(classes.tolist(), [[1, 2, 0, 1, 2]])
 
 
+def test_DataProvider_num_workers():
+  from LmDataset import LmDataset
+  from TFDataPipeline import FeedDictDataProvider
+  import tempfile
+  import shutil
+  tmp_dir = tempfile.mkdtemp()
+  corpus_file = tmp_dir + "/corpus.txt"
+  with open(corpus_file, "w") as f:
+    f.write("".join(["%s\n" % " ".join(["hello", "world", "abc"][:1 + i % 3] * (1 + i % 4)) for i in range(23)]))
+  symbols_file = tmp_dir + "/symbols.txt"
+  with open(symbols_file, "w") as f:
+    f.write("[END] 0\nhello 1\nworld 2\nabc 3\n")
+  # LmDataset can only load the seqs in order, thus every worker must use its own shard.
+  dataset = LmDataset(
+    corpus_file=corpus_file, orth_symbols_map_file=symbols_file, word_based=True, seq_ordering="random")
+  extern_data = ExternData()
+  extern_data.init_from_dataset(dataset)
+
+  def get_all_batch_data(num_workers):
+    dataset.init_seq_order(epoch=2)
+    batches = dataset.generate_batches(recurrent_net=True, max_seqs=3, batch_size=100)
+    data_provider = FeedDictDataProvider(
+      tf_session=session, extern_data=extern_data,
+      data_keys=["data"],
+      dataset=dataset, batches=batches, num_workers=num_workers)
+    data_provider.start_threads()
+    res = []
+    while data_provider.have_more_data(session=session):
+      feed_dict, meta = data_provider.get_feed_dict()
+      data = feed_dict[extern_data.data["data"].placeholder]
+      seq_lens = feed_dict[extern_data.data["data"].get_sequence_lengths()]
+      res.append([(tag, data[i, :seq_lens[i]].tolist()) for (i, tag) in enumerate(meta["seq_tag"])])
+    assert data_provider.have_reached_end()
+    assert_equal(data_provider.get_complete_frac(), 1.)
+    data_provider.stop_threads()
+    return res
+
+  try:
+    expected = get_all_batch_data(num_workers=0)
+    res = get_all_batch_data(num_workers=3)
+    # The batches are from the shards, thus they are different, but the seqs are the same.
+    assert res != expected
+    expected_seqs = dict(sum(expected, []))
+    seqs = sum(res, [])
+    assert_equal(len(seqs), 23)
+    assert_equal(dict(seqs), expected_seqs)
+    # The order is deterministic.
+    assert_equal(get_all_batch_data(num_workers=3), res)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def test_DataProvider_num_workers_needs_sharding():
+  from GeneratingDataset import DummyDataset
+  from TFDataPipeline import FeedDictDataProvider
+  dataset = DummyDataset(input_dim=2, output_dim=3, num_seqs=11, seq_len=5)
+  assert not dataset.supports_sharding()
+  extern_data = ExternData()
+  extern_data.init_from_dataset(dataset)
+  dataset.init_seq_order(epoch=1)
+  data_provider = FeedDictDataProvider(
+    tf_session=session, extern_data=extern_data,
+    data_keys=["data", "classes"],
+    dataset=dataset, batches=dataset.generate_batches(recurrent_net=True, max_seqs=2, batch_size=20), num_workers=2)
+  try:
+    data_provider.start_threads()
+  except Exception as exc:
+    print("Expected exception: %s" % exc)
+    assert "sharding" in str(exc)
+  else:
+    assert False, "expected exception"
+
+
+def test_DataProvider_buffer_pool():
+  from GeneratingDataset import StaticDataset
+  from TFDataPipeline import FeedDictDataProvider
+  rnd = numpy.random.RandomState(42)
+  dataset = StaticDataset(
+    input_dim=2, output_dim=3,
+    data=[{"data": rnd.uniform(-1., 1., (seq_len, 2)).astype("float32"),
+           "classes": rnd.choice(range(3), (seq_len,)).astype("int32")}
+          for seq_len in [5, 9, 2, 4, 8, 3, 7]])
+  extern_data = ExternData()
+  extern_data.init_from_dataset(dataset)
+
+  def get_all_batch_data(use_buffer_pool):
+    dataset.init_seq_order(epoch=1)
+    batches = dataset.generate_batches(recurrent_net=True, max_seqs=2, batch_size=20)
+    data_provider = FeedDictDataProvider(
+      tf_session=session, extern_data=extern_data,
+      data_keys=["data", "classes"],
+      dataset=dataset, batches=batches, use_buffer_pool=use_buffer_pool)
+    res = []
+    while batches.has_more():
+      feed_dict, _ = data_provider.get_feed_dict(single_threaded=True)
+      data = feed_dict[extern_data.data["data"].placeholder]
+      res.append(data.copy())
+      data.fill(42.)  # the padding must be reset when the buffer is reused
+      batches.advance(1)
+    if use_buffer_pool:
+      assert data_provider.buffer_pool.num_allocations < len(res)
+    return res
+
+  expected = get_all_batch_data(use_buffer_pool=False)
+  res = get_all_batch_data(use_buffer_pool=True)
+  assert_equal(len(res), len(expected))
+  for data, expected_data in zip(res, expected):
+    numpy.testing.assert_array_equal(data, expected_data)
+
+
 def test_engine_train():
   from GeneratingDataset import DummyDataset
   seq_len = 5
@@ -186,6 +296,154 @@ def test_engine_train():
   engine.finalize()
 
 
+def test_engine_train_save_model_async():
+  from GeneratingDataset import DummyDataset
+  import glob
+  train_data = DummyDataset(input_dim=2, output_dim=3, num_seqs=4, seq_len=5)
+  train_data.init_seq_order(epoch=1)
+  config = Config()
+  config.update({
+    "model": "%s/model" % _get_tmp_dir(),
+    "save_model_async": True,
+    "num_outputs": 3,
+    "num_inputs": 2,
+    "network": {"output": {"class": "softmax", "loss": "ce"}},
+    "start_epoch": 1,
+    "num_epochs": 2
+  })
+  engine = Engine(config=config)
+  engine.init_train_from_config(config=config, train_data=train_data)
+  engine.train()
+  assert_equal(sorted(engine.get_existing_models(config).keys()), [1, 2])
+  model_filename = engine.get_epoch_model_filename()
+  assert not glob.glob(model_filename + ".tmp-*")
+  params = engine.network.get_params_serialized(session=engine.tf_session)
+  engine.tf_session.run(tf.global_variables_initializer())  # reset
+  engine.load_model(filename=model_filename)
+  params_loaded = engine.network.get_params_serialized(session=engine.tf_session)
+  for layer_name, layer_params in params.values_dict.items():
+    for param_name, value in layer_params.items():
+      numpy.testing.assert_array_equal(value, params_loaded.values_dict[layer_name][param_name])
+  engine.finalize()
+
+
+def test_engine_init_new_network_stream_params():
+  from GeneratingDataset import DummyDataset
+  train_data = DummyDataset(input_dim=2, output_dim=3, num_seqs=4, seq_len=5)
+  train_data.init_seq_order(epoch=1)
+  net_dict = {"hidden": {"class": "linear", "activation": "tanh", "n_out": 4},
+              "output": {"class": "softmax", "loss": "ce", "from": "hidden"}}
+  net_dict2 = {"hidden": {"class": "linear", "activation": "tanh", "n_out": 4},
+               "hidden2": {"class": "linear", "activation": "tanh", "n_out": 4, "from": "hidden"},
+               "output": {"class": "softmax", "loss": "ce", "from": "hidden2"}}
+  config = Config()
+  config.update({
+    "model": "%s/model" % _get_tmp_dir(),
+    "init_new_network_stream_params": True,
+    "num_outputs": 3,
+    "num_inputs": 2,
+    "network": net_dict,
+    "start_epoch": 1,
+    "num_epochs": 1
+  })
+  engine = Engine(config=config)
+  engine.init_train_from_config(config=config, train_data=train_data)
+  old_session = engine.tf_session
+  old_params = engine.network.get_params_serialized(session=engine.tf_session)
+  engine.init_new_network(net_dict2)
+  assert engine.tf_session is not old_session
+  assert old_session._closed
+  params = engine.network.get_params_serialized(session=engine.tf_session)
+  assert_equal(sorted(params.values_dict.keys()), ["hidden", "hidden2", "output"])
+  for layer_name in ["hidden", "output"]:
+    for param_name, value in old_params.values_dict[layer_name].items():
+      numpy.testing.assert_array_equal(value, params.values_dict[layer_name][param_name])
+  assert_equal(params.global_train_step, old_params.global_train_step)
+  engine.train()
+  engine.finalize()
+
+
+def test_engine_horovod_cost_balanced_batches_needs_random_access():
+  from GeneratingDataset import DummyDataset
+  dataset = DummyDataset(input_dim=2, output_dim=3, num_seqs=11, seq_len=5)
+  dataset.init_seq_order(epoch=1)
+  batches = dataset.generate_batches(recurrent_net=True, max_seqs=2, batch_size=10)
+  try:
+    Engine._get_horovod_cost_balanced_batches(dataset=dataset, batches=batches, rank=0, num_ranks=2)
+  except Exception as exc:
+    print("Expected exception: %s" % exc)
+    assert "random access" in str(exc)
+  else:
+    assert False, "expected exception"
+
+
+def test_engine_runner_timings_and_trace_steps():
+  from GeneratingDataset import DummyDataset
+  import glob
+  train_data = DummyDataset(input_dim=2, output_dim=3, num_seqs=4, seq_len=5)
+  train_data.init_seq_order(epoch=1)
+  tmp_dir = _get_tmp_dir()
+  engine = Engine(config=Config({
+    "network": {"output": {"class": "softmax", "loss": "ce"}},
+    "model": "%s/model" % tmp_dir,
+    "tf_log_dir": "%s/tf-log" % tmp_dir,
+    "tf_trace_steps": "1-2",
+    "num_outputs": 3,
+    "num_inputs": 2,
+    "num_epochs": 1,
+  }))
+  engine.init_train_from_config()
+  batches = train_data.generate_batches(
+    recurrent_net=engine.network.recurrent,
+    batch_size=200,
+    max_seqs=1,
+    used_data_keys=engine.network.used_data_keys)
+  trainer = Runner(engine=engine, dataset=train_data, batches=batches, train=True)
+  trainer.run(report_prefix="test_engine_runner_timings_and_trace_steps")
+  assert trainer.finalized
+  assert_equal(trainer.batch_shape_stats.num_batches, 4)
+  assert_equal(trainer.batch_shape_stats.num_frames["data"], 4 * 5)
+  assert_equal(sorted(trainer.step_timings.keys()), sorted(Runner.TimingParts + ("step",)))
+  assert trainer.timings["session_run"] > 0
+  traces = glob.glob("%s/tf-log/*/timeline-step*.trace.json" % tmp_dir)
+  assert_equal(
+    sorted([os.path.basename(fn) for fn in traces]), ["timeline-step1.trace.json", "timeline-step2.trace.json"])
+  engine.finalize()
+
+
+def test_engine_runner_trace_steps_forward_no_summaries():
+  from GeneratingDataset import DummyDataset
+  import glob
+  dataset = DummyDataset(input_dim=2, output_dim=3, num_seqs=2, seq_len=5)
+  dataset.init_seq_order(epoch=1)
+  tmp_dir = _get_tmp_dir()
+  engine = Engine(config=Config({
+    "task": "forward",
+    "allow_random_model_init": True,
+    "network": {"output": {"class": "linear", "activation": None, "n_out": 3}},
+    "tf_log_dir": "%s/tf-log" % tmp_dir,
+    "tf_trace_steps": [0],
+    "num_outputs": 3,
+    "num_inputs": 2,
+  }))
+  engine.init_network_from_config()
+  fetches = engine.network.get_fetches_dict(should_train=False, should_eval=False, with_summary=True)
+  assert "summary" not in fetches  # no losses, no updater, thus no summaries
+  batches = dataset.generate_batches(
+    recurrent_net=engine.network.recurrent,
+    batch_size=200,
+    max_seqs=1,
+    used_data_keys=engine.network.used_data_keys)
+  forwarder = Runner(
+    engine=engine, dataset=dataset, batches=batches, train=False, eval=False,
+    extra_fetches={"output": engine.network.get_default_output_layer().output.placeholder})
+  forwarder.run(report_prefix="test_engine_runner_trace_steps_forward_no_summaries")
+  assert forwarder.finalized
+  traces = glob.glob("%s/tf-log/*/timeline-step*.trace.json" % tmp_dir)
+  assert_equal([os.path.basename(fn) for fn in traces], ["timeline-step0.trace.json"])
+  engine.finalize()
+
+
 def test_engine_train_uneven_batches():
   rnd = numpy.random.RandomState(42)
   from GeneratingDataset import StaticDataset
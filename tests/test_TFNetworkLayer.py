@@ -80,6 +80,18 @@ def make_feed_dict(data_list, same_time=False, n_batch=3, n_time=7):
   return d
 
 
+def test_get_layer_class_lazy():
+  import TFNetworkLayer
+  import TFNetworkSigProcLayer
+  assert_equal(get_layer_class("linear"), LinearLayer)
+  assert_equal(get_layer_class("forward"), LinearLayer)
+  # Only the module which defines the layer class gets registered.
+  assert_equal(get_layer_class("batch_median_pooling"), TFNetworkSigProcLayer.BatchMedianPoolingLayer)
+  assert "TFNetworkSigProcLayer" in TFNetworkLayer._LayerClassModulesRegistered
+  assert "batch_median_pooling" in get_layer_class_name_list()  # registers all
+  assert "rec" in get_layer_class_name_list()
+
+
 def test_concat_sources():
   with make_scope() as session:
     network = TFNetwork(train_flag=True, extern_data=ExternData())
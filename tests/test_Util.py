@@ -6,7 +6,7 @@ import os
 my_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path += [my_dir + "/.."]  # Python 3 hack
 
-from nose.tools import assert_equal, assert_not_equal, assert_raises, assert_true, assert_is
+from nose.tools import assert_equal, assert_not_equal, assert_raises, assert_true, assert_false, assert_is
 from numpy.testing.utils import assert_almost_equal
 from Util import *
 import numpy as np
@@ -129,6 +129,33 @@ def test_NumbersDict_int_floordiv():
   assert_equal(b.dict["classes"], 1)
 
 
+def test_NumbersDict_iadd_different_keys():
+  a = NumbersDict(numbers_dict={"data": 3}, broadcast_value=1)
+  b = NumbersDict({"data": 2, "classes": 5})
+  a_ = a
+  a += b
+  assert a is a_
+  assert_equal(a.value, 1)
+  assert_equal(a.dict, {"data": 5, "classes": 6})
+
+
+def test_NumbersDict_any_compare():
+  a = NumbersDict({"data": 3, "classes": 5})
+  assert_true(a.any_compare(NumbersDict({"classes": 4}), (lambda x, y: x > y)))
+  assert_false(a.any_compare(NumbersDict({"classes": 6}), (lambda x, y: x > y)))
+  assert_true(a.any_compare(NumbersDict(4), (lambda x, y: x > y)))
+  assert_false(a.any_compare(NumbersDict(), (lambda x, y: x > y)))
+
+
+def test_NumbersDict_max_min():
+  a = NumbersDict({"data": 3, "classes": 5})
+  b = NumbersDict(numbers_dict={"data": 4}, broadcast_value=1)
+  assert_equal(NumbersDict.max([a, b]).dict, {"data": 4, "classes": 5})
+  assert_equal(NumbersDict.max([a, b]).value, 1)
+  assert_equal(NumbersDict.min([a, b]).dict, {"data": 3, "classes": 1})
+  assert_equal(NumbersDict.min([a, b, 2]).dict, {"data": 2, "classes": 1})
+
+
 def test_collect_class_init_kwargs():
   class A(object):
     def __init__(self, a):
@@ -181,6 +208,42 @@ def test_NativeCodeCompiler():
   assert_equal(lib.get_magic(), 42)
 
 
+def test_NativeCodeCompiler_shared_cache_dir():
+  import tempfile
+  import shutil
+  from threading import Thread
+  code = """
+    extern "C" int get_magic() { return 17; }
+    """
+  old_cache_dir_root = NativeCodeCompiler.CacheDirRoot
+  NativeCodeCompiler.CacheDirRoot = tempfile.mkdtemp()
+  try:
+    compilers = [
+      NativeCodeCompiler(base_name="test_NativeCodeCompiler_shared", code_version=1, code=code) for _ in range(3)]
+    assert len(set([native._mod_path for native in compilers])) == 1
+    assert compilers[0]._mod_path.startswith(NativeCodeCompiler.CacheDirRoot + "/")
+    # Concurrent compilation of the same op. Only one should compile it, the others should reuse it.
+    threads = [Thread(target=native.get_lib_filename) for native in compilers]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    mod_path = compilers[0]._mod_path
+    assert_equal(
+      sorted(os.listdir(mod_path)),
+      ["compile.log", "info.py", "test_NativeCodeCompiler_shared.cc", "test_NativeCodeCompiler_shared.so"])
+    compile_log_mtime = os.path.getmtime("%s/compile.log" % mod_path)
+    native = NativeCodeCompiler(base_name="test_NativeCodeCompiler_shared", code_version=1, code=code)
+    import ctypes
+    lib = native.load_lib_ctypes()
+    lib.get_magic.restype = ctypes.c_int
+    assert_equal(lib.get_magic(), 17)
+    assert_equal(os.path.getmtime("%s/compile.log" % mod_path), compile_log_mtime)  # not recompiled
+  finally:
+    shutil.rmtree(NativeCodeCompiler.CacheDirRoot)
+    NativeCodeCompiler.CacheDirRoot = old_cache_dir_root
+
+
 def test_Stats():
   rnd = numpy.random.RandomState(42)
   m = rnd.uniform(-2., 10., (1000, 3))
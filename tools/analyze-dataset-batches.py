@@ -3,6 +3,8 @@
 """
 Goes through a dataset (similar as dump-dataset.py), but does the training batch creation,
 and calculate statistics about how much seqs we have per batch, how much zero padding there is, etc.
+The statistics are collected via :class:`EngineBatch.BatchShapeStats`,
+i.e. they are exactly the same as the batch shape stats which the TF engine reports during training.
 """
 
 from __future__ import print_function, division
@@ -22,8 +24,9 @@ sys.path.append(returnn_dir)
 import rnn
 from Log import log
 import Util
-from Util import Stats, hms, NumbersDict
+from Util import Stats, hms
 from Dataset import Batch, Dataset, init_dataset
+from EngineBatch import BatchShapeStats
 from Config import Config
 
 
@@ -55,6 +58,7 @@ def analyze_dataset(options):
   seq_drop = config.float('seq_drop', 0.0)
   max_seq_length = config.typed_value('max_seq_length', None) or config.float('max_seq_length', 0)
   max_pad_size = config.typed_value("max_pad_size", None)
+  bucket_boundaries = config.typed_value("batch_bucket_boundaries", None)
 
   batches = dataset.generate_batches(
     recurrent_net=recurrent,
@@ -62,13 +66,12 @@ def analyze_dataset(options):
     max_seqs=max_seqs,
     max_seq_length=max_seq_length,
     max_pad_size=max_pad_size,
+    bucket_boundaries=bucket_boundaries,
     seq_drop=seq_drop,
     used_data_keys=used_data_keys)
 
   step = 0
-  total_num_seqs = 0
-  total_num_frames = NumbersDict()
-  total_num_used_frames = NumbersDict()
+  batch_shape_stats = BatchShapeStats()
 
   try:
     while batches.has_more():
@@ -94,17 +97,15 @@ def analyze_dataset(options):
         remaining_estimated = total_time_estimated - start_elapsed
         progress += " (%s)" % hms(remaining_estimated)
 
-      batch_max_time = NumbersDict.max([seq.frame_length for seq in batch.seqs]) * len(batch.seqs)
-      batch_num_used_frames = sum([seq.frame_length for seq in batch.seqs], NumbersDict())
-      total_num_seqs += len(batch.seqs)
+      batch_info = batch_shape_stats.collect_batch(batch, data_keys=used_data_keys)
       num_seqs_stats.collect(numpy.array([len(batch.seqs)]))
-      total_num_frames += batch_max_time
-      total_num_used_frames += batch_num_used_frames
 
       print(
         "%s, batch %i, num seqs %i, frames %s, used %s (%s)" % (
           progress, step, len(batch.seqs),
-          batch_max_time, batch_num_used_frames, batch_num_used_frames / batch_max_time),
+          batch_info["max_frames"][options.key] * batch_info["num_slices"], batch_info["num_frames"][options.key],
+          1. - BatchShapeStats.get_padding_ratio(
+            batch_info["num_frames"][options.key], batch_info["max_frames"][options.key] * batch_info["num_slices"])),
         file=log.v5)
       if show_interactive_process_bar:
         Util.progress_bar_with_time(complete_frac, prefix=progress_prefix)
@@ -117,13 +118,17 @@ def analyze_dataset(options):
       hms(time.time() - start_time), batches.has_more()), file=log.v2)
     print("Dataset epoch %i, order %r." % (dataset.epoch, dataset.seq_ordering))
     print("Num batches (steps): %i" % step, file=log.v1)
-    print("Num seqs: %i" % total_num_seqs, file=log.v1)
+    print("Num seqs: %i" % batch_shape_stats.num_seqs, file=log.v1)
     num_seqs_stats.dump(stream=log.v1, stream_prefix="Batch num seqs ")
     for key in used_data_keys:
+      if key not in batch_shape_stats.num_padded_frames.dict:
+        continue
       print("Data key %r:" % key, file=log.v1)
-      print("  Num frames: %s" % total_num_frames[key], file=log.v1)
-      print("  Num used frames: %s" % total_num_used_frames[key], file=log.v1)
-      print("  Fraction used frames: %s" % (total_num_used_frames / total_num_frames)[key], file=log.v1)
+      print("  Num frames: %s" % batch_shape_stats.num_padded_frames[key], file=log.v1)
+      print("  Num used frames: %s" % batch_shape_stats.num_frames[key], file=log.v1)
+      print("  Fraction used frames: %s" % (1. - batch_shape_stats.get_padding_ratios()[key]), file=log.v1)
+    print("Batch shape stats (same as reported by the TF engine):", file=log.v1)
+    batch_shape_stats.dump(stream=log.v1, stream_prefix="  ")
     dataset.finish_epoch()
 
 
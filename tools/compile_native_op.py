@@ -1,5 +1,16 @@
 #!/usr/bin/env python3
 
+"""
+Compiles native ops, e.g. to precompile all the ops a config needs into a (shared) cache dir,
+such that the jobs later only need to load the libs. Example::
+
+  compile_native_op.py --config my.config --network_variants train search --jobs 4 --cache_dir /shared/cache
+
+Each network variant and each ``--native_op`` entry is one job, and ``--jobs`` runs these jobs in parallel.
+The ops of one network are compiled one after another within its job
+(the network construction needs each op before it can continue),
+so ``--jobs`` has no effect for a single network variant.
+"""
 
 from __future__ import print_function
 
@@ -45,27 +56,94 @@ def init(config_filename, log_verbosity):
   assert Util.BackendEngine.is_tensorflow_selected(), "this is only for TensorFlow"
   rnn.init_faulthandler()
   rnn.init_config_json_network()
-  if 'network' in config.typed_dict:
-    print("Loading network")
-    from TFNetwork import TFNetwork
+
+
+def make_network(variant):
+  """
+  Constructs the network from the config, which will compile all the native ops it needs.
+
+  :param str variant: "train", "eval" or "search"
+  """
+  print("Loading network, variant %r" % variant)
+  from TFNetwork import TFNetwork
+  with tf.Graph().as_default():
     network = TFNetwork(
       name="root",
       config=config,
       rnd_seed=1,
-      train_flag=False,
-      eval_flag=True,
-      search_flag=False)
+      train_flag=variant == "train",
+      eval_flag=variant in {"train", "eval"},
+      search_flag=variant == "search")
     network.construct_from_dict(config.typed_dict["network"])
 
 
+def run_job(job, args):
+  """
+  :param (str,str) job: ("native_op", op name) or ("network", variant)
+  :param argparse.Namespace args:
+  :return: list of compiled libs
+  :rtype: list[str]
+  """
+  from TFUtil import NativeCodeCompiler
+  import NativeOp
+  from TFNativeOp import make_op, OpMaker
+  NativeCodeCompiler.CollectedCompilers = []
+  kind, name = job
+  if kind == "native_op":
+    print("Loading native op %r" % name)
+    make_op(getattr(NativeOp, name), compiler_opts={"verbose": True},
+            search_for_numpy_blas=args.search_for_numpy_blas, blas_lib=args.blas_lib)
+  elif kind == "network":
+    make_network(variant=name)
+  else:
+    raise ValueError("invalid job %r" % (job,))
+
+  libs = []
+  if OpMaker.with_cuda and OpMaker.tf_blas_gemm_workaround:
+    print('CUDA BLAS lib:', OpMaker.cuda_blas_gemm_so_filename())
+    libs.append(OpMaker.cuda_blas_gemm_so_filename())
+  elif OpMaker.with_cuda is False:
+    print('No CUDA.')
+
+  for compiler in NativeCodeCompiler.CollectedCompilers:
+    assert isinstance(compiler, NativeCodeCompiler)
+    print(compiler)
+    libs.append(compiler._so_filename)
+  return libs
+
+
+def run_job_in_subprocess(job, args):
+  """
+  Called via multiprocessing in a new process.
+
+  :param (str,str) job:
+  :param argparse.Namespace args:
+  :return: list of compiled libs
+  :rtype: list[str]
+  """
+  from TFUtil import CudaEnv
+  CudaEnv.verbose_find_cuda = True
+  init(config_filename=args.config, log_verbosity=args.verbosity)
+  return run_job(job, args)
+
+
 def main(argv):
+  """
+  Main entry.
+  """
   from TFUtil import CudaEnv, NativeCodeCompiler
   CudaEnv.verbose_find_cuda = True
-  NativeCodeCompiler.CollectedCompilers = []
 
   argparser = argparse.ArgumentParser(description='Compile some op')
   argparser.add_argument('--config', help="filename to config-file")
-  argparser.add_argument('--native_op', help="op name. e.g. 'LstmGenericBase'")
+  argparser.add_argument('--native_op', nargs="*", default=[], help="op name(s). e.g. 'LstmGenericBase'")
+  argparser.add_argument('--network_variants', nargs="*", default=["eval"], choices=["train", "eval", "search"],
+                         help="construct the network from the config in these variants (default: eval)")
+  argparser.add_argument('--jobs', type=int, default=1,
+                         help="number of parallel processes. each native op and each network variant is one job. "
+                              "the ops of one network variant are compiled sequentially")
+  argparser.add_argument('--cache_dir',
+                         help="native op cache dir, e.g. shared between nodes (default: native_op_cache_dir)")
   argparser.add_argument('--blas_lib', default=None,
                          help="specify which blas lib to use (path to .so or file name to search for)")
   argparser.add_argument('--search_for_numpy_blas', dest='search_for_numpy_blas', action='store_true',
@@ -75,26 +153,34 @@ def main(argv):
   argparser.add_argument("--verbosity", default=4, type=int, help="5 for all seqs (default: 4)")
   argparser.add_argument("--output_file", help='if given, will write the list of libs to this file')
   args = argparser.parse_args(argv[1:])
+  if args.cache_dir:
+    # Via env, such that the subprocesses also use it. The config option native_op_cache_dir has precedence.
+    os.environ["RETURNN_NATIVE_CACHE_DIR"] = args.cache_dir
   init(config_filename=args.config, log_verbosity=args.verbosity)
+  print("Native op cache dir:", NativeCodeCompiler.get_cache_dir_root())
 
-  import NativeOp
-  from TFNativeOp import make_op, OpMaker
-  if args.native_op:
-    print("Loading native op %r" % args.native_op)
-    make_op(getattr(NativeOp, args.native_op), compiler_opts={"verbose": True},
-            search_for_numpy_blas=args.search_for_numpy_blas, blas_lib=args.blas_lib)
-
+  jobs = [("native_op", name) for name in args.native_op]
+  if "network" in config.typed_dict:
+    jobs += [("network", variant) for variant in args.network_variants]
   libs = []
-  if OpMaker.with_cuda and OpMaker.tf_blas_gemm_workaround:
-    print('CUDA BLAS lib:', OpMaker.cuda_blas_gemm_so_filename())
-    libs.append(OpMaker.cuda_blas_gemm_so_filename())
-  elif OpMaker.with_cuda is False:
-    print('No CUDA.')
-
-  for compiler in NativeCodeCompiler.CollectedCompilers:
-    assert isinstance(compiler, NativeCodeCompiler)
-    print(compiler)
-    libs.append(compiler._so_filename)
+  if args.jobs > 1 and len(jobs) <= 1:
+    print("Only %i job, thus --jobs %i has no effect." % (len(jobs), args.jobs))
+  if args.jobs > 1 and len(jobs) > 1:
+    # Each job in its own fresh process. Jobs which need the same op will wait for each other (via the lock file),
+    # and the op will only be compiled once.
+    import multiprocessing
+    from functools import partial
+    print("Running %i jobs with %i processes." % (len(jobs), args.jobs))
+    pool = multiprocessing.get_context("spawn").Pool(processes=args.jobs)
+    try:
+      for job_libs in pool.map(partial(run_job_in_subprocess, args=args), jobs, chunksize=1):
+        libs += [fn for fn in job_libs if fn not in libs]
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    for job in jobs:
+      libs += [fn for fn in run_job(job, args) if fn not in libs]
 
   if libs:
     print("libs:")
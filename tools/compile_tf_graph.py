@@ -86,7 +86,8 @@ class RecStepByStepLayer(RecLayer):
   This also takes care of all needed state, and latent variables (via :class:`ChoiceLayer`).
   All the state is kept in variables, such that you can avoid feeding/fetching.
 
-  E.g., if you want to implement beam search in an external application which uses the compiled graph,
+  E.g., if you want to implement beam search in an external application which uses the compiled graph
+  (see `tf_rec_step_by_step_decoder.py` for such an implementation in Python),
   you would compile the graph with search_flag disabled (such that RETURNN does not do any related logic),
   enable this recurrent step-by-step compilation, and then do the following TF session runs:
 
@@ -139,6 +140,8 @@ class RecStepByStepLayer(RecLayer):
     :param str rec_layer_name:
     :param TFNetwork network:
     :param str|None output_file_name:
+    :return: the info, as it is stored in the JSON. see the class docstring, and `tf_rec_step_by_step_decoder.py`
+    :rtype: dict[str]
     """
     assert rec_layer_name in network.layers
     rec_layer = network.layers[rec_layer_name]
@@ -191,6 +194,7 @@ class RecStepByStepLayer(RecLayer):
       with open(output_file_name, "w") as f:
         f.write(info_str)
       print("Stored rec-step-by-step info JSON in file:", output_file_name)
+    return info
 
   class StateVar:
     """
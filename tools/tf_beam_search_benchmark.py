@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for beam search decoding with :class:`TFNetworkRecLayer.RecLayer` and :class:`ChoiceLayer`.
+Builds the network on random weights, feeds random input from :class:`GeneratingDataset.DummyDataset`,
+and sweeps over beam size, batch size and input seq length.
+For each combination, it reports the throughput (seqs/sec), the latency per decoder step, and the peak memory.
+
+Modes (``--modes``):
+
+  * ``in_graph``: the whole search is a single session run, via the ``tf.while_loop`` of the rec layer,
+    where :class:`ChoiceLayer` uses :func:`TFUtil.beam_search`.
+  * ``step_by_step``: the rec layer is compiled via :class:`RecStepByStepLayer` (see `compile_tf_graph.py`),
+    and the search is done by :class:`StepByStepDecoder` (see `tf_rec_step_by_step_decoder.py`),
+    i.e. one session run per decoder step, and finished hyps are removed from the batch.
+    The peak memory is not measured in this mode.
+
+For the latency of streaming/online decoding, i.e. when seqs arrive one by one, use ``--batch_sizes 1``.
+
+Networks (``--network``):
+
+  * ``attention``: BLSTM encoder, LSTM decoder with dot attention, label-synchronous (until end-of-seq label 0).
+    With random weights, the decoder mostly runs until its max seq len, which is the encoder length.
+  * ``transducer``: BLSTM encoder, LSTM decoder which is frame-synchronous over the encoder frames,
+    i.e. one choice per encoder frame.
+  * a config file which defines ``network`` (with a rec layer "output"), and optionally ``extern_data``.
+
+By default, everything runs on CPU. Example::
+
+  tf_beam_search_benchmark.py --network attention --beam_sizes 1 4 12 --batch_sizes 1 16 --seq_lens 20 100
+  tf_beam_search_benchmark.py --network attention --modes in_graph step_by_step --batch_sizes 1
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import json
+import resource
+import argparse
+import numpy
+import tensorflow as tf
+
+my_dir = os.path.dirname(os.path.abspath(__file__))
+returnn_dir = os.path.dirname(my_dir)
+sys.path.insert(0, returnn_dir)
+
+import better_exchook
+from Log import log
+from Config import Config
+from TFNetwork import TFNetwork, ExternData
+from TFNetworkRecLayer import RecLayer
+from GeneratingDataset import DummyDataset
+from compile_tf_graph import RecStepByStepLayer
+from tf_rec_step_by_step_decoder import StepByStepDecoder
+
+
+def get_encoder_net_dict(num_layers, dim):
+  """
+  :param int num_layers:
+  :param int dim:
+  :return: layers "lstm<i>_fw", "lstm<i>_bw", and "encoder"
+  :rtype: dict[str,dict[str]]
+  """
+  net_dict = {}
+  src = ["data"]
+  for i in range(num_layers):
+    for direction, prefix in [(1, "fw"), (-1, "bw")]:
+      net_dict["lstm%i_%s" % (i, prefix)] = {
+        "class": "rec", "unit": "LSTMBlock", "n_out": dim, "direction": direction, "from": src}
+    src = ["lstm%i_fw" % i, "lstm%i_bw" % i]
+  net_dict["encoder"] = {"class": "copy", "from": src}
+  return net_dict
+
+
+def get_attention_net_dict(beam_size, num_encoder_layers, dim):
+  """
+  :param int beam_size:
+  :param int num_encoder_layers:
+  :param int dim:
+  :rtype: dict[str,dict[str]]
+  """
+  net_dict = get_encoder_net_dict(num_layers=num_encoder_layers, dim=dim)
+  net_dict["enc_ctx"] = {"class": "linear", "activation": "tanh", "from": ["encoder"], "n_out": dim}
+  net_dict["output"] = {
+    "class": "rec", "from": [], "target": "classes", "max_seq_len": "max_len_from('base:encoder')",
+    "unit": {
+      "output": {"class": "choice", "target": "classes", "beam_size": beam_size, "from": ["output_prob"],
+                 "initial_output": 0},
+      "end": {"class": "compare", "from": ["output"], "value": 0},
+      "target_embed": {"class": "linear", "activation": None, "with_bias": False, "from": ["output"],
+                       "n_out": dim, "initial_output": 0},
+      "s": {"class": "rnn_cell", "unit": "LSTMBlock", "from": ["prev:target_embed", "prev:att"], "n_out": dim},
+      "c_in": {"class": "linear", "activation": "tanh", "from": ["s"], "n_out": dim},
+      "att": {"class": "dot_attention", "from": ["c_in"], "base": "base:encoder", "base_ctx": "base:enc_ctx",
+              "n_out": dim * 2},
+      "readout": {"class": "linear", "activation": "tanh", "from": ["s", "att"], "n_out": dim},
+      "output_prob": {"class": "softmax", "from": ["readout"], "target": "classes"}}}
+  net_dict["decision"] = {"class": "decide", "from": ["output"], "target": "classes"}
+  return net_dict
+
+
+def get_transducer_net_dict(beam_size, num_encoder_layers, dim):
+  """
+  :param int beam_size:
+  :param int num_encoder_layers:
+  :param int dim:
+  :rtype: dict[str,dict[str]]
+  """
+  net_dict = get_encoder_net_dict(num_layers=num_encoder_layers, dim=dim)
+  net_dict["output"] = {
+    "class": "rec", "from": ["encoder"], "target": "classes",
+    "unit": {
+      "output": {"class": "choice", "target": "classes", "beam_size": beam_size, "from": ["output_prob"],
+                 "initial_output": 0},
+      "prev_out_embed": {"class": "linear", "activation": None, "with_bias": False, "from": ["prev:output"],
+                         "n_out": dim},
+      "s": {"class": "rnn_cell", "unit": "LSTMBlock", "from": ["prev_out_embed"], "n_out": dim},
+      "joint": {"class": "linear", "activation": "tanh", "from": ["data:source", "s"], "n_out": dim},
+      "output_prob": {"class": "softmax", "from": ["joint"], "target": "classes"}}}
+  net_dict["decision"] = {"class": "decide", "from": ["output"], "target": "classes"}
+  return net_dict
+
+
+def create_network(args, beam_size, step_by_step=False):
+  """
+  :param argparse.Namespace args:
+  :param int beam_size:
+  :param bool step_by_step: compile the rec layer "output" via :class:`RecStepByStepLayer`, without search flag
+  :rtype: TFNetwork
+  """
+  config = Config()
+  if args.network in {"attention", "transducer"}:
+    get_net_dict = {"attention": get_attention_net_dict, "transducer": get_transducer_net_dict}[args.network]
+    net_dict = get_net_dict(beam_size=beam_size, num_encoder_layers=args.num_encoder_layers, dim=args.dim)
+    extern_data_opts = {
+      "data": {"dim": args.input_dim},
+      "classes": {"dim": args.num_classes, "sparse": True, "available_for_inference": False}}
+  else:
+    config.load_file(args.network)
+    net_dict = config.typed_value("network")
+    for layer in net_dict["output"]["unit"].values():
+      if layer["class"] == "choice":
+        layer["beam_size"] = beam_size
+    extern_data_opts = config.typed_value("extern_data") or {
+      "data": {"dim": args.input_dim},
+      "classes": {"dim": args.num_classes, "sparse": True, "available_for_inference": False}}
+  if step_by_step:
+    net_dict.pop("decision", None)  # the search is done outside of the graph
+    RecStepByStepLayer.prepare_compile(rec_layer_name="output", net_dict=net_dict)
+  extern_data = ExternData(extern_data_opts)
+  network = TFNetwork(
+    config=config, extern_data=extern_data, rnd_seed=args.seed, train_flag=False, eval_flag=False,
+    search_flag=not step_by_step)
+  network.construct_from_dict(net_dict)
+  return network
+
+
+def get_peak_memory(run_metadata):
+  """
+  :param tf.RunMetadata run_metadata: from a run with tf.RunOptions.FULL_TRACE
+  :return: sum over all allocators of the peak allocated bytes
+  :rtype: int
+  """
+  peak_by_allocator = {}
+  for dev_stats in run_metadata.step_stats.dev_stats:
+    for node_stats in dev_stats.node_stats:
+      for mem in node_stats.memory:
+        key = (dev_stats.device, mem.allocator_name)
+        peak_by_allocator[key] = max(
+          peak_by_allocator.get(key, 0), mem.allocator_bytes_in_use, mem.peak_bytes)
+  return sum(peak_by_allocator.values())
+
+
+def get_dummy_input(batch_size, seq_len, input_dim):
+  """
+  :param int batch_size:
+  :param int seq_len:
+  :param int input_dim:
+  :return: seqs, each of shape (seq_len,input_dim)
+  :rtype: list[numpy.ndarray]
+  """
+  dataset = DummyDataset(input_dim=input_dim, output_dim=1, num_seqs=batch_size, seq_len=seq_len)
+  dataset.init_seq_order(epoch=1)
+  dataset.load_seqs(0, batch_size)
+  return [dataset.get_data(i, "data") for i in range(batch_size)]
+
+
+def benchmark(session, network, batch_size, seq_len, num_runs, input_dim):
+  """
+  :param tf.Session session:
+  :param TFNetwork network:
+  :param int batch_size:
+  :param int seq_len:
+  :param int num_runs:
+  :param int input_dim:
+  :return: result dict
+  :rtype: dict[str,float|int]
+  """
+  data = network.extern_data.data["data"]
+  feed_dict = {
+    data.placeholder: numpy.stack(get_dummy_input(batch_size=batch_size, seq_len=seq_len, input_dim=input_dim)),
+    data.size_placeholder[0]: [seq_len] * batch_size}
+  rec_layer = network.layers["output"]
+  assert isinstance(rec_layer, RecLayer)
+  fetches = (rec_layer.output.placeholder, rec_layer.output.get_sequence_lengths())
+
+  # The first run includes the lazy initialization of the session, thus it is not counted.
+  session.run(fetches, feed_dict=feed_dict)
+
+  run_metadata = tf.RunMetadata()
+  session.run(
+    fetches, feed_dict=feed_dict,
+    options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+
+  run_times = []
+  num_steps = 0
+  for _ in range(num_runs):
+    start_time = time.time()
+    _, out_seq_lens = session.run(fetches, feed_dict=feed_dict)
+    run_times.append(time.time() - start_time)
+    num_steps += int(max(out_seq_lens))
+  run_times = numpy.array(run_times)
+  return {
+    "seqs_per_sec": batch_size * num_runs / numpy.sum(run_times),
+    "run_time_mean": numpy.mean(run_times),
+    "run_time_p90": numpy.percentile(run_times, 90),
+    "num_steps_mean": num_steps / float(num_runs),
+    "step_latency": numpy.sum(run_times) / max(num_steps, 1),
+    "peak_mem_bytes": get_peak_memory(run_metadata),
+    "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def benchmark_step_by_step(decoder, batch_size, seq_len, num_runs, input_dim):
+  """
+  :param StepByStepDecoder decoder:
+  :param int batch_size:
+  :param int seq_len:
+  :param int num_runs:
+  :param int input_dim:
+  :return: result dict, like :func:`benchmark`
+  :rtype: dict[str,float|int|None]
+  """
+  inputs = get_dummy_input(batch_size=batch_size, seq_len=seq_len, input_dim=input_dim)
+  decoder.decode(inputs)  # not counted, see benchmark()
+  run_times = []
+  num_steps = 0
+  for _ in range(num_runs):
+    start_time = time.time()
+    decoder.decode(inputs)
+    run_times.append(time.time() - start_time)
+    num_steps += decoder.num_steps
+  run_times = numpy.array(run_times)
+  return {
+    "seqs_per_sec": batch_size * num_runs / numpy.sum(run_times),
+    "run_time_mean": numpy.mean(run_times),
+    "run_time_p90": numpy.percentile(run_times, 90),
+    "num_steps_mean": num_steps / float(num_runs),
+    "step_latency": numpy.sum(run_times) / max(num_steps, 1),
+    "peak_mem_bytes": None,
+    "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def main():
+  """
+  Main entry.
+  """
+  arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  arg_parser.add_argument("--network", default="attention", help="'attention', 'transducer' or a config file")
+  arg_parser.add_argument("--modes", nargs="+", default=["in_graph"], choices=["in_graph", "step_by_step"])
+  arg_parser.add_argument("--beam_sizes", type=int, nargs="+", default=[1, 4, 12])
+  arg_parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 16])
+  arg_parser.add_argument("--seq_lens", type=int, nargs="+", default=[20, 100], help="input (encoder) seq lens")
+  arg_parser.add_argument("--num_runs", type=int, default=5, help="timed runs per combination")
+  arg_parser.add_argument("--input_dim", type=int, default=40)
+  arg_parser.add_argument("--num_classes", type=int, default=1000)
+  arg_parser.add_argument("--dim", type=int, default=128, help="hidden dim of the built-in networks")
+  arg_parser.add_argument("--num_encoder_layers", type=int, default=2)
+  arg_parser.add_argument("--seed", type=int, default=42)
+  arg_parser.add_argument("--end_label", type=int, default=0, help="for step_by_step. -1 to disable")
+  arg_parser.add_argument("--device", default="cpu", help="e.g. 'cpu' (default) or 'gpu'")
+  arg_parser.add_argument("--num_threads", type=int, help="intra/inter op parallelism threads")
+  arg_parser.add_argument("--output_json", help="write all results to this file, e.g. to compare them in CI")
+  arg_parser.add_argument("--verbosity", type=int, default=2)
+  args = arg_parser.parse_args()
+  better_exchook.install()
+  log.initialize(verbosity=[args.verbosity])
+
+  session_opts = {}
+  if args.device == "cpu":
+    session_opts["device_count"] = {"GPU": 0}
+  if args.num_threads:
+    session_opts["intra_op_parallelism_threads"] = args.num_threads
+    session_opts["inter_op_parallelism_threads"] = args.num_threads
+
+  results = []
+  print("%12s %6s %6s %7s | %10s %10s %10s %10s %11s %11s" % (
+    "mode", "beam", "batch", "seq_len", "seqs/sec", "run (ms)", "steps", "step (ms)", "peak mem MB", "max rss MB"))
+  for mode in args.modes:
+    for beam_size in args.beam_sizes:
+      # The beam size is part of the graph. The batch size and seq len are dynamic.
+      with tf.Graph().as_default() as graph:
+        step_by_step = mode == "step_by_step"
+        with tf.device("/%s:0" % args.device):
+          network = create_network(args, beam_size=beam_size, step_by_step=step_by_step)
+          info = RecStepByStepLayer.post_compile(rec_layer_name="output", network=network) if step_by_step else None
+        input_dim = network.extern_data.data["data"].dim
+        with tf.Session(graph=graph, config=tf.ConfigProto(**session_opts)) as session:
+          network.initialize_params(session)
+          decoder = StepByStepDecoder(
+            session=session, info=info, beam_size=beam_size,
+            end_label=args.end_label if args.end_label >= 0 else None) if step_by_step else None
+          for batch_size in args.batch_sizes:
+            for seq_len in args.seq_lens:
+              if step_by_step:
+                result = benchmark_step_by_step(
+                  decoder=decoder, batch_size=batch_size, seq_len=seq_len, num_runs=args.num_runs,
+                  input_dim=input_dim)
+              else:
+                result = benchmark(
+                  session=session, network=network, batch_size=batch_size, seq_len=seq_len, num_runs=args.num_runs,
+                  input_dim=input_dim)
+              print("%12s %6i %6i %7i | %10.2f %10.2f %10.1f %10.3f %11s %11.1f" % (
+                mode, beam_size, batch_size, seq_len,
+                result["seqs_per_sec"], result["run_time_mean"] * 1000., result["num_steps_mean"],
+                result["step_latency"] * 1000.,
+                "%.1f" % (result["peak_mem_bytes"] / 1024. ** 2) if result["peak_mem_bytes"] is not None else "-",
+                result["max_rss_bytes"] / 1024. ** 2))
+              sys.stdout.flush()
+              result.update({
+                "network": args.network, "mode": mode,
+                "beam_size": beam_size, "batch_size": batch_size, "seq_len": seq_len})
+              results.append(result)
+
+  if args.output_json:
+    with open(args.output_json, "w") as f:
+      json.dump([{k: (v.item() if isinstance(v, numpy.generic) else v) for (k, v) in r.items()} for r in results],
+                f, indent=2, sort_keys=True)
+    print("Wrote results to %s." % args.output_json)
+
+
+if __name__ == '__main__':
+  main()
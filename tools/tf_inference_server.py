@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+
+"""
+Inference server for a TF graph which was compiled via `compile_tf_graph.py`.
+
+The graph and the model params are loaded once, into a single `tf.Session`.
+Concurrent requests are batched together into a single `session.run`
+(up to ``--max_seqs`` seqs and ``--max_frames`` frames,
+waiting at most ``--max_latency`` seconds for further requests).
+The input is copied into preallocated buffers, which only grow when needed.
+
+Example::
+
+  compile_tf_graph.py returnn.config --output_file graph.meta
+  tf_inference_server.py --graph graph.meta --chkpt net-model/network.040 --output_layer output --port 10687
+
+HTTP interface: POST to /classify with JSON ``{"data": [[...], ...]}`` (time-major features, or label indices).
+The response is JSON ``{"result": [...], "queue_latency": ..., "compute_latency": ...}``.
+
+Stdin interface (``--stdin``): one JSON input per line, one JSON response per line, in the same order.
+
+See `tf_inference_server_benchmark.py` for a load generator.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import typing
+import numpy
+import tensorflow as tf
+try:
+  # noinspection PyCompatibility
+  from Queue import Queue, Empty
+except ImportError:
+  # noinspection PyCompatibility
+  from queue import Queue, Empty
+
+my_dir = os.path.dirname(os.path.abspath(__file__))
+returnn_dir = os.path.dirname(my_dir)
+sys.path.insert(0, returnn_dir)
+
+# No RETURNN dependency needed for the server itself. Just TF itself.
+
+
+class InferenceRequest:
+  """
+  A single seq to classify.
+  """
+
+  def __init__(self, data):
+    """
+    :param numpy.ndarray data: shape (time,) (sparse) or (time,dim)
+    """
+    self.data = data
+    self.num_frames = data.shape[0]
+    self.result = None  # type: typing.Optional[numpy.ndarray]
+    self.exception = None  # type: typing.Optional[BaseException]
+    self.done = threading.Event()
+    self.time_received = time.time()
+    self.time_compute_start = None  # type: typing.Optional[float]
+    self.time_compute_end = None  # type: typing.Optional[float]
+
+  def wait(self):
+    """
+    :return: result
+    :rtype: numpy.ndarray
+    """
+    self.done.wait()
+    if self.exception:
+      raise self.exception
+    return self.result
+
+  def get_latency_info(self):
+    """
+    :rtype: dict[str,float]
+    """
+    return {
+      "queue_latency": self.time_compute_start - self.time_received,
+      "compute_latency": self.time_compute_end - self.time_compute_start}
+
+
+class InferenceEngine:
+  """
+  Holds the session, and runs the batching loop in a background thread.
+  """
+
+  def __init__(self, graph_filename, chkpt_filename, output_tensor_name,
+               input_tensor_name="extern_data/placeholders/data/data:0",
+               input_size_tensor_name="extern_data/placeholders/data/data_dim0_size:0",
+               output_size_tensor_name=None,
+               max_seqs=32, max_frames=20000, max_latency=0.01):
+    """
+    :param str graph_filename: .pb, .pbtxt, .meta or .metatxt, via compile_tf_graph.py
+    :param str chkpt_filename: TF checkpoint with the model params
+    :param str output_tensor_name: batch-major, e.g. "output/output_batch_major:0"
+    :param str input_tensor_name:
+    :param str input_size_tensor_name:
+    :param str|None output_size_tensor_name: if not given, and the output has the same time len as the input,
+      we use the input seq lens to cut the output. otherwise the output is not cut.
+    :param int max_seqs: max number of seqs per batch
+    :param int max_frames: max number of (padded) input frames per batch
+    :param float max_latency: max time in seconds to wait for further requests to fill the batch
+    """
+    self.max_seqs = max_seqs
+    self.max_frames = max_frames
+    self.max_latency = max_latency
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      self._load_graph(graph_filename=graph_filename)
+      self.input_tensor = self.graph.get_tensor_by_name(input_tensor_name)
+      self.input_size_tensor = self.graph.get_tensor_by_name(input_size_tensor_name)
+      self.output_tensor = self.graph.get_tensor_by_name(output_tensor_name)
+      self.output_size_tensor = (
+        self.graph.get_tensor_by_name(output_size_tensor_name) if output_size_tensor_name else None)
+      self.feed_dict_extra = {}
+      for op_name in ["globals/train_flag"]:  # compile_tf_graph.py --train=-1
+        if op_name in [op.name for op in self.graph.get_operations()]:
+          self.feed_dict_extra[self.graph.get_tensor_by_name(op_name + ":0")] = False
+      self.session = tf.Session(graph=self.graph)
+      self._load_params(chkpt_filename=chkpt_filename)
+    self.input_dtype = self.input_tensor.dtype.base_dtype.as_numpy_dtype
+    self.input_feature_shape = tuple([d.value for d in self.input_tensor.shape[2:]])
+    assert all(self.input_feature_shape), "feature dims must be static, got %r" % self.input_tensor.shape
+    self._input_buffer = numpy.zeros((0,), dtype=self.input_dtype)  # flat, reshaped for each batch
+    self._input_size_buffer = numpy.zeros((max_seqs,), dtype="int32")
+    self._queue = Queue()
+    self._next_request = None  # type: typing.Optional[InferenceRequest]  # did not fit into the last batch
+    self._thread = threading.Thread(target=self._thread_main, name="inference batching")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _load_graph(self, graph_filename):
+    """
+    :param str graph_filename:
+    """
+    ext = os.path.splitext(graph_filename)[1]
+    if ext in [".meta", ".metatxt"]:
+      self.saver = tf.train.import_meta_graph(graph_filename, clear_devices=True)
+      return
+    graph_def = tf.GraphDef()
+    if ext == ".pbtxt":
+      from google.protobuf import text_format
+      text_format.Merge(open(graph_filename).read(), graph_def)
+    else:
+      graph_def.ParseFromString(open(graph_filename, "rb").read())
+    tf.import_graph_def(graph_def, name="")
+    self.saver = None  # no variable collections in a plain graph def, see _load_params
+
+  def _load_params(self, chkpt_filename):
+    """
+    :param str chkpt_filename:
+    """
+    if self.saver:
+      self.saver.restore(self.session, chkpt_filename)
+      return
+    # Plain graph def. Assign all the variables from the checkpoint via their assign ops.
+    reader = tf.train.NewCheckpointReader(chkpt_filename)
+    ops = {op.name: op for op in self.graph.get_operations()}
+    assign_ops = []
+    feed_dict = {}
+    for var_name in reader.get_variable_to_shape_map():
+      if var_name not in ops or var_name + "/Assign" not in ops:
+        continue
+      assign_op = ops[var_name + "/Assign"]
+      assign_ops.append(assign_op)
+      feed_dict[assign_op.inputs[1]] = reader.get_tensor(var_name)
+    var_ops = [op for op in ops.values() if op.type in ["VariableV2", "Variable"]]
+    assert len(assign_ops) == len(var_ops), "not all variables %r found in checkpoint %r" % (
+      sorted([op.name for op in var_ops]), chkpt_filename)
+    self.session.run(assign_ops, feed_dict=feed_dict)
+
+  def classify(self, data):
+    """
+    Thread-safe.
+
+    :param numpy.ndarray data: shape (time,) (sparse) or (time,dim)
+    :return: the request. use :func:`InferenceRequest.wait` to get the result
+    :rtype: InferenceRequest
+    """
+    data = numpy.asarray(data, dtype=self.input_dtype)
+    assert data.shape[1:] == self.input_feature_shape, "expected shape (time,)+%r, got %r" % (
+      self.input_feature_shape, data.shape)
+    request = InferenceRequest(data)
+    self._queue.put(request)
+    return request
+
+  def _collect_batch(self):
+    """
+    :return: requests for the next batch. blocks until there is at least one request
+    :rtype: list[InferenceRequest]
+    """
+    if self._next_request:
+      requests = [self._next_request]
+      self._next_request = None
+    else:
+      requests = [self._queue.get()]
+    deadline = requests[0].time_received + self.max_latency
+    while len(requests) < self.max_seqs:
+      try:
+        request = self._queue.get(timeout=max(deadline - time.time(), 0.))
+      except Empty:
+        break
+      max_len = max(request.num_frames, max([r.num_frames for r in requests]))
+      if max_len * (len(requests) + 1) > self.max_frames:
+        self._next_request = request
+        break
+      requests.append(request)
+    return requests
+
+  def _get_input_batch(self, requests):
+    """
+    Copies the seqs into the preallocated buffer.
+
+    :param list[InferenceRequest] requests:
+    :return: (input, input sizes), input is batch-major
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    n_batch = len(requests)
+    max_len = max([r.num_frames for r in requests])
+    shape = (n_batch, max_len) + self.input_feature_shape
+    size = int(numpy.prod(shape))
+    if self._input_buffer.size < size:
+      self._input_buffer = numpy.zeros((max(size, self._input_buffer.size * 2),), dtype=self.input_dtype)
+    batch = self._input_buffer[:size].reshape(shape)  # contiguous view into the buffer
+    for i, r in enumerate(requests):
+      batch[i, :r.num_frames] = r.data
+      batch[i, r.num_frames:] = 0
+    sizes = self._input_size_buffer[:n_batch]
+    sizes[:] = [r.num_frames for r in requests]
+    return batch, sizes
+
+  def _run_batch(self, requests):
+    """
+    :param list[InferenceRequest] requests:
+    """
+    start_time = time.time()
+    for r in requests:
+      r.time_compute_start = start_time
+    try:
+      batch, sizes = self._get_input_batch(requests)
+      feed_dict = {self.input_tensor: batch, self.input_size_tensor: sizes}
+      feed_dict.update(self.feed_dict_extra)
+      fetches = [self.output_tensor]
+      if self.output_size_tensor is not None:
+        fetches.append(self.output_size_tensor)
+      res = self.session.run(fetches, feed_dict=feed_dict)
+      output = res[0]
+      if self.output_size_tensor is not None:
+        output_sizes = res[1]
+      elif output.ndim >= 2 and output.shape[1] == batch.shape[1]:
+        output_sizes = sizes
+      else:
+        output_sizes = [None] * len(requests)
+      for i, r in enumerate(requests):
+        r.result = output[i, :output_sizes[i]] if output_sizes[i] is not None else output[i]
+    except Exception as exc:
+      for r in requests:
+        r.exception = exc
+    end_time = time.time()
+    for r in requests:
+      r.time_compute_end = end_time
+      r.done.set()
+
+  def _thread_main(self):
+    while True:
+      self._run_batch(self._collect_batch())
+
+
+def serve_http(engine, port):
+  """
+  :param InferenceEngine engine:
+  :param int port:
+  """
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+
+  class Handler(BaseHTTPRequestHandler):
+    """
+    Handles one request, in its own thread.
+    """
+
+    # noinspection PyPep8Naming
+    def do_POST(self):
+      """
+      Classify.
+      """
+      if self.path != "/classify":
+        self.send_error(404)
+        return
+      try:
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf8"))
+        request = engine.classify(body["data"])
+        result = request.wait()
+      except Exception as exc:
+        self.send_error(400, str(exc))
+        return
+      response = {"result": result.tolist()}
+      response.update(request.get_latency_info())
+      response_bytes = json.dumps(response).encode("utf8")
+      self.send_response(200)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(response_bytes)))
+      self.end_headers()
+      self.wfile.write(response_bytes)
+
+    def log_message(self, *args):
+      """
+      No logging per request.
+      """
+
+  class Server(ThreadingMixIn, HTTPServer):
+    """
+    A thread per request, such that the engine can batch them.
+    """
+    daemon_threads = True
+
+  print("Starting server on port: %d" % port)
+  Server(("", port), Handler).serve_forever()
+
+
+def serve_stdin(engine):
+  """
+  Reads one JSON input per line (``{"data": ...}``), and writes the responses in the same order.
+  All lines are submitted as soon as they are read, such that they can be batched.
+
+  :param InferenceEngine engine:
+  """
+  pending = Queue()  # type: Queue[typing.Optional[InferenceRequest]]
+
+  def writer():
+    """
+    Writes the responses in order.
+    """
+    while True:
+      request = pending.get()
+      if request is None:
+        break
+      response = {"result": request.wait().tolist()}
+      response.update(request.get_latency_info())
+      print(json.dumps(response))
+      sys.stdout.flush()
+
+  writer_thread = threading.Thread(target=writer, name="stdin response writer")
+  writer_thread.start()
+  for line in sys.stdin:
+    if line.strip():
+      pending.put(engine.classify(json.loads(line)["data"]))
+  pending.put(None)
+  writer_thread.join()
+
+
+def main():
+  """
+  Main entry.
+  """
+  arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  arg_parser.add_argument("--graph", help="compiled TF graph (.pb, .pbtxt, .meta, .metatxt)", required=True)
+  arg_parser.add_argument("--chkpt", help="TF checkpoint (model params)", required=True)
+  arg_parser.add_argument("--output_layer", default="output", help="uses <output_layer>/output_batch_major:0")
+  arg_parser.add_argument("--output_tensor", help="overwrites --output_layer, any batch-major tensor name")
+  arg_parser.add_argument("--output_size_tensor", help="seq lens of the output. by default from the input")
+  arg_parser.add_argument("--input_key", default="data", help="extern data key")
+  arg_parser.add_argument("--load_op_library", action="append", default=[], help="e.g. compiled native ops")
+  arg_parser.add_argument("--max_seqs", type=int, default=32)
+  arg_parser.add_argument("--max_frames", type=int, default=20000, help="max padded input frames per batch")
+  arg_parser.add_argument("--max_latency", type=float, default=0.01, help="in seconds")
+  arg_parser.add_argument("--port", type=int, default=10687)
+  arg_parser.add_argument("--stdin", action="store_true", help="read from stdin instead of serving HTTP")
+  args = arg_parser.parse_args()
+
+  for filename in args.load_op_library:
+    tf.load_op_library(filename)
+  engine = InferenceEngine(
+    graph_filename=args.graph, chkpt_filename=args.chkpt,
+    output_tensor_name=args.output_tensor or "%s/output_batch_major:0" % args.output_layer,
+    input_tensor_name="extern_data/placeholders/%s/%s:0" % (args.input_key, args.input_key),
+    input_size_tensor_name="extern_data/placeholders/%s/%s_dim0_size:0" % (args.input_key, args.input_key),
+    output_size_tensor_name=args.output_size_tensor,
+    max_seqs=args.max_seqs, max_frames=args.max_frames, max_latency=args.max_latency)
+  if args.stdin:
+    serve_stdin(engine)
+  else:
+    serve_http(engine, port=args.port)
+
+
+if __name__ == '__main__':
+  import better_exchook
+  better_exchook.install()
+  main()
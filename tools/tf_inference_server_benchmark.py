@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+Load generator for `tf_inference_server.py`.
+Sends random seqs with a fixed number of concurrent clients,
+and reports the throughput and the latency distribution.
+
+Example::
+
+  tf_inference_server_benchmark.py --url http://localhost:10687/classify --dim 40 --concurrency 16
+"""
+
+from __future__ import print_function
+
+import json
+import time
+import argparse
+import threading
+import numpy
+from urllib.request import urlopen, Request
+
+
+def send_request(url, data):
+  """
+  :param str url:
+  :param numpy.ndarray data:
+  :return: response
+  :rtype: dict[str]
+  """
+  body = json.dumps({"data": data.tolist()}).encode("utf8")
+  request = Request(url, data=body, headers={"Content-Type": "application/json"})
+  return json.loads(urlopen(request).read().decode("utf8"))
+
+
+def main():
+  """
+  Main entry.
+  """
+  arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  arg_parser.add_argument("--url", default="http://localhost:10687/classify")
+  arg_parser.add_argument("--dim", type=int, help="feature dim for dense input")
+  arg_parser.add_argument("--sparse_dim", type=int, help="vocab size for sparse input")
+  arg_parser.add_argument("--min_len", type=int, default=50)
+  arg_parser.add_argument("--max_len", type=int, default=500)
+  arg_parser.add_argument("--num_requests", type=int, default=1000)
+  arg_parser.add_argument("--concurrency", type=int, default=8, help="number of clients sending in parallel")
+  arg_parser.add_argument("--seed", type=int, default=42)
+  args = arg_parser.parse_args()
+  assert bool(args.dim) != bool(args.sparse_dim), "specify either --dim or --sparse_dim"
+
+  rnd = numpy.random.RandomState(args.seed)
+  seq_lens = rnd.randint(args.min_len, args.max_len + 1, size=(args.num_requests,))
+  if args.dim:
+    inputs = [rnd.normal(size=(n, args.dim)).astype("float32") for n in seq_lens]
+  else:
+    inputs = [rnd.randint(0, args.sparse_dim, size=(n,)) for n in seq_lens]
+
+  lock = threading.Lock()
+  next_idx = [0]
+  latencies = []
+  server_latencies = []  # (queue, compute)
+  errors = []
+
+  def client():
+    """
+    Sends requests until all are done.
+    """
+    while True:
+      with lock:
+        idx = next_idx[0]
+        if idx >= len(inputs):
+          return
+        next_idx[0] += 1
+      start_time = time.time()
+      try:
+        response = send_request(args.url, inputs[idx])
+      except Exception as exc:
+        with lock:
+          errors.append(exc)
+        continue
+      with lock:
+        latencies.append(time.time() - start_time)
+        server_latencies.append((response["queue_latency"], response["compute_latency"]))
+
+  print("Sending %i requests (seq len %i-%i) with %i clients to %s ..." % (
+    args.num_requests, args.min_len, args.max_len, args.concurrency, args.url))
+  start_time = time.time()
+  threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  total_time = time.time() - start_time
+
+  print("Total time: %.3f sec, %i errors" % (total_time, len(errors)))
+  if errors:
+    print("First error:", errors[0])
+  if not latencies:
+    return
+  print("Throughput: %.1f seqs/sec, %.1f frames/sec" % (
+    len(latencies) / total_time, sum(seq_lens[:len(latencies)]) / total_time))
+  latencies = numpy.array(latencies) * 1000.
+  print("Latency (ms): mean %.1f, p50 %.1f, p90 %.1f, p99 %.1f, max %.1f" % (
+    numpy.mean(latencies), numpy.percentile(latencies, 50), numpy.percentile(latencies, 90),
+    numpy.percentile(latencies, 99), numpy.max(latencies)))
+  server_latencies = numpy.array(server_latencies) * 1000.
+  print("Server queue latency (ms): mean %.1f, p99 %.1f; compute latency (ms): mean %.1f, p99 %.1f" % (
+    numpy.mean(server_latencies[:, 0]), numpy.percentile(server_latencies[:, 0], 99),
+    numpy.mean(server_latencies[:, 1]), numpy.percentile(server_latencies[:, 1], 99)))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+"""
+Beam search decoder for a rec layer which was compiled in step-by-step form via `compile_tf_graph.py`
+(see :class:`RecStepByStepLayer` there for the interface).
+The encoder and every single decoder step are separate session runs, and the beam is managed here in Python.
+Hypotheses which are finished (end label, or max seq len reached),
+or which cannot become better than an already finished hypothesis of the same seq,
+are removed from the batch between the steps, i.e. all the state vars are compacted
+(via the "select_src_beams" op), such that the following steps only compute the remaining active hypotheses.
+
+Example::
+
+  compile_tf_graph.py returnn.config --rec_step_by_step output --rec_step_by_step_output_file info.json \\
+    --output_file graph.meta
+  tf_rec_step_by_step_decoder.py --graph graph.meta --info info.json --chkpt net-model/network.040 --beam_size 12
+
+The input is read from stdin, one JSON ``{"data": [[...], ...]}`` (time-major features, or label indices) per line,
+and the output is one JSON ``{"hyps": [[...], ...], "scores": [...], "latency": ..., "num_steps": ...}`` per line,
+with the hyps sorted by score (best first).
+
+See `tf_beam_search_benchmark.py` (``--modes step_by_step``) for a comparison to the search inside the graph.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import typing
+import numpy
+import tensorflow as tf
+
+my_dir = os.path.dirname(os.path.abspath(__file__))
+returnn_dir = os.path.dirname(my_dir)
+sys.path.insert(0, returnn_dir)
+
+# No RETURNN dependency needed for the decoder itself. Just TF itself.
+
+
+class StepByStepDecoder:
+  """
+  Runs the encoder and the decoder steps of a step-by-step compiled graph, and does the beam search.
+  """
+
+  def __init__(self, session, info,
+               input_tensor_name="extern_data/placeholders/data/data:0",
+               input_size_tensor_name="extern_data/placeholders/data/data_dim0_size:0",
+               beam_size=12, end_label=0, max_seq_len_factor=1.0):
+    """
+    :param tf.Session session: with the graph, and the model params already loaded
+    :param dict[str] info: the JSON info from `compile_tf_graph.py --rec_step_by_step_output_file`
+    :param str input_tensor_name:
+    :param str input_size_tensor_name:
+    :param int beam_size:
+    :param int|None end_label: a hyp ends with this label (which is not part of the result). None to disable
+    :param float max_seq_len_factor: a hyp ends after this factor times the input seq len steps
+    """
+    assert len(info["stochastic_var_order"]) == 1, (
+      "only a single choice (stochastic var) is supported, got %r" % info["stochastic_var_order"])
+    self.session = session
+    self.beam_size = beam_size
+    self.end_label = end_label
+    self.max_seq_len_factor = max_seq_len_factor
+    graph = session.graph
+    self.input_tensor = graph.get_tensor_by_name(input_tensor_name)
+    self.input_size_tensor = graph.get_tensor_by_name(input_size_tensor_name)
+    self.input_dtype = self.input_tensor.dtype.base_dtype.as_numpy_dtype
+    self.init_op = graph.get_operation_by_name(info["init_op"])
+    self.next_step_op = graph.get_operation_by_name(info["next_step_op"])
+    self.select_src_beams_op = graph.get_operation_by_name(info["select_src_beams"]["op"])
+    self.src_beams_placeholder = graph.get_tensor_by_name(
+      info["select_src_beams"]["src_beams_placeholder"] + ":0")
+    stochastic_var = info["stochastic_vars"][info["stochastic_var_order"][0]]
+    # This is the assign op of the scores state var. Its output is the new value, thus we get it in one session run.
+    self.calc_scores = graph.get_operation_by_name(stochastic_var["calc_scores_op"]).outputs[0]
+    choice_var = graph.get_tensor_by_name(info["state_vars"][stochastic_var["choice_state_var"]]["var_op"] + ":0")
+    with graph.as_default():
+      self.choice_placeholder = tf.placeholder(
+        name="step_by_step_decoder_choice", shape=(None,), dtype=choice_var.dtype.base_dtype)
+      self.set_choice_op = tf.assign(choice_var, self.choice_placeholder, validate_shape=False).op
+    self.feed_dict_extra = {}
+    for op_name in ["globals/train_flag"]:  # compile_tf_graph.py --train=-1
+      if op_name in [op.name for op in graph.get_operations()]:
+        self.feed_dict_extra[graph.get_tensor_by_name(op_name + ":0")] = False
+    self.num_steps = 0  # of the last decode() call
+
+  def decode(self, inputs):
+    """
+    :param list[numpy.ndarray] inputs: seqs, each of shape (time,) (sparse) or (time,dim)
+    :return: per seq, the finished hyps (labels, score), sorted by score, best first
+    :rtype: list[list[(list[int],float)]]
+    """
+    num_seqs = len(inputs)
+    seq_lens = numpy.array([x.shape[0] for x in inputs], dtype="int32")
+    data = numpy.zeros((num_seqs, max(seq_lens)) + inputs[0].shape[1:], dtype=self.input_dtype)
+    for i, x in enumerate(inputs):
+      data[i, :x.shape[0]] = x
+    feed_dict = {self.input_tensor: data, self.input_size_tensor: seq_lens}
+    feed_dict.update(self.feed_dict_extra)
+    self.session.run(self.init_op, feed_dict=feed_dict)
+    max_seq_lens = numpy.maximum(numpy.ceil(seq_lens * self.max_seq_len_factor).astype("int32"), 1)
+    # The active hyps. Each is one entry in the batch dim of the state vars, grouped by seq (in increasing order).
+    hyp_seq_idx = numpy.arange(num_seqs)
+    hyp_scores = numpy.zeros((num_seqs,), dtype="float32")
+    hyp_labels = [[] for _ in range(num_seqs)]  # type: typing.List[typing.List[int]]
+    finished = [[] for _ in range(num_seqs)]  # type: typing.List[typing.List[typing.Tuple[typing.List[int],float]]]
+    step = 0
+    while len(hyp_seq_idx) > 0:
+      scores = self.session.run(self.calc_scores, feed_dict=self.feed_dict_extra)  # (hyps,dim), +log space
+      num_labels = scores.shape[1]
+      scores = scores + hyp_scores[:, None]
+      new_src_hyps, new_labels, new_scores = [], [], []
+      seq_idxs, seq_starts, seq_counts = numpy.unique(hyp_seq_idx, return_index=True, return_counts=True)
+      for seq_idx, start, count in zip(seq_idxs, seq_starts, seq_counts):
+        seq_scores = scores[start:start + count].reshape((-1,))
+        k = min(self.beam_size, len(seq_scores))
+        best = numpy.argpartition(-seq_scores, k - 1)[:k]
+        best = best[numpy.argsort(-seq_scores[best], kind="stable")]
+        seq_finished = finished[seq_idx]
+        for idx in best:
+          src_hyp, label, score = start + idx // num_labels, int(idx % num_labels), float(seq_scores[idx])
+          if label == self.end_label:
+            seq_finished.append((hyp_labels[src_hyp], score))
+          elif step + 1 >= max_seq_lens[seq_idx]:
+            seq_finished.append((hyp_labels[src_hyp] + [label], score))
+          else:
+            new_src_hyps.append(src_hyp)
+            new_labels.append(label)
+            new_scores.append(score)
+        if seq_finished:
+          # The scores only get worse with further labels, so we can prune all hyps
+          # which are already worse than the best finished hyp, or all if we have enough finished hyps.
+          best_finished_score = max(score for (_, score) in seq_finished)
+          while new_src_hyps and hyp_seq_idx[new_src_hyps[-1]] == seq_idx and (
+                len(seq_finished) >= self.beam_size or new_scores[-1] <= best_finished_score):
+            new_src_hyps.pop()
+            new_labels.pop()
+            new_scores.pop()
+      if not new_src_hyps:
+        break
+      # Select the remaining hyps in all the state vars, i.e. remove the finished ones from the batch.
+      # We treat all hyps as a single batch entry, and select the new hyps as its beam.
+      self.session.run(
+        [self.select_src_beams_op, self.set_choice_op],
+        feed_dict={
+          self.src_beams_placeholder: numpy.array([new_src_hyps], dtype="int32"),
+          self.choice_placeholder: numpy.array(new_labels, dtype=self.choice_placeholder.dtype.as_numpy_dtype)})
+      self.session.run(self.next_step_op, feed_dict=self.feed_dict_extra)
+      hyp_labels = [hyp_labels[src_hyp] + [label] for (src_hyp, label) in zip(new_src_hyps, new_labels)]
+      hyp_seq_idx = hyp_seq_idx[new_src_hyps]
+      hyp_scores = numpy.array(new_scores, dtype="float32")
+      step += 1
+    self.num_steps = step + 1
+    return [sorted(seq_finished, key=lambda hyp: -hyp[1])[:self.beam_size] for seq_finished in finished]
+
+
+def load_session(graph_filename, chkpt_filename):
+  """
+  :param str graph_filename: .meta or .metatxt, via compile_tf_graph.py
+  :param str chkpt_filename: TF checkpoint with the model params
+  :return: new session, with the graph, and the model params loaded
+  :rtype: tf.Session
+  """
+  assert os.path.splitext(graph_filename)[1] in [".meta", ".metatxt"], (
+    "need a meta graph, to distinguish the model params from the state vars")
+  graph = tf.Graph()
+  with graph.as_default():
+    saver = tf.train.import_meta_graph(graph_filename, clear_devices=True)
+  session = tf.Session(graph=graph)
+  saver.restore(session, chkpt_filename)
+  return session
+
+
+def main():
+  """
+  Main entry.
+  """
+  arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  arg_parser.add_argument("--graph", help="compiled TF graph (.meta, .metatxt)", required=True)
+  arg_parser.add_argument("--info", help="JSON via compile_tf_graph.py --rec_step_by_step_output_file", required=True)
+  arg_parser.add_argument("--chkpt", help="TF checkpoint (model params)", required=True)
+  arg_parser.add_argument("--input_key", default="data", help="extern data key")
+  arg_parser.add_argument("--load_op_library", action="append", default=[], help="e.g. compiled native ops")
+  arg_parser.add_argument("--beam_size", type=int, default=12)
+  arg_parser.add_argument("--end_label", type=int, default=0, help="-1 to disable")
+  arg_parser.add_argument("--max_seq_len_factor", type=float, default=1.0, help="relative to the input seq len")
+  args = arg_parser.parse_args()
+
+  for filename in args.load_op_library:
+    tf.load_op_library(filename)
+  with open(args.info) as f:
+    info = json.load(f)
+  decoder = StepByStepDecoder(
+    session=load_session(graph_filename=args.graph, chkpt_filename=args.chkpt), info=info,
+    input_tensor_name="extern_data/placeholders/%s/%s:0" % (args.input_key, args.input_key),
+    input_size_tensor_name="extern_data/placeholders/%s/%s_dim0_size:0" % (args.input_key, args.input_key),
+    beam_size=args.beam_size, end_label=args.end_label if args.end_label >= 0 else None,
+    max_seq_len_factor=args.max_seq_len_factor)
+  for line in sys.stdin:
+    line = line.strip()
+    if not line:
+      continue
+    data = numpy.array(json.loads(line)["data"])
+    start_time = time.time()
+    hyps, = decoder.decode([data])
+    print(json.dumps({
+      "hyps": [labels for (labels, _) in hyps], "scores": [score for (_, score) in hyps],
+      "latency": time.time() - start_time, "num_steps": decoder.num_steps}))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+  import better_exchook
+  better_exchook.install()
+  main()